@@ -0,0 +1,207 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""A stand-in for MySQLdb (as databases.mysql wraps it) over SQLite.
+
+It's for load tests and trying the server out locally, selected with
+CONFIG_DB_BACKEND=sqlite and CONFIG_SQLITE_DB=filename: queries are
+translated from the MySQL dialect the server uses (%s and ? parameters,
+<=>), and cursors behave like MySQLdb's, with buffered cursors fetching
+their rows (and setting rowcount) on execute.  createSchema() loads
+sql/schema.sql and the like."""
+import re
+import sqlite3
+from sqlite3 import (Error, Warning, InterfaceError, DatabaseError, DataError,
+                     OperationalError, IntegrityError, InternalError,
+                     ProgrammingError, NotSupportedError)
+
+_params = re.compile(r"%[%s]")
+
+
+def translate(query, args=None):
+    """Returns query in SQLite's dialect"""
+    query = query.replace("<=>", " IS ")
+    if args is not None:
+        query = _params.sub(lambda m: m.group(0) == "%%" and "%" or "?", query)
+    return query
+
+
+class Cursor(object):
+    """Like MySQLdb.cursors.Cursor, with the rows fetched on execute"""
+    _buffered = True
+    _dicts = False
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection._conn.cursor()
+        self._rows = None
+        self._pos = 0
+        self.rowcount = -1
+
+    def execute(self, query, args=None):
+        if args is not None and not isinstance(args, (tuple, list, dict)):
+            # MySQLdb formats a lone value too
+            args = (args,)
+        self._cursor.execute(translate(query, args), args or ())
+        self._rows = None
+        self._pos = 0
+        self.rowcount = self._cursor.rowcount
+        if self._cursor.description is not None and self._buffered:
+            self._rows = [self._row(r) for r in self._cursor.fetchall()]
+            self.rowcount = len(self._rows)
+        return self.rowcount
+
+    def executemany(self, query, args):
+        self._cursor.executemany(translate(query, ()), args)
+        self.rowcount = self._cursor.rowcount
+        return self.rowcount
+
+    def _row(self, row):
+        if self._dicts:
+            return dict(zip([d[0] for d in self._cursor.description], row))
+        return row
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        if rows:
+            return rows[0]
+        return None
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self._cursor.arraysize
+        if self._rows is None:
+            return [self._row(r) for r in self._cursor.fetchmany(size)]
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        if self._rows is None:
+            return [self._row(r) for r in self._cursor.fetchall()]
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def close(self):
+        self._rows = None
+        self._cursor.close()
+
+
+class DictCursor(Cursor):
+    _dicts = True
+
+
+class SSCursor(Cursor):
+    """Reads rows as they're fetched rather than on execute"""
+    _buffered = False
+
+
+class SSDictCursor(SSCursor):
+    _dicts = True
+
+
+class cursors:
+    """As in MySQLdb.cursors"""
+    Cursor = Cursor
+    DictCursor = DictCursor
+    SSCursor = SSCursor
+    SSDictCursor = SSDictCursor
+
+
+class Connection(object):
+    def __init__(self, db=":memory:", cursorclass=Cursor, timeout=30, **kw):
+        # The connection pool hands connections from thread to thread
+        self._conn = sqlite3.connect(db, timeout=timeout, check_same_thread=False)
+        # Strings come back as str, as they do from MySQLdb
+        self._conn.text_factory = str
+        self.cursorclass = cursorclass
+        self._last_insert = None
+
+    def cursor(self, cursorclass=None):
+        return (cursorclass or self.cursorclass)(self)
+
+    def execute(self, query, args=None):
+        cur = self.cursor()
+        result = cur.execute(query, args)
+        self._last_insert = cur.lastrowid
+        cur.close()
+        return result
+
+    def insert_id(self):
+        return self._last_insert
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def ping(self):
+        self._conn.execute("SELECT 1")
+
+    def close(self):
+        self._conn.close()
+
+
+def connect(*args, **kw):
+    return Connection(*args, **kw)
+
+
+def createSchema(conn, sql):
+    """Runs MySQL CREATE TABLE and INSERT statements (as in sql/*.sql) on
+    an SQLite connection"""
+    for statement in sql.split(";\n"):
+        lines = [l for l in statement.splitlines() if not l.strip().startswith("--")]
+        statement = "\n".join(lines).strip()
+        if not statement or statement.upper().startswith("SET "):
+            continue
+        if statement.upper().startswith("CREATE TABLE"):
+            for s in _createTable(statement):
+                conn._conn.execute(s)
+        else:
+            conn._conn.execute(translate(statement))
+    conn.commit()
+
+
+def _createTable(statement):
+    """Returns the SQLite statements for a MySQL CREATE TABLE: the table,
+    and an index for each of its KEYs"""
+    head, body = statement.split("(", 1)
+    table = head.split()[-1].strip("`")
+    body = body[:body.rindex(")")]
+    columns = []
+    indexes = []
+    auto = None
+    for line in body.splitlines():
+        line = line.strip().rstrip(",")
+        if not line:
+            continue
+        upper = line.upper()
+        if upper.startswith("PRIMARY KEY"):
+            if auto is None:
+                columns.append(line)
+        elif upper.startswith("UNIQUE KEY"):
+            columns.append("UNIQUE " + line[line.index("("):])
+        elif upper.startswith("KEY"):
+            indexes.append(line[line.index("("):])
+        elif "AUTO_INCREMENT" in upper:
+            auto = line.split()[0]
+            columns.append("%s INTEGER PRIMARY KEY AUTOINCREMENT" % auto)
+        else:
+            columns.append(re.sub(r"(?i)\s+UNSIGNED", "", line))
+    statements = ["CREATE TABLE IF NOT EXISTS %s (\n  %s\n)" % (table, ",\n  ".join(columns))]
+    for i, index in enumerate(indexes):
+        statements.append("CREATE INDEX IF NOT EXISTS %s_%i ON %s %s" % (table, i, table, index))
+    return statements
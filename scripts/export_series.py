@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Writes (test, branch, os) series to columnar files.
+
+The database is configured with the same CONFIG_MYSQL_* environment
+variables as the server."""
+import os
+import sys
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(here), 'server'))
+
+import columnar
+from export_cgi import buildSeries, FORMATS
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [TEST_ID,BRANCH_ID,OS_ID ...]")
+    parser.add_option("-d", "--dir", dest="dir", default=".", help="directory to write files to")
+    parser.add_option("-f", "--format", dest="format", default="columnar",
+                      help="columnar (default), arrow or parquet")
+    parser.add_option("-a", "--all", dest="all", action="store_true",
+                      help="export every valid test combination")
+    options, args = parser.parse_args()
+
+    if options.format not in FORMATS:
+        parser.error("Unknown format %s" % options.format)
+    if options.format != 'columnar' and columnar.pyarrow is None:
+        parser.error("The %s format needs pyarrow" % options.format)
+
+    combos = []
+    for arg in args:
+        try:
+            test_id, branch_id, os_id = [int(x) for x in arg.split(",")]
+        except ValueError:
+            parser.error("Bad series %r, expected TEST_ID,BRANCH_ID,OS_ID" % arg)
+        combos.append((test_id, branch_id, os_id))
+    if options.all:
+        from api import get_test_combos
+        combos.extend((row['test_id'], row['branch_id'], row['os_id'])
+                      for row in get_test_combos())
+    if not combos:
+        parser.error("No series given")
+
+    if not os.path.exists(options.dir):
+        os.makedirs(options.dir)
+
+    ext = FORMATS[options.format][1]
+    for test_id, branch_id, os_id in combos:
+        writer = buildSeries(test_id, branch_id, os_id)
+        if not len(writer):
+            print "No runs for test %s branch %s os %s" % (test_id, branch_id, os_id)
+            continue
+        filename = os.path.join(options.dir, "%s-%s-%s.%s" % (test_id, branch_id, os_id, ext))
+        tmp = filename + ".tmp"
+        fp = open(tmp, "wb")
+        writer.write(fp, options.format)
+        fp.close()
+        os.rename(tmp, filename)
+        print "Wrote %i runs to %s" % (len(writer), filename)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Load tests the server's WSGI apps: api, getdata, collect and bulk.
+
+A database is seeded with synthetic test runs and each endpoint is driven
+by concurrent clients, calling the app in-process or over HTTP to a local
+server.  Latency percentiles, throughput, errors and the queries each
+request ran (their number, database time and rows, from graphsdb.queries)
+are reported per endpoint, with the slowest statements in the JSON.
+
+The database is SQLite (databases.sqlite) by default; --db mysql uses the
+one set with the CONFIG_MYSQL_* environment variables, as the server does.
+Seeding that expects an empty scratch database."""
+import os
+import sys
+import math
+import time
+import random
+import httplib
+import tempfile
+import threading
+import urllib
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from webob import Request
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.append(os.path.join(root, 'server'))
+
+ENDPOINTS = ['api', 'getdata', 'collect', 'bulk']
+MODES = ['inprocess', 'http']
+
+OSES = ["linux", "win7", "mac", "android"]
+BRANCHES = ["Firefox", "Inbound", "Try"]
+TESTS = [("ts", "Ts", None),
+         ("tp5", "Tp5", "tp5"),
+         ("tsvg", "SVG", None),
+         ("dromaeo", "Dromaeo", None),
+         ("a11y", "A11Y", None)]
+PAGES = 10
+VALUES_PER_RUN = 10
+POINTS_PER_SET = 200
+DAY = 24 * 3600
+
+# The tables getdata_cgi and bulk_cgi still read and write, which are no
+# longer in sql/schema.sql.  Their annotations live alongside the current
+# ones, in extra columns.
+LEGACY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dataset_info (
+   id INT UNSIGNED NOT NULL AUTO_INCREMENT,
+   type VARCHAR(255),
+   machine VARCHAR(255),
+   test VARCHAR(255),
+   test_type VARCHAR(255),
+   extra_data VARCHAR(255),
+   branch VARCHAR(255),
+   date INT,
+
+   PRIMARY KEY (id),
+   KEY (type, date)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS dataset_values (
+   dataset_id INT UNSIGNED NOT NULL,
+   time INT NOT NULL,
+   value FLOAT,
+
+   KEY (dataset_id, time)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS dataset_branchinfo (
+   dataset_id INT UNSIGNED NOT NULL,
+   time INT NOT NULL,
+   branchid VARCHAR(255),
+
+   KEY (dataset_id, time)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS dataset_extra_data (
+   dataset_id INT UNSIGNED NOT NULL,
+   time INT NOT NULL,
+   data TEXT,
+
+   KEY (dataset_id, time)
+) ENGINE=InnoDB;
+
+ALTER TABLE annotations ADD COLUMN dataset_id INT;
+ALTER TABLE annotations ADD COLUMN time INT;
+ALTER TABLE annotations ADD COLUMN value TEXT;
+"""
+
+
+def createSchema(MySQLdb, conn):
+    sql = open(os.path.join(root, 'sql', 'schema.sql')).read() + LEGACY_SCHEMA
+    if hasattr(MySQLdb, 'createSchema'):
+        MySQLdb.createSchema(conn, sql)
+        return
+    cur = conn.cursor()
+    for statement in sql.split(";\n"):
+        if statement.strip():
+            cur.execute(statement)
+    cur.close()
+    conn.commit()
+
+
+def seed(conn, scale=1, days=60, now=None, rnd=None):
+    """Fills an empty database with runs of every test on every branch and
+    os over the last days, and datasets for the legacy tables; the amount
+    of data grows linearly with scale"""
+    if now is None:
+        now = int(time.time())
+    if rnd is None:
+        rnd = random.Random(1)
+    start = now - days * DAY
+    cur = conn.cursor()
+
+    def insert(table, columns, rows):
+        if rows:
+            cur.executemany("INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns),
+                                                                 ", ".join(["%s"] * len(columns))),
+                            rows)
+
+    insert("os_list", ["id", "name"], [(i + 1, name) for i, name in enumerate(OSES)])
+    insert("branches", ["id", "name"], [(i + 1, name) for i, name in enumerate(BRANCHES)])
+    insert("pagesets", ["id", "name"], [(1, "tp5")])
+    insert("pages", ["id", "pageset_id", "name"],
+           [(i + 1, 1, "page%i.html" % i) for i in range(PAGES)])
+    insert("tests", ["id", "name", "pretty_name", "is_active", "pageset_id"],
+           [(i + 1, name, pretty, 1, pageset and 1 or None)
+            for i, (name, pretty, pageset) in enumerate(TESTS)])
+
+    machines = {}
+    rows = []
+    for os_id in range(1, len(OSES) + 1):
+        for n in range(2 * scale):
+            rows.append((len(rows) + 1, os_id, "talos-%s-%02i" % (OSES[os_id - 1], n), 1, start))
+            machines.setdefault(os_id, []).append(len(rows))
+    insert("machines", ["id", "os_id", "name", "is_active", "date_added"], rows)
+
+    builds = []
+    runs = []
+    values = []
+    annotations = []
+    per_branch = 40 * scale
+    for branch_id in range(1, len(BRANCHES) + 1):
+        for n in range(per_branch):
+            date = start + (days * DAY) * n // per_branch + rnd.randint(0, 600)
+            build_id = len(builds) + 1
+            builds.append((build_id, 20000000000000 + build_id, "%012x" % rnd.getrandbits(48),
+                           branch_id, date))
+            for test_id, (name, pretty, pageset) in enumerate(TESTS):
+                for os_id in machines:
+                    run_id = len(runs) + 1
+                    level = 100 * (test_id + 1) + 10 * os_id
+                    run_values = [rnd.gauss(level, level * 0.02) for i in range(VALUES_PER_RUN)]
+                    runs.append((run_id, rnd.choice(machines[os_id]), test_id + 1, build_id, 0,
+                                 date + rnd.randint(600, 3600),
+                                 sum(run_values) / len(run_values)))
+                    for i, value in enumerate(run_values):
+                        values.append((run_id, i, value, pageset and i % PAGES + 1 or None))
+                    if run_id % 25 == 0:
+                        annotations.append((run_id, "Regression", 500000 + run_id))
+    insert("builds", ["id", "ref_build_id", "ref_changeset", "branch_id", "date_added"], builds)
+    insert("test_runs", ["id", "machine_id", "test_id", "build_id", "run_number", "date_run",
+                         "average"], runs)
+    insert("test_run_values", ["test_run_id", "interval_id", "value", "page_id"], values)
+    insert("annotations", ["test_run_id", "note", "bug_id"], annotations)
+    insert("valid_test_combinations", ["test_id", "branch_id", "os_id"],
+           [(t + 1, b + 1, o + 1) for t in range(len(TESTS))
+            for b in range(len(BRANCHES)) for o in range(len(OSES))])
+    insert("valid_test_combinations_updated", ["last_updated"], [(now,)])
+
+    sets = []
+    points = []
+    extra = []
+    branchinfo = []
+    for set_id in range(1, 10 * scale + 1):
+        test = TESTS[set_id % len(TESTS)][0]
+        branch = BRANCHES[set_id % len(BRANCHES)]
+        os_id = set_id % len(OSES) + 1
+        machine = "talos-%s-%02i" % (OSES[os_id - 1], set_id % (2 * scale))
+        sets.append((set_id, "continuous", machine, test, "perf", "branch=" + branch, branch, 0))
+        for n in range(POINTS_PER_SET):
+            t = start + (days * DAY) * n // POINTS_PER_SET
+            points.append((set_id, t, rnd.gauss(100, 2)))
+            extra.append((set_id, t, "rev%i" % n))
+            branchinfo.append((set_id, t, str(20000000000000 + n)))
+    insert("dataset_info", ["id", "type", "machine", "test", "test_type", "extra_data", "branch",
+                            "date"], sets)
+    insert("dataset_values", ["dataset_id", "time", "value"], points)
+    insert("dataset_extra_data", ["dataset_id", "time", "data"], extra)
+    insert("dataset_branchinfo", ["dataset_id", "time", "branchid"], branchinfo)
+    cur.close()
+    conn.commit()
+    return {'runs': len(runs), 'values': len(values), 'datasets': len(sets),
+            'points': len(points)}
+
+
+class Dataset(object):
+    """The ids and names requests are made for, read from the database"""
+
+    def __init__(self, conn):
+        cur = conn.cursor()
+        cur.execute("SELECT test_id, branch_id, os_id FROM valid_test_combinations")
+        self.combos = [tuple(row) for row in cur.fetchall()]
+        cur.execute("SELECT id, name, os_id FROM machines WHERE is_active <> 0")
+        self.machines = [tuple(row) for row in cur.fetchall()]
+        cur.execute("SELECT id, name FROM tests")
+        self.tests = dict(cur.fetchall())
+        cur.execute("SELECT id, name FROM branches")
+        self.branches = dict(cur.fetchall())
+        cur.execute("SELECT MIN(id), MAX(id), MAX(date_run) FROM test_runs")
+        self.first_run, self.last_run, self.last_date = cur.fetchone()
+        cur.execute("SELECT id, machine, test, branch FROM dataset_info WHERE type = %s LIMIT 1000",
+                    ("continuous",))
+        self.sets = [tuple(row) for row in cur.fetchall()]
+        cur.close()
+        if not (self.combos and self.machines and self.first_run and self.sets):
+            raise ValueError("The database has no data to make requests for; seed it first")
+        self.nextBuild = iter(xrange(1, sys.maxint)).next
+
+
+def apiRequest(data, rnd):
+    test_id, branch_id, os_id = rnd.choice(data.combos)
+    choice = rnd.random()
+    if choice < 0.1:
+        params = {'item': 'tests'}
+    elif choice < 0.3:
+        params = {'item': 'test', 'id': test_id}
+    elif choice < 0.6:
+        params = {'item': 'testruns', 'id': test_id, 'branchid': branch_id, 'platformid': os_id}
+    elif choice < 0.8:
+        machine_id = rnd.choice([m[0] for m in data.machines if m[2] == os_id])
+        params = {'item': 'testruns', 'id': test_id, 'branchid': branch_id,
+                  'machineid': machine_id, 'days': 30}
+    else:
+        params = {'item': 'testrun', 'id': rnd.randint(data.first_run, data.last_run)}
+    return "/api?" + urllib.urlencode(params), None
+
+
+def getdataRequest(data, rnd):
+    set_id = rnd.choice(data.sets)[0]
+    choice = rnd.random()
+    if choice < 0.15:
+        params = {'getlist': 1, 'type': 'continuous', 'branch': 1}
+    elif choice < 0.3:
+        params = {'type': 'continuous'}
+    elif choice < 0.4:
+        params = {'action': 'testinfo', 'setid': set_id}
+    elif choice < 0.85:
+        params = {'setid': set_id}
+    else:
+        params = {'setid': set_id, 'starttime': data.last_date - 14 * DAY,
+                  'endtime': data.last_date}
+    return "/getdata?" + urllib.urlencode(params), None
+
+
+def collectRequest(data, rnd):
+    test_id, branch_id, os_id = rnd.choice(data.combos)
+    machine = rnd.choice([m[1] for m in data.machines if m[2] == os_id])
+    build = data.nextBuild()
+    lines = ["START", "VALUES",
+             "%s,%s,%s,%012x,%i,%i" % (machine, data.tests[test_id], data.branches[branch_id],
+                                       build, 30000000000000 + build, int(time.time()))]
+    for i in range(VALUES_PER_RUN):
+        lines.append("%i,%.2f" % (i, rnd.gauss(100, 2)))
+    lines.append("END")
+    return "/collect", "\n".join(lines) + "\n"
+
+
+def bulkRequest(data, rnd):
+    set_id, machine, test, branch = rnd.choice(data.sets)
+    build = data.nextBuild()
+    lines = []
+    for i in range(20):
+        lines.append("%.2f,%s,%s,%i,0,%s,%i,continuous,rev%i"
+                     % (rnd.gauss(100, 2), test, machine, data.last_date + build * 60 + i,
+                        branch, 30000000000000 + build, build))
+    return "/bulk", "\n".join(lines) + "\n"
+
+REQUESTS = {'api': apiRequest,
+            'getdata': getdataRequest,
+            'collect': collectRequest,
+            'bulk': bulkRequest,
+            }
+
+
+def makeRequest(path, body):
+    """Returns a webob request for path, POSTing body as an uploaded file
+    as collect and bulk expect"""
+    if body is None:
+        req = Request.blank(path)
+    else:
+        req = Request.blank(path, POST={'filename': ('data.txt', body)})
+    req.headers['Accept-Encoding'] = 'gzip'
+    return req
+
+
+def percentile(values, p):
+    """The nearest-rank pth percentile of the sorted values"""
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class Stats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.queries = []
+        self.db_time = []
+        self.rows = []
+        self.slowest = {}
+
+    def request(self, latency, status):
+        self._lock.acquire()
+        try:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if not isinstance(status, int) or status >= 400:
+                self.errors += 1
+        finally:
+            self._lock.release()
+
+    def ranQueries(self, stats):
+        """Records a request's graphsdb.QueryStats"""
+        self._lock.acquire()
+        try:
+            self.queries.append(stats.queries)
+            self.db_time.append(stats.time)
+            self.rows.append(stats.rows)
+            for elapsed, statement in stats.slowest():
+                self.slowest[statement] = max(elapsed, self.slowest.get(statement, 0))
+        finally:
+            self._lock.release()
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        result = {'requests': len(latencies),
+                  'errors': self.errors,
+                  'statuses': dict((str(k), v) for k, v in self.statuses.items()),
+                  'elapsed': elapsed,
+                  'throughput': elapsed and len(latencies) / elapsed or None,
+                  }
+        for p in (50, 95, 99):
+            result['p%i_ms' % p] = latencies and percentile(latencies, p) * 1000
+        if self.queries:
+            n = float(len(self.queries))
+            result['queries'] = sum(self.queries) / n
+            result['max_queries'] = max(self.queries)
+            result['db_ms'] = sum(self.db_time) / n * 1000
+            result['rows'] = sum(self.rows) / n
+        else:
+            result['queries'] = result['max_queries'] = result['db_ms'] = result['rows'] = None
+        slowest = sorted(self.slowest.items(), key=lambda item: -item[1])[:5]
+        result['slowest'] = [{'statement': statement, 'ms': elapsed * 1000}
+                             for statement, elapsed in slowest]
+        return result
+
+
+class Harness(object):
+    """Serves the endpoints' apps, in-process and over HTTP, and runs
+    phases of requests against them"""
+
+    def __init__(self, apps, queries):
+        self.apps = apps
+        self.stats = None
+        self.server = None
+        queries.listeners.append(self.ranQueries)
+
+    def ranQueries(self, stats):
+        if self.stats is not None:
+            self.stats.ranQueries(stats)
+
+    def app(self, environ, start_response):
+        name = environ.get('PATH_INFO', '').strip('/').split('/')[0]
+        if name not in self.apps:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ["No endpoint %s\n" % name]
+        return self.apps[name](environ, start_response)
+
+    def startServer(self):
+        self.server = make_server('127.0.0.1', 0, self.app, ThreadingWSGIServer, QuietHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stopServer(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def send(self, mode, path, body):
+        """Makes one request, returning its status"""
+        req = makeRequest(path, body)
+        if mode == 'inprocess':
+            resp = req.get_response(self.app)
+            resp.body
+            return resp.status_int
+        conn = httplib.HTTPConnection(*self.server.server_address)
+        try:
+            conn.request(req.method, req.path_qs, req.body, dict(req.headers))
+            resp = conn.getresponse()
+            resp.read()
+            return resp.status
+        finally:
+            conn.close()
+
+    def run(self, endpoint, mode, data, requests=200, concurrency=4, warmup=5, seed=1):
+        make = REQUESTS[endpoint]
+        rnd = random.Random(seed)
+        for i in range(warmup):
+            self.send(mode, *make(data, rnd))
+
+        self.stats = stats = Stats()
+        remaining = [requests]
+        lock = threading.Lock()
+
+        def client(rnd):
+            while 1:
+                lock.acquire()
+                try:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                finally:
+                    lock.release()
+                path, body = make(data, rnd)
+                start = time.time()
+                try:
+                    status = self.send(mode, path, body)
+                except Exception, e:
+                    status = e.__class__.__name__
+                stats.request(time.time() - start, status)
+
+        threads = [threading.Thread(target=client, args=(random.Random(seed * 1000 + i),))
+                   for i in range(concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        self.stats = None
+        result = stats.summary(elapsed)
+        result.update({'endpoint': endpoint, 'mode': mode, 'concurrency': concurrency})
+        return result
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def printResults(results, out=sys.stdout):
+    def ms(value):
+        if value is None:
+            return "-"
+        return "%.1f" % value
+    print >>out, "%-8s %-9s %6s %6s %8s %8s %8s %8s %8s %8s %8s" % (
+        "endpoint", "mode", "reqs", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms",
+        "queries", "db ms", "rows")
+    for r in results:
+        print >>out, "%-8s %-9s %6i %6i %8s %8s %8s %8s %8s %8s %8s" % (
+            r['endpoint'], r['mode'], r['requests'], r['errors'], ms(r['throughput']),
+            ms(r['p50_ms']), ms(r['p95_ms']), ms(r['p99_ms']), ms(r['queries']),
+            ms(r['db_ms']), ms(r['rows']))
+        if r['errors']:
+            print >>out, "    statuses: %s" % ", ".join(
+                "%s: %i" % item for item in sorted(r['statuses'].items()))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--db", dest="db", default="sqlite",
+                      help="sqlite (default) or mysql, configured as for the server")
+    parser.add_option("--sqlite-db", dest="sqlite_db",
+                      help="SQLite database to use, seeded if it doesn't exist "
+                           "(default: a temporary one)")
+    parser.add_option("--seed", dest="seed", action="store_true",
+                      help="seed the database first (always done for a new SQLite one)")
+    parser.add_option("--scale", dest="scale", type="int", default=1,
+                      help="how much data to seed, in multiples of %i runs"
+                           % (40 * len(BRANCHES) * len(TESTS) * len(OSES)))
+    parser.add_option("-e", "--endpoints", dest="endpoints", default=",".join(ENDPOINTS),
+                      help="endpoints to load, of %s" % ", ".join(ENDPOINTS))
+    parser.add_option("-m", "--modes", dest="modes", default=",".join(MODES),
+                      help="inprocess and/or http (default both)")
+    parser.add_option("-n", "--requests", dest="requests", type="int", default=200,
+                      help="requests per endpoint and mode")
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int", default=4,
+                      help="concurrent clients")
+    parser.add_option("--warmup", dest="warmup", type="int", default=5,
+                      help="requests to make before measuring")
+    parser.add_option("--random-seed", dest="random_seed", type="int", default=1)
+    parser.add_option("--json", dest="json", help="also write the results to this file")
+    options, args = parser.parse_args()
+
+    endpoints = [e.strip() for e in options.endpoints.split(",") if e.strip()]
+    modes = [m.strip() for m in options.modes.split(",") if m.strip()]
+    for e in endpoints:
+        if e not in ENDPOINTS:
+            parser.error("Unknown endpoint %s" % e)
+    for m in modes:
+        if m not in MODES:
+            parser.error("Unknown mode %s" % m)
+    if options.db not in ('sqlite', 'mysql'):
+        parser.error("--db must be sqlite or mysql")
+
+    tmpdir = None
+    do_seed = options.seed
+    if options.db == 'sqlite':
+        filename = options.sqlite_db
+        if filename is None:
+            tmpdir = tempfile.mkdtemp()
+            filename = os.path.join(tmpdir, 'graphs.sqlite')
+        if not os.path.exists(filename):
+            do_seed = True
+        # graphsdb reads these as it's imported
+        os.environ['CONFIG_DB_BACKEND'] = 'sqlite'
+        os.environ['CONFIG_SQLITE_DB'] = filename
+
+    import graphsdb
+    from api_cgi import application as api_app
+    from getdata_cgi import application as getdata_app
+    from collect_cgi import application as collect_app
+    from bulk_cgi import application as bulk_app
+
+    conn = graphsdb.MySQLdb.connect(**graphsdb.kw)
+    if do_seed:
+        start = time.time()
+        if options.db == 'sqlite':
+            # Readers needn't wait for writers
+            conn._conn.execute("PRAGMA journal_mode=WAL")
+        createSchema(graphsdb.MySQLdb, conn)
+        counts = seed(conn, options.scale, rnd=random.Random(options.random_seed))
+        print "Seeded %(runs)i runs (%(values)i values) and %(datasets)i datasets" % counts,
+        print "(%(points)i points)" % counts, "in %.1fs" % (time.time() - start)
+    data = Dataset(conn)
+    conn.close()
+
+    harness = Harness({'api': api_app, 'getdata': getdata_app,
+                       'collect': collect_app, 'bulk': bulk_app},
+                      graphsdb.queries)
+    if 'http' in modes:
+        harness.startServer()
+    results = []
+    # The handlers print progress, some to a stdout they held on to
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        for endpoint in endpoints:
+            for mode in modes:
+                results.append(harness.run(endpoint, mode, data, options.requests,
+                                           options.concurrency, options.warmup,
+                                           options.random_seed))
+    finally:
+        sys.stdout.flush()
+        os.dup2(stdout, 1)
+        os.close(devnull)
+        os.close(stdout)
+        harness.stopServer()
+
+    printResults(results)
+    if options.json:
+        f = open(options.json, 'w')
+        json.dump({'time': int(time.time()), 'db': options.db, 'scale': options.scale,
+                   'results': results}, f, indent=1, sort_keys=True)
+        f.close()
+
+    if tmpdir:
+        os.remove(filename)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+        os.rmdir(tmpdir)
+    if [r for r in results if r['errors']]:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
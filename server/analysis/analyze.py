@@ -1,6 +1,18 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+from array import array
+from collections import deque
+from operator import attrgetter
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How close (relative) a t value computed from running statistics has to be
+# to a threshold before it is recomputed exactly with calc_t
+T_TOLERANCE = 1e-6
+
 def analyze(data):
     n = len(data)
     if n > 1:
@@ -22,18 +34,116 @@ def analyze(data):
     return {"avg": avg, "n": n, "variance": variance}
 
 
+def median(values):
+    """Returns the median of values, or None if there aren't any"""
+    if not values:
+        return None
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
 def calc_t(w1, w2):
     if len(w1) == 0 or len(w2) == 0:
         return 0
 
-    s1 = analyze(w1)
-    s2 = analyze(w2)
+    return stats_t(analyze(w1), analyze(w2))
+
+
+def stats_t(s1, s2):
+    """calc_t for two windows already summarized by analyze()"""
+    if s1['n'] == 0 or s2['n'] == 0:
+        return 0
 
     if s1['variance'] == 0 and s2['variance'] == 0:
         return 0
 
     return (s2['avg'] - s1['avg']) / (((s1['variance'] / s1['n']) + (s2['variance'] / s2['n'])) ** 0.5)
 
+
+class RollingStats(object):
+    """Mean and variance of the last size values pushed, kept up to date
+    with Welford's method as values enter and leave the window.
+
+    Values are counted so that a window of identical values has a variance
+    of exactly 0, as it does with analyze().  The running sums are rebuilt
+    from the window every size removals to stop rounding errors building
+    up."""
+    def __init__(self, size):
+        self.size = size
+        self.values = deque()
+        self.counts = {}
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.removed = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def push(self, x):
+        values = self.values
+        values.append(x)
+        self.counts[x] = self.counts.get(x, 0) + 1
+        delta = x - self.mean
+        self.mean += delta / len(values)
+        self.m2 += delta * (x - self.mean)
+        if len(values) > self.size:
+            self.remove()
+
+    def remove(self):
+        """Drops the oldest value"""
+        values = self.values
+        x = values.popleft()
+        c = self.counts[x] - 1
+        if c:
+            self.counts[x] = c
+        else:
+            del self.counts[x]
+        if not values:
+            self.mean = self.m2 = 0.0
+            return
+        delta = x - self.mean
+        self.mean -= delta / len(values)
+        self.m2 -= delta * (x - self.mean)
+        self.removed += 1
+        if self.removed >= self.size:
+            self.rebuild()
+
+    def rebuild(self):
+        s = analyze(list(self.values))
+        self.mean = float(s['avg'])
+        self.m2 = s['variance'] * (s['n'] - 1)
+        self.removed = 0
+
+    @property
+    def exact(self):
+        """Whether stats() is exactly what analyze() would return"""
+        return len(self.counts) <= 1
+
+    def stats(self):
+        n = len(self.values)
+        if self.exact:
+            if n == 0:
+                avg = 0.0
+            else:
+                avg = self.values[0]
+            return {"avg": avg, "n": n, "variance": 0.0}
+        if self.m2 <= 0:
+            # Rounding has eaten the variance of a window that isn't flat
+            self.rebuild()
+        return {"avg": self.mean, "n": n, "variance": self.m2 / (n - 1)}
+
+    def t(self, other, threshold):
+        """Returns calc_t(self, other), computing it exactly when it is too
+        close to threshold to trust the running statistics"""
+        t = stats_t(self.stats(), other.stats())
+        if not (self.exact and other.exact) and \
+                abs(abs(t) - threshold) <= T_TOLERANCE * (abs(t) + threshold):
+            t = calc_t(list(self.values), list(other.values))
+        return t
+
 class PerfDatum(object):
     __slots__ = ('testrun_id', 'machine_id', 'timestamp', 'value', 'buildid',
             'time', 'revision', 'run_number', 'last_other', 'historical_stats',
@@ -55,6 +165,14 @@ class PerfDatum(object):
         # What revision this data is for
         self.revision = revision
 
+    def __getstate__(self):
+        # So points can be passed to and from worker processes
+        return dict((k, getattr(self, k)) for k in self.__slots__ if hasattr(self, k))
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
     def __cmp__(self, o):
         return cmp(
                 (self.time, self.timestamp),
@@ -77,6 +195,154 @@ class PerfDatum(object):
         return "Build %s on %s %s %s %s" % (self.buildid, self.timestamp, self.time, self.value, self.machine_id)
 
 
+# The order PerfDatum.__cmp__ sorts points in
+_sortKey = attrgetter('time', 'timestamp')
+
+
+class PerfSeries(object):
+    """The points of a series stored column-wise in arrays.
+
+    Revisions are kept once each and referred to by index, and buildids and
+    run numbers of -1 stand for None.  Indexing or iterating gives new
+    PerfDatums, so changes to them aren't stored back; use setTimes() to
+    change the times."""
+    def __init__(self):
+        self.testrun_ids = array('l')
+        self.machine_ids = array('l')
+        self.timestamps = array('l')
+        self.values = array('d')
+        self.buildids = array('l')
+        self.times = array('l')
+        self.run_numbers = array('h')
+        self.revision_ids = array('l')
+        self.revisions = []
+        self._revision_index = {}
+
+    @classmethod
+    def fromData(cls, data):
+        """Returns a PerfSeries holding a list of PerfDatums"""
+        series = cls()
+        for d in data:
+            series.append(d.testrun_id, d.machine_id, d.timestamp, d.value,
+                          d.buildid, d.time, d.revision, getattr(d, 'run_number', None))
+        return series
+
+    def __len__(self):
+        return len(self.testrun_ids)
+
+    def _revisionId(self, revision):
+        if revision is None:
+            return -1
+        r = self._revision_index.get(revision)
+        if r is None:
+            r = self._revision_index[revision] = len(self.revisions)
+            self.revisions.append(revision)
+        return r
+
+    def append(self, testrun_id, machine_id, timestamp, value, buildid, time,
+            revision=None, run_number=None):
+        self.testrun_ids.append(testrun_id)
+        self.machine_ids.append(machine_id)
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+        if buildid is None:
+            buildid = -1
+        self.buildids.append(buildid)
+        self.times.append(time)
+        if run_number is None:
+            run_number = -1
+        self.run_numbers.append(run_number)
+        self.revision_ids.append(self._revisionId(revision))
+
+    def __getitem__(self, i):
+        buildid = self.buildids[i]
+        if buildid == -1:
+            buildid = None
+        r = self.revision_ids[i]
+        if r == -1:
+            revision = None
+        else:
+            revision = self.revisions[r]
+        d = PerfDatum(self.testrun_ids[i], self.machine_ids[i], self.timestamps[i],
+                self.values[i], buildid, self.times[i], revision)
+        if self.run_numbers[i] != -1:
+            d.run_number = self.run_numbers[i]
+        return d
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def _columns(self):
+        return ('testrun_ids', 'machine_ids', 'timestamps', 'values',
+                'buildids', 'times', 'run_numbers', 'revision_ids')
+
+    def take(self, indexes):
+        """Returns a new PerfSeries of the points at indexes, in that order"""
+        series = PerfSeries()
+        if numpy is not None and len(indexes) and len(self):
+            idx = numpy.asarray(indexes, dtype=numpy.intp)
+            for name in self._columns():
+                column = getattr(self, name)
+                taken = numpy.frombuffer(column, dtype=column.typecode)[idx]
+                getattr(series, name).fromstring(taken.tostring())
+        else:
+            for name in self._columns():
+                column = getattr(self, name)
+                getattr(series, name).extend(column[i] for i in indexes)
+        # Only keep the revisions still referred to
+        remap = {-1: -1}
+        for r in set(series.revision_ids):
+            if r != -1:
+                remap[r] = series._revisionId(self.revisions[r])
+        series.revision_ids = array('l', [remap[r] for r in series.revision_ids])
+        return series
+
+    def order(self):
+        """Returns the indexes of the points sorted by (time, timestamp),
+        keeping points that tie in the order they were added"""
+        if numpy is not None and len(self):
+            times = numpy.frombuffer(self.times, dtype=self.times.typecode)
+            timestamps = numpy.frombuffer(self.timestamps, dtype=self.timestamps.typecode)
+            return numpy.lexsort((timestamps, times)).tolist()
+        times, timestamps = self.times, self.timestamps
+        return sorted(xrange(len(self)), key=lambda i: (times[i], timestamps[i]))
+
+    def sorted(self):
+        return self.take(self.order())
+
+    def machineIndexes(self, indexes=None):
+        """Returns {machine_id: [index, ...]} for the points at indexes (all
+        of them by default), in the order of indexes"""
+        if indexes is None:
+            indexes = xrange(len(self))
+        machines = {}
+        machine_ids = self.machine_ids
+        for i in indexes:
+            machine_id = machine_ids[i]
+            m = machines.get(machine_id)
+            if m is None:
+                m = machines[machine_id] = []
+            m.append(i)
+        return machines
+
+    def setTimes(self, times):
+        """Sets the time of each point whose revision is in times, a
+        {revision: time} dict"""
+        by_id = {}
+        for revision, t in times.iteritems():
+            r = self._revision_index.get(revision)
+            if r is not None and t:
+                by_id[r] = t
+        if not by_id:
+            return
+        revision_ids = self.revision_ids
+        for i in xrange(len(self)):
+            t = by_id.get(revision_ids[i])
+            if t is not None:
+                self.times[i] = t
+
+
 class TalosAnalyzer:
     def __init__(self):
         # List of PerfDatum instances
@@ -86,49 +352,208 @@ class TalosAnalyzer:
         # Cache of calm points
         self.zenPoints = {}
 
+        # Where in data analyze_t starts (back_window by default), the good
+        # data it starts with, and how many good points came before those
+        self.start = None
+        self.seed_good = []
+        self.good_dropped = 0
+        # The good data once analyze_t has run, and the first point it
+        # couldn't classify for lack of data after it
+        self.good_data = []
+        self.next = None
+
     def addData(self, data):
+        if isinstance(data, PerfSeries):
+            order = data.order()
+            if not self.data and not self.machine_history:
+                # The series' sorted order gives both data and the machine
+                # histories without sorting any PerfDatums
+                points = [data[i] for i in xrange(len(data))]
+                self.data = [points[i] for i in order]
+                for machine_id, idx in data.machineIndexes(order).iteritems():
+                    self.machine_history.setdefault(machine_id, []).extend(points[i] for i in idx)
+                return
+            data = [data[i] for i in order]
+
         self.data.extend(data)
         for d in data:
             self.machine_history.setdefault(d.machine_id, []).append(d)
 
-        self.data.sort()
+        self.data.sort(key=_sortKey)
         for d in self.machine_history.values():
-            d.sort()
+            d.sort(key=_sortKey)
+
+    def getState(self, j, k, machine_history_size):
+        """Returns what resume() needs to carry on from where analyze_t
+        stopped: the points it couldn't classify yet, enough of the good
+        data for the back and other-machine windows, and enough of each
+        machine's history"""
+        cut = min(self.next, len(self.data))
+        pending = self.data[cut:]
+        keep = max(j, self._otherTail(self.good_data, k*2))
+        good = self.good_data[max(0, len(self.good_data)-keep):]
+        waiting = set(id(d) for d in pending)
+        history = {}
+        for machine_id, h in self.machine_history.items():
+            h = [d for d in h if id(d) not in waiting]
+            if machine_history_size > 1 and h:
+                # A repeat of a result finds the first copy in the history,
+                # so keep the window before the first of the last results
+                # that were run at the same time
+                s = len(h) - 1
+                while s > 0 and h[s-1].time == h[-1].time and h[s-1].timestamp == h[-1].timestamp:
+                    s -= 1
+                history[machine_id] = h[max(0, s-machine_history_size+1):]
+        if cut:
+            last = self.data[cut-1]
+            last = (last.time, last.timestamp)
+        else:
+            last = None
+        return {'pending': pending,
+                # Points still to be skipped while the back window fills
+                'skip': self.next - cut,
+                'good': good,
+                'good_dropped': self.good_dropped + len(self.good_data) - len(good),
+                'history': history,
+                'last': last,
+                }
+
+    def resume(self, state, data):
+        """Sets up analyze_t to carry on from a getState() state with new
+        data.  Returns False, leaving the analyzer untouched, if any of data
+        would have been ordered before points that were already classified"""
+        data = list(data)
+        if state['last'] is not None:
+            for d in data:
+                if (d.time, d.timestamp) < state['last']:
+                    return False
+        for machine_id, h in state['history'].items():
+            self.machine_history.setdefault(machine_id, []).extend(h)
+        self.addData(state['pending'] + data)
+        self.start = state['skip']
+        self.seed_good = state['good']
+        self.good_dropped = state['good_dropped']
+        return True
+
+    def _firstUsable(self):
+        """Returns the index of the first good point the other-machine
+        windows may use; the very first good point of a series never is"""
+        if self.good_dropped:
+            return 0
+        return 1
+
+    def _otherTail(self, good_data, size):
+        """Returns how many of the last good points are needed so that every
+        machine has size points from other machines among them"""
+        first = self._firstUsable()
+        if len(good_data) <= first:
+            return 0
+        counts = {}
+        most = 0
+        l = len(good_data) - 1
+        while l >= first:
+            machine_id = good_data[l].machine_id
+            counts[machine_id] = counts.get(machine_id, 0) + 1
+            most = max(most, counts[machine_id])
+            if len(good_data) - l - most >= size:
+                break
+            l -= 1
+        return len(good_data) - max(l, first)
+
+    def historyPositions(self):
+        """Returns the position of each point of data in its machine's
+        history, as machine_history[d.machine_id].index(d) would find it"""
+        first = {}
+        for history in self.machine_history.values():
+            for pos, d in enumerate(history):
+                first.setdefault((d.timestamp, d.value, d.buildid, d.machine_id), pos)
+        return [first[(d.timestamp, d.value, d.buildid, d.machine_id)] for d in self.data]
+
+    def _machineWindow(self, windows, machine_id, pos, size):
+        """Returns the stats of the size points of a machine's history up to
+        and including pos"""
+        history = self.machine_history[machine_id]
+        end = pos + 1
+        w = windows.get(machine_id)
+        if w is None or w[1] > end or end - w[1] >= size:
+            w = windows[machine_id] = [RollingStats(size), max(0, end - size)]
+        stats = w[0]
+        for l in xrange(w[1], end):
+            stats.push(history[l].value)
+        w[1] = end
+        return stats
+
+    def _otherWindow(self, windows, good_data, machine_id, size):
+        """Returns the stats of the last size good points (other than the
+        first) from machines other than machine_id"""
+        end = len(good_data)
+        w = windows.get(machine_id)
+        first = self._firstUsable()
+        if w is None or end - w[1] > 2 * size:
+            # Quicker to look back from the end than to catch up
+            values = []
+            l = end - 1
+            while len(values) < size and l >= first:
+                dl = good_data[l]
+                if dl.machine_id != machine_id:
+                    values.append(dl.value)
+                l -= 1
+            stats = RollingStats(size)
+            for v in reversed(values):
+                stats.push(v)
+            windows[machine_id] = [stats, end]
+            return stats
+        stats = w[0]
+        for l in xrange(max(w[1], first), end):
+            dl = good_data[l]
+            if dl.machine_id != machine_id:
+                stats.push(dl.value)
+        w[1] = end
+        return stats
 
     def analyze_t(self, j, k, threshold, machine_threshold, machine_history_size):
         # Use T-Tests
         # Analyze test data using T-Tests, comparing data[i-j:i] to data[i:i+k]
-        good_data = []
-
-        for i in range(j, len(self.data)-k+1):
-            di = self.data[i]
-            jw = [d.value for d in good_data[-j:]]
-            kw = [d.value for d in self.data[i:i+k]]
-
-            my_history = self.machine_history[di.machine_id]
-            my_history_index = my_history.index(di)
-            my_data = [d.value for d in self.machine_history[di.machine_id][my_history_index-machine_history_size+1:my_history_index+1]]
-            other_data = []
-            l = len(good_data)-1
-            while len(other_data) < k*2 and l > 0:
-                dl = good_data[l]
-                if dl.machine_id != di.machine_id:
-                    other_data.insert(0, dl.value)
-                l -= 1
+        #
+        # The windows are kept as RollingStats rather than rebuilt for each
+        # point.  Points that aren't good get their stats from analyze(); the
+        # stats of good points can differ from it in the last few bits.
+        if j < 1 or k < 1:
+            raise ValueError("The back and fore windows need at least one point")
+        data = self.data
+        start = self.start
+        if start is None:
+            start = j
+        good_data = self.good_data = list(self.seed_good)
+        self.next = max(start, len(data)-k+1)
+        back = RollingStats(j)
+        for d in good_data[-j:]:
+            back.push(d.value)
+        fore = RollingStats(k)
+        for d in data[start:start+k-1]:
+            fore.push(d.value)
+        positions = self.historyPositions()
+        # machine_id -> [RollingStats, index the window ends at]
+        my_windows = {}
+        other_windows = {}
 
-            di.historical_stats = analyze(jw)
-            di.forward_stats = analyze(kw)
+        for i in range(start, len(data)-k+1):
+            di = data[i]
+            fore.push(data[i+k-1].value)
 
-            if len(jw) >= j:
-                t = calc_t(jw, kw)
+            if len(back) >= j:
+                t = back.t(fore, threshold)
             else:
                 # Assume it's ok, we don't have enough data
                 t = 0
 
-            if len(other_data) >= k*2 and len(my_data) >= machine_history_size:
-                m_t = calc_t(other_data, my_data)
-            else:
-                m_t = 0
+            m_t = 0
+            if machine_history_size > 0 and positions[i] >= machine_history_size - 1:
+                other = self._otherWindow(other_windows, good_data, di.machine_id, k*2)
+                if len(other) >= k*2:
+                    mine = self._machineWindow(my_windows, di.machine_id,
+                            positions[i], machine_history_size)
+                    m_t = other.t(mine, machine_threshold)
 
             if abs(m_t) >= machine_threshold:
                 l = len(good_data)-1
@@ -138,14 +563,22 @@ class TalosAnalyzer:
                         di.last_other = dl
                         break
                     l -= 1
+                di.historical_stats = analyze(list(back.values))
+                di.forward_stats = analyze(list(fore.values))
                 # We think this machine is bad, so don't add its data to the
                 # set of good data
                 yield di, "machine"
             elif abs(t) <= threshold:
+                di.historical_stats = back.stats()
+                di.forward_stats = fore.stats()
                 good_data.append(di)
+                back.push(di.value)
                 yield di, "good"
             else:
+                di.historical_stats = analyze(list(back.values))
+                di.forward_stats = analyze(list(fore.values))
                 # By including the data point as part of the "good" data, we slowly
                 # adjust to the new baseline.
                 good_data.append(di)
+                back.push(di.value)
                 yield di, "regression"
@@ -1,35 +1,28 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+
 import sqlalchemy as sa
 from sqlalchemy.ext.sqlsoup import SqlSoup
 
-from analyze import PerfDatum
+from analyze import PerfSeries
+from datasource import DataSource, TestSeries
 
 import logging as log
 
-class TestSeries:
-    def __init__(self, branch_id, branch_name, os_id, os_name, test_id, test_name, test_shortname):
-        self.branch_id = branch_id
-        self.branch_name = branch_name
-        self.os_id = os_id
-        self.os_name = os_name
-        self.test_id = test_id
-        self.test_name = test_name
-        self.test_shortname = test_shortname
-
-    def __eq__(self, o):
-        return (self.branch_id, self.os_id, self.test_id) == (o.branch_id, o.os_id, o.test_id)
-
-    def __hash__(self):
-        return hash((self.branch_id, self.os_id, self.test_id))
-
-    def __str__(self):
-        return "%s %s %s" % (self.branch_name, self.os_name, self.test_shortname)
-
 db = None
 goodNameClause = None
 
+# {(test_id, branch_id, os_id): PerfSeries} loaded by prefetchTestData, and
+# the date_run and test run id they were loaded from
+_prefetched = {}
+_prefetch_start = None
+_prefetch_after = None
+
+# How many rows to fetch at a time from a streamed result
+FETCH_SIZE = 1000
+
 
 def connect(url):
     global db
@@ -39,13 +32,23 @@ def connect(url):
     goodNameClause = db.machines.is_active == 1
 
 
-def getTestData(series, start_time):
-    q = sa.select(
-        [db.test_runs.id, db.test_runs.machine_id, db.builds.ref_build_id,
-            db.test_runs.date_run, db.test_runs.average,
-            db.builds.ref_changeset, db.test_runs.run_number,
-            db.builds.branch_id],
-        sa.and_(
+def addRun(runs, row):
+    runs.append(row.id, row.machine_id, row.date_run, row.average,
+                row.ref_build_id, row.date_run, row.ref_changeset, row.run_number)
+
+def getTestData(series, start_time, after_id=None):
+    """Returns the runs of series after start_time as a PerfSeries; with
+    after_id, only the runs with a greater id"""
+    runs = _prefetched.get((series.test_id, series.branch_id, series.os_id))
+    if (runs is not None and _prefetch_start <= start_time and
+        (_prefetch_after is None or (after_id is not None and _prefetch_after <= after_id))):
+        if after_id is None:
+            after_id = -1
+        dates, ids = runs.timestamps, runs.testrun_ids
+        return runs.take([i for i in xrange(len(runs))
+                          if dates[i] > start_time and ids[i] > after_id])
+
+    clauses = [
         db.test_runs.test_id == series.test_id,
         db.builds.branch_id == series.branch_id,
         db.machines.os_id == series.os_id,
@@ -54,18 +57,90 @@ def getTestData(series, start_time):
         db.test_runs.date_run > start_time,
         goodNameClause,
         sa.not_(db.machines.name.like("%stage%")),
-        ))
+        ]
+    if after_id is not None:
+        clauses.append(db.test_runs.id > after_id)
+    q = sa.select(
+        [db.test_runs.id, db.test_runs.machine_id, db.builds.ref_build_id,
+            db.test_runs.date_run, db.test_runs.average,
+            db.builds.ref_changeset, db.test_runs.run_number,
+            db.builds.branch_id],
+        sa.and_(*clauses))
 
-    data = []
-    for row in q.execute():
+    data = PerfSeries()
+    for row in iterRows(q):
         if row.average is None:
             continue
-        t = row.date_run
-        d = PerfDatum(row.id, row.machine_id, row.date_run, row.average, row.ref_build_id, t, row.ref_changeset)
-        d.run_number = row.run_number
-        data.append(d)
+        addRun(data, row)
     return data
 
+def prefetchTestData(series, start_time, partitions=1, after_id=None):
+    """Loads the runs since start_time (and, with after_id, with a greater
+    id) of all of series at once, so that getTestData doesn't need a query
+    per series.
+
+    The runs are read in partitions streaming queries, each covering an
+    equal range of date_run.  Returns how many runs were loaded."""
+    global _prefetched, _prefetch_start, _prefetch_after
+    runs = {}
+    for s in series:
+        runs[(s.test_id, s.branch_id, s.os_id)] = PerfSeries()
+    if not runs:
+        _prefetched, _prefetch_start, _prefetch_after = runs, start_time, after_id
+        return 0
+    test_ids = set(key[0] for key in runs)
+    branch_ids = set(key[1] for key in runs)
+
+    now = time.time()
+    step = (now - start_time) / partitions
+    bounds = [start_time + step * i for i in range(partitions)] + [None]
+    count = 0
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        clauses = [
+            db.test_runs.test_id.in_(test_ids),
+            db.builds.branch_id.in_(branch_ids),
+            db.test_runs.machine_id == db.machines.id,
+            db.test_runs.build_id == db.builds.id,
+            db.test_runs.date_run > lo,
+            goodNameClause,
+            sa.not_(db.machines.name.like("%stage%")),
+            ]
+        if hi is not None:
+            clauses.append(db.test_runs.date_run <= hi)
+        if after_id is not None:
+            clauses.append(db.test_runs.id > after_id)
+        q = sa.select(
+            [db.test_runs.test_id, db.builds.branch_id, db.machines.os_id,
+                db.test_runs.id, db.test_runs.machine_id, db.builds.ref_build_id,
+                db.test_runs.date_run, db.test_runs.average,
+                db.builds.ref_changeset, db.test_runs.run_number],
+            sa.and_(*clauses))
+        t = time.time()
+        for row in iterRows(q):
+            if row.average is None:
+                continue
+            r = runs.get((row.test_id, row.branch_id, row.os_id))
+            if r is not None:
+                addRun(r, row)
+                count += 1
+        log.debug("%.2f to prefetch runs after %s", time.time() - t, lo)
+
+    _prefetched, _prefetch_start, _prefetch_after = runs, start_time, after_id
+    return count
+
+def iterRows(q, size=FETCH_SIZE):
+    """Executes q with a server-side cursor, yielding rows size at a time"""
+    result = q.execution_options(stream_results=True).execute()
+    try:
+        while True:
+            rows = result.fetchmany(size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
 def getTestSeries(branches, start_date, test_names, last_run=None):
     # Find all the Branch/OS/Test combinations
     if len(test_names) > 0:
@@ -98,9 +173,52 @@ def getTestSeries(branches, start_date, test_names, last_run=None):
     return retval
 
 
+# {machine_id: name} and {(os_id, branch_id, test_id): [machine_id, ...]},
+# filled in by preloadMachines or as machines are looked up.  Workers forked
+# after the preload share it.
+_name_cache = {}
 _machines_cache = {}
 
 
+def preloadMachines(series=()):
+    """Loads the names of all the machines, and which machines have run each
+    of series, with a query for each rather than one per machine and series"""
+    global _name_cache, _machines_cache
+    names = {}
+    q = sa.select([db.machines.id, db.machines.name])
+    for row in iterRows(q):
+        names[row.id] = row.name
+    _name_cache = names
+
+    if not series:
+        return
+    keys = set((s.os_id, s.branch_id, s.test_id) for s in series)
+    machines = dict((key, []) for key in keys)
+    q = sa.select(
+        [db.machines.os_id, db.builds.branch_id, db.test_runs.test_id, db.machines.id],
+        sa.and_(
+            db.test_runs.machine_id == db.machines.id,
+            db.builds.id == db.test_runs.build_id,
+            db.builds.branch_id.in_(set(key[1] for key in keys)),
+            db.test_runs.test_id.in_(set(key[2] for key in keys)),
+            goodNameClause,
+            sa.not_(db.machines.name.like('%stage%')),
+            )).distinct()
+    for row in iterRows(q):
+        m = machines.get((row.os_id, row.branch_id, row.test_id))
+        if m is not None:
+            m.append(row.id)
+    _machines_cache.update(machines)
+
+
+def refreshMachines():
+    """Forgets the machines that have been loaded, so that they're looked up
+    again"""
+    global _name_cache, _machines_cache
+    _name_cache = {}
+    _machines_cache = {}
+
+
 def getMachinesForTest(series):
     key = (series.os_id, series.branch_id, series.test_id)
     if key in _machines_cache:
@@ -122,14 +240,12 @@ def getMachinesForTest(series):
     return _machines_cache[key]
 
 
-_name_cache = {}
-
-
 def getMachineName(machine_id):
     if machine_id in _name_cache:
         return _name_cache[machine_id]
 
-    m = db.machines.filter_by(id=machine_id).one()
+    # A machine added since the preload
+    m = db.machines.filter_by(id=machine_id).first()
     if m:
         _name_cache[machine_id] = m.name
         return m.name
@@ -137,6 +253,32 @@ def getMachineName(machine_id):
         _name_cache[machine_id] = None
         return None
 
+class DBSource(DataSource):
+    """The functions above as a DataSource"""
+    def __init__(self, url):
+        self.url = url
+
+    def connect(self):
+        connect(self.url)
+
+    def getTestSeries(self, branches, start_time, test_names, last_run=None):
+        return getTestSeries(branches, start_time, test_names, last_run)
+
+    def getTestData(self, series, start_time, after_id=None):
+        return getTestData(series, start_time, after_id)
+
+    def prefetchTestData(self, series, start_time, partitions=1, after_id=None):
+        return prefetchTestData(series, start_time, partitions, after_id)
+
+    def preloadMachines(self, series=()):
+        preloadMachines(series)
+
+    def getMachinesForTest(self, series):
+        return getMachinesForTest(series)
+
+    def getMachineName(self, machine_id):
+        return getMachineName(machine_id)
+
 def getInactiveMachines(statusdb_url, initial_time, start_time, end_time):
     """Returns a list of slave machines that have been active between
     initial_time and end_time, but haven't been active between start_time and
@@ -1,42 +1,59 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Test data from a graph server's web API.
+
+Requests go through an httpfetch.Fetcher, so they're made a few at a time
+over kept-alive connections and retried when they fail, and each series'
+runs are only fetched once a run.  A series' runs are fetched as a columnar
+export when export_url is given, or else with one /test/runs request for all
+of its machines; servers that can't do either get a request per machine."""
+import os
+import sys
+import math
+import time
 import logging as log
 try:
     import simplejson as json
 except ImportError:
     import json
 
-import urllib
-from analyze import PerfDatum
+from analyze import PerfSeries
+from datasource import DataSource, TestSeries
+from httpfetch import Fetcher, FetchError
 
-
-class TestSeries:
-    def __init__(self, branch_id, branch_name, os_id, os_name, test_id, test_name):
-        self.branch_id = branch_id
-        self.branch_name = branch_name
-        self.os_id = os_id
-        self.os_name = os_name
-        self.test_id = test_id
-        self.test_name = test_name
-
-    def __eq__(self, o):
-        return (self.branch_id, self.os_id, self.test_id) == (o.branch_id, o.os_id, o.test_id)
-
-    def __hash__(self):
-        return hash((self.branch_id, self.os_id, self.test_id))
-
-
-class GraphAPISource:
-    def __init__(self, baseurl):
-        self.baseurl = baseurl
-
-    def getTestSeries(self, branches, start_date, test_names):
+try:
+    import columnar
+except ImportError:
+    # It lives with the server code
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    import columnar
+
+
+class GraphAPISource(DataSource):
+    def __init__(self, baseurl, export_url=None, fetcher=None):
+        self.baseurl = baseurl.rstrip("/")
+        self.export_url = export_url
+        if fetcher is None:
+            fetcher = Fetcher()
+        self.fetcher = fetcher
+        self.machines_by_branch = {}
+        self.machine_names = {}
+        # {series: (start_time, [(testrun_id, machine_id, date_run, average,
+        # ref_build_id, revision, run_number), ...])} fetched this run
+        self.runs = {}
+        # Whether /test/runs can be asked for all of a series' machines at once
+        self.batch = True
+
+    def clearCache(self):
+        """Forgets the runs fetched so far, so that they're fetched again"""
+        self.runs = {}
+
+    def getTestSeries(self, branches, start_date, test_names, last_run=None):
         url = "%s/%s" % (self.baseurl, "test")
         try:
             log.debug("Getting %s", url)
-            req = urllib.urlopen(url)
-            tests = json.load(req)
+            tests = json.loads(self.fetcher.fetch(url))
         except KeyboardInterrupt:
             raise
         except:
@@ -47,13 +64,14 @@ class GraphAPISource:
             log.warn("Test status not ok: %s", tests['stat'])
             return []
 
+        branches = set(branches)
+        test_names = set(test_names)
         retval = []
         machines_by_branch = {}
         machine_names = {}
         for test in tests['tests']:
             machine_info = test['machine']
             machine_id = machine_info['id']
-            machine_name = machine_info['name']
             os_info = test['os']
             os_id = os_info['id']
             branch_info = test['branch']
@@ -77,64 +95,160 @@ class GraphAPISource:
 
             series = TestSeries(branch_id, branch_info['name'],
                            os_id, os_info['name'],
-                           test_id, test_name)
-            if series not in retval:
+                           test_id, test_name, test_name)
+            machines = machines_by_branch.get(series)
+            if machines is None:
+                machines = machines_by_branch[series] = set()
                 retval.append(series)
-
-            if series not in machines_by_branch:
-                machines_by_branch[series] = []
-            if machine_id not in machines_by_branch[series]:
-                machines_by_branch[series].append(machine_id)
-            if machine_id not in machine_names:
-                machine_names[machine_id] = machine_info['name']
+            machines.add(machine_id)
+            machine_names[machine_id] = machine_info['name']
         self.machines_by_branch = machines_by_branch
         self.machine_names = machine_names
         return retval
 
-    def getTestData(self, series, start_time):
+    def _urls(self, method, series, start_time):
+        """Returns [(url, machine_id), ...] to fetch series' runs from;
+        machine_id is None when the response covers every machine"""
         base = self.baseurl
-        retval = []
-        seen = {}
-        for machine_id in self.machines_by_branch[series]:
-            test_id = series.test_id
-            branch_id = series.branch_id
-            machine_id = machine_id
-            url = "%(base)s/test/runs?id=%(test_id)s&branchid=%(branch_id)s&machineid=%(machine_id)s" % locals()
-            try:
-                log.debug("Getting %s", url)
-                req = urllib.urlopen(url)
-                results = json.load(req)
-            except KeyboardInterrupt:
-                raise
-            except:
-                log.exception("Couldn't load or parse %s", url)
-                continue
-
-            if 'test_runs' not in results:
-                log.debug("No data from %s", url)
-                continue
-
-            for item in results['test_runs']:
-                testrunid, build, date, average, run_number, annotations = item
-                if average is None:
+        test_id = series.test_id
+        branch_id = series.branch_id
+        os_id = series.os_id
+        if method == 'export':
+            export_url = self.export_url
+            since = int(start_time)
+            return [("%(export_url)s?id=%(test_id)s&branchid=%(branch_id)s&platformid=%(os_id)s&since=%(since)s" % locals(), None)]
+        # /test/runs goes back a number of days
+        days = int(math.ceil((time.time() - start_time) / (24*3600.0))) + 1
+        if method == 'batch':
+            return [("%(base)s/test/runs?id=%(test_id)s&branchid=%(branch_id)s&platformid=%(os_id)s&days=%(days)s" % locals(), None)]
+        urls = []
+        for machine_id in sorted(self.machines_by_branch.get(series, ())):
+            urls.append(("%(base)s/test/runs?id=%(test_id)s&branchid=%(branch_id)s&machineid=%(machine_id)s&days=%(days)s" % locals(), machine_id))
+        return urls
+
+    def _parse(self, method, body, machine_id):
+        if method == 'export':
+            columns, meta = columnar.readColumns(body)
+            values = columns['value']
+            rows = []
+            for i in xrange(len(values)):
+                # Missing averages are stored as NaN
+                if values[i] != values[i]:
                     continue
-                d = PerfDatum(machine_id, date, average, build[1], date, build[2])
-                d.run_number = run_number
-                retval.append(d)
-                t = (d.buildid, date, average, machine_id)
-                #if t in seen:
-                    #if seen[t].run_number == run_number:
-                        #continue
-                    #log.error("%s %s %s", seen[t], seen[t].machine_id, seen[t].run_number)
-                    #log.error("%s %s %s", d, d.machine_id, d.run_number)
-                    #log.error(url)
-                #else:
-                    #seen[t] = d
-
-        return retval
+                rows.append((columns['id'][i], columns['machine_id'][i],
+                             columns['date_run'][i], values[i],
+                             columns['ref_build_id'][i] or None,
+                             columns['revision'][i] or None,
+                             columns['run_number'][i]))
+            return rows
+
+        results = json.loads(body)
+        rows = []
+        for item in results.get('test_runs', ()):
+            testrunid, build, date, average, run_number, annotations = item[:6]
+            if average is None:
+                continue
+            # Runs for every machine say which machine they're from
+            if len(item) > 6:
+                machine_id = item[6]
+            rows.append((testrunid, machine_id, date, average, build[1], build[2], run_number))
+        return rows
+
+    def _noRuns(self, method, error):
+        """Returns whether error is /test/runs saying there are no runs,
+        which it does with a 404"""
+        if method == 'export' or not isinstance(error, FetchError) or error.status != 404:
+            return False
+        try:
+            result = json.loads(error.body)
+        except ValueError:
+            return False
+        return result.get('stat') == 'fail' and str(result.get('code')) == '102'
+
+    def _load(self, series, start_time):
+        """Fetches the runs since start_time of any of series that haven't
+        been fetched yet"""
+        todo = []
+        for s in series:
+            cached = self.runs.get(s)
+            if cached is None or cached[0] > start_time:
+                todo.append(s)
+        if not todo:
+            return 0
+
+        methods = []
+        if self.export_url:
+            methods.append('export')
+        if self.batch:
+            methods.append('batch')
+        methods.append('machine')
+
+        runs = {}
+        for method in methods:
+            if not todo:
+                break
+            requests = {}
+            for s in todo:
+                runs[s] = []
+                for url, machine_id in self._urls(method, s, start_time):
+                    requests[url] = (s, machine_id)
+            bodies = self.fetcher.fetchAll(requests.keys())
+
+            failed = set()
+            rejected = False
+            for url, (s, machine_id) in requests.items():
+                body = bodies[url]
+                try:
+                    if self._noRuns(method, body):
+                        continue
+                    if isinstance(body, Exception):
+                        if isinstance(body, FetchError) and body.status == 400:
+                            rejected = True
+                        raise body
+                    runs[s].extend(self._parse(method, body, machine_id))
+                except KeyboardInterrupt:
+                    raise
+                except Exception, e:
+                    if method == 'machine':
+                        log.error("Couldn't load or parse %s: %s", url, e)
+                    else:
+                        log.debug("Couldn't load or parse %s: %s", url, e)
+                        failed.add(s)
+            # Servers that can't do it reject the platformid-only query;
+            # other failures just fall back for the series they hit
+            if method == 'batch' and rejected:
+                log.info("%s can't return all of a series' machines at once, "
+                         "fetching them one at a time", self.baseurl)
+                self.batch = False
+            todo = [s for s in todo if s in failed]
+
+        count = 0
+        for s, rows in runs.items():
+            self.runs[s] = (start_time, rows)
+            count += len(rows)
+        return count
+
+    def prefetchTestData(self, series, start_time, partitions=1, after_id=None):
+        """Fetches the runs of all of series at once, so that getTestData
+        doesn't need to wait for each one.  Returns how many runs were
+        fetched"""
+        return self._load(series, start_time)
+
+    def getTestData(self, series, start_time, after_id=None):
+        """Returns the runs of series after start_time as a PerfSeries; with
+        after_id, only the runs with a greater id"""
+        self._load([series], start_time)
+        if after_id is None:
+            after_id = -1
+        data = PerfSeries()
+        for testrun_id, machine_id, date, average, buildid, revision, run_number in self.runs[series][1]:
+            if date > start_time and testrun_id > after_id:
+                data.append(testrun_id, machine_id, date, average, buildid, date,
+                            revision, run_number)
+        return data
 
     def getMachinesForTest(self, series):
-        return self.machines_by_branch[series]
+        return sorted(self.machines_by_branch[series])
 
     def getMachineName(self, machine_id):
         return self.machine_names[machine_id]
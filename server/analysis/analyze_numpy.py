@@ -0,0 +1,230 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""A NumPy version of TalosAnalyzer.analyze_t.
+
+The fore windows and the per-machine history windows don't depend on how
+earlier points were classified, so their statistics are computed for the
+whole series at once.  The back window and the other-machine windows are
+made of good data, which only changes when a point is blamed on its
+machine; they are computed a chunk of points at a time on the assumption
+that none of the chunk will be, and the chunk is walked in order to check
+that.  When a point is blamed on its machine the rest of the chunk is thrown
+away and the next chunk starts after it."""
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+from analyze import analyze, calc_t, T_TOLERANCE, TalosAnalyzer
+
+# Bounds on how many points are evaluated at once
+MIN_CHUNK = 16
+MAX_CHUNK = 1024
+
+
+def window_stats(values, ends, size):
+    """Returns (avg, variance, flat) arrays for the windows
+    values[end-size:end] for each end in ends.
+
+    The sums come from a cumulative sum.  Variances are taken about those
+    means over a strided view of the windows, since a cumulative sum of
+    squares loses too much precision to reproduce analyze()."""
+    ends = numpy.asarray(ends, dtype=numpy.intp)
+    if not len(ends):
+        empty = numpy.zeros(0)
+        return empty, empty, numpy.zeros(0, dtype=bool)
+    sums = numpy.concatenate(([0.0], numpy.cumsum(values)))
+    avg = (sums[ends] - sums[ends - size]) / size
+    stride = values.strides[0]
+    windows = as_strided(values, shape=(len(values) - size + 1, size),
+                         strides=(stride, stride))[ends - size]
+    flat = (windows == windows[:, :1]).all(axis=1)
+    avg[flat] = windows[flat, 0]
+    if size > 1:
+        variance = ((windows - avg[:, None]) ** 2).sum(axis=1) / (size - 1)
+    else:
+        variance = numpy.zeros(len(ends))
+    variance[flat] = 0.0
+    return avg, variance, flat
+
+
+def t_values(s1, s2):
+    """stats_t over arrays of full windows; s1 and s2 are (avg, variance,
+    flat, n) tuples"""
+    avg1, var1, flat1, n1 = s1
+    avg2, var2, flat2, n2 = s2
+    both_flat = flat1 & flat2
+    denom = numpy.sqrt(var1 / n1 + var2 / n2)
+    denom[both_flat] = 1.0
+    t = (avg2 - avg1) / denom
+    t[both_flat] = 0.0
+    return t, both_flat
+
+
+def near(t, threshold):
+    return numpy.abs(numpy.abs(t) - threshold) <= T_TOLERANCE * (numpy.abs(t) + threshold)
+
+
+def as_stats(avg, n, variance):
+    return {"avg": avg, "n": n, "variance": variance}
+
+
+class NumpyTalosAnalyzer(TalosAnalyzer):
+    def _machineStats(self, positions, size):
+        """Returns (avg, variance, flat, valid) arrays giving the stats of
+        each point's machine history window"""
+        n = len(self.data)
+        avg = numpy.zeros(n)
+        variance = numpy.zeros(n)
+        flat = numpy.zeros(n, dtype=bool)
+        valid = numpy.zeros(n, dtype=bool)
+        if size <= 0:
+            return avg, variance, flat, valid
+        points = {}
+        for i, d in enumerate(self.data):
+            points.setdefault(d.machine_id, []).append(i)
+        for machine_id, idx in points.iteritems():
+            history = numpy.array([d.value for d in self.machine_history[machine_id]], dtype=float)
+            idx = numpy.array(idx, dtype=numpy.intp)
+            pos = positions[idx]
+            ok = pos >= size - 1
+            idx, pos = idx[ok], pos[ok]
+            avg[idx], variance[idx], flat[idx] = window_stats(history, pos + 1, size)
+            valid[idx] = True
+        return avg, variance, flat, valid
+
+    def analyze_t(self, j, k, threshold, machine_threshold, machine_history_size):
+        if j < 1 or k < 1:
+            raise ValueError("The back and fore windows need at least one point")
+        data = self.data
+        n = len(data)
+        end = n - k + 1
+        start = self.start
+        if start is None:
+            start = j
+        good_data = self.good_data = list(self.seed_good)
+        good_values = [d.value for d in good_data]
+        self.next = max(start, end)
+        if end <= start:
+            return
+        values = numpy.array([d.value for d in data], dtype=float)
+        machines = numpy.array([d.machine_id for d in data])
+        positions = numpy.array(self.historyPositions(), dtype=numpy.intp)
+
+        fore_avg, fore_var, fore_flat = window_stats(values, numpy.arange(start, end) + k, k)
+        fore = (numpy.concatenate((numpy.zeros(start), fore_avg)),
+                numpy.concatenate((numpy.zeros(start), fore_var)),
+                numpy.concatenate((numpy.zeros(start, dtype=bool), fore_flat)),
+                k)
+        my_avg, my_var, my_flat, my_valid = self._machineStats(positions, machine_history_size)
+        fore_list = [fore[0].tolist(), fore[1].tolist()]
+
+        other_size = k*2
+        i = start
+        chunk = MIN_CHUNK
+        while i < end:
+            stop = min(end, i + chunk)
+            idx = numpy.arange(i, stop)
+
+            # Back windows, assuming everything from i on is good
+            tail = numpy.array(good_values[-j:], dtype=float)
+            seq = numpy.concatenate((tail, values[i:stop]))
+            have = len(good_data) + idx - i
+            full = have >= j
+            back_ends = (len(tail) + idx - i)[full]
+            back_avg, back_var, back_flat = window_stats(seq, back_ends, j)
+            f = idx[full]
+            t = numpy.zeros(len(idx))
+            check_t = numpy.zeros(len(idx), dtype=bool)
+            t[full], both_flat = t_values((back_avg, back_var, back_flat, j),
+                                          (fore[0][f], fore[1][f], fore[2][f], k))
+            check_t[full] = near(t[full], threshold) & ~both_flat
+
+            # Other machines' windows, under the same assumption
+            m_t = numpy.zeros(len(idx))
+            check_m = numpy.zeros(len(idx), dtype=bool)
+            other_windows = {}
+            if machine_history_size > 0:
+                count = self._otherTail(good_data, other_size)
+                tail = good_data[len(good_data) - count:]
+                seq = numpy.concatenate((numpy.array([d.value for d in tail], dtype=float),
+                                         values[i:stop]))
+                seq_machines = numpy.concatenate((numpy.array([d.machine_id for d in tail]),
+                                                  machines[i:stop]))
+                for machine_id in numpy.unique(machines[i:stop]):
+                    mine = numpy.flatnonzero((machines[i:stop] == machine_id) & my_valid[i:stop])
+                    if not len(mine):
+                        continue
+                    other = seq_machines != machine_id
+                    if not good_data and not self.good_dropped:
+                        # The first good point is never compared against
+                        other[0] = False
+                    others = seq[other]
+                    before = numpy.concatenate(([0], numpy.cumsum(other)))[count + mine]
+                    ok = before >= other_size
+                    mine, before = mine[ok], before[ok]
+                    if not len(mine):
+                        continue
+                    o_avg, o_var, o_flat = window_stats(others, before, other_size)
+                    p = mine + i
+                    m_t[mine], both_flat = t_values((o_avg, o_var, o_flat, other_size),
+                                                    (my_avg[p], my_var[p], my_flat[p],
+                                                     machine_history_size))
+                    check_m[mine] = near(m_t[mine], machine_threshold) & ~both_flat
+                    for o, b in zip(mine.tolist(), before.tolist()):
+                        other_windows[o] = (others, b)
+
+            # Walk the chunk, stopping at the first point blamed on its
+            # machine since the windows after it are wrong
+            full = full.tolist()
+            back_stats = zip(back_avg.tolist(), back_var.tolist())
+            b = 0
+            for o in range(len(idx)):
+                ii = i + o
+                di = data[ii]
+                if check_t[o]:
+                    t[o] = calc_t(good_values[-j:], values[ii:ii+k].tolist())
+                if check_m[o]:
+                    others, before = other_windows[o]
+                    history = self.machine_history[di.machine_id]
+                    pos = positions[ii]
+                    m_t[o] = calc_t(others[before-other_size:before].tolist(),
+                                    [d.value for d in history[pos-machine_history_size+1:pos+1]])
+
+                if abs(m_t[o]) >= machine_threshold:
+                    l = len(good_data)-1
+                    while l >= 0:
+                        dl = good_data[l]
+                        if dl.machine_id != di.machine_id:
+                            di.last_other = dl
+                            break
+                        l -= 1
+                    di.historical_stats = analyze(good_values[-j:])
+                    di.forward_stats = analyze(values[ii:ii+k].tolist())
+                    yield di, "machine"
+                    o += 1
+                    break
+
+                if abs(t[o]) <= threshold:
+                    state = "good"
+                    if full[o]:
+                        di.historical_stats = as_stats(back_stats[b][0], j, back_stats[b][1])
+                    else:
+                        di.historical_stats = analyze(good_values[-j:])
+                    di.forward_stats = as_stats(fore_list[0][ii], k, fore_list[1][ii])
+                else:
+                    state = "regression"
+                    di.historical_stats = analyze(good_values[-j:])
+                    di.forward_stats = analyze(values[ii:ii+k].tolist())
+                if full[o]:
+                    b += 1
+                good_data.append(di)
+                good_values.append(di.value)
+                yield di, state
+            else:
+                o = len(idx)
+
+            i += o
+            if o == len(idx):
+                chunk = min(MAX_CHUNK, chunk * 2)
+            else:
+                chunk = max(MIN_CHUNK, o * 2)
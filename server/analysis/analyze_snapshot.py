@@ -0,0 +1,195 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Test data from a directory of columnar snapshot files.
+
+A snapshot holds a file per series, named TEST_ID-BRANCH_ID-OS_ID.grcol like
+scripts/export_series.py writes, and a series.json index with the names of
+the series and of their machines.  The files are memory-mapped, so reading
+a series doesn't touch the network or the database, and forked workers share
+the pages.  writeSnapshot() makes one from any other source:
+
+    python analyze_snapshot.py -c analysis.cfg -d snapshot/
+"""
+import os
+import sys
+import time
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from analyze import PerfSeries
+from datasource import DataSource, TestSeries
+
+try:
+    import columnar
+except ImportError:
+    # It lives with the server code
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    import columnar
+
+INDEX = "series.json"
+
+
+def seriesFilename(dirname, series):
+    return os.path.join(dirname, "%s-%s-%s.grcol" % (series.test_id, series.branch_id, series.os_id))
+
+
+class SnapshotSource(DataSource):
+    def __init__(self, dirname):
+        self.dirname = dirname
+        index = json.load(open(os.path.join(dirname, INDEX)))
+        self.series = [TestSeries(s['branch_id'], s['branch_name'], s['os_id'], s['os_name'],
+                                  s['test_id'], s['test_name'], s['test_shortname'])
+                       for s in index['series']]
+        self.machine_names = dict((int(k), v) for k, v in index['machines'].items())
+        # {series: ColumnarFile}, opened as they're needed
+        self.files = {}
+
+    def _file(self, series):
+        """Returns the series' ColumnarFile, or None if it has no runs"""
+        if series not in self.files:
+            filename = seriesFilename(self.dirname, series)
+            if os.path.exists(filename):
+                self.files[series] = columnar.ColumnarFile(filename)
+            else:
+                self.files[series] = None
+        return self.files[series]
+
+    def _rows(self, series, start_time, after_id=None):
+        """Returns the indexes of the runs of series after start_time (and
+        after_id) that have a value"""
+        f = self._file(series)
+        if f is None:
+            return []
+        ids, dates, values = f['id'], f['date_run'], f['value']
+        if after_id is None:
+            after_id = -1
+        if columnar.numpy is not None:
+            numpy = columnar.numpy
+            # Missing values are stored as NaN
+            mask = (dates > start_time) & (values == values)
+            if after_id >= 0:
+                mask &= ids > after_id
+            return numpy.flatnonzero(mask)
+        return [i for i in xrange(len(f))
+                if dates[i] > start_time and ids[i] > after_id and values[i] == values[i]]
+
+    def getTestSeries(self, branches, start_time, test_names, last_run=None):
+        branches = set(branches)
+        test_names = set(test_names)
+        retval = []
+        for s in self.series:
+            if s.branch_name not in branches:
+                continue
+            if test_names and s.test_name not in test_names:
+                continue
+            if len(self._rows(s, start_time, last_run or None)):
+                retval.append(s)
+        return retval
+
+    def getTestData(self, series, start_time, after_id=None):
+        data = PerfSeries()
+        rows = self._rows(series, start_time, after_id)
+        if not len(rows):
+            return data
+        f = self._file(series)
+        if columnar.numpy is not None:
+            column = lambda name: f[name][rows].tolist()
+        else:
+            column = lambda name: [f[name][i] for i in rows]
+        for testrun_id, machine_id, date, value, buildid, revision, run_number in zip(
+                column('id'), column('machine_id'), column('date_run'), column('value'),
+                column('ref_build_id'), column('revision'), column('run_number')):
+            data.append(testrun_id, machine_id, date, value, buildid or None, date,
+                        revision or None, run_number)
+        return data
+
+    def getMachinesForTest(self, series):
+        f = self._file(series)
+        if f is None:
+            return []
+        return sorted(set(f['machine_id'].tolist() if columnar.numpy is not None else f['machine_id']))
+
+    def getMachineName(self, machine_id):
+        return self.machine_names.get(machine_id)
+
+
+def writeSnapshot(source, dirname, branches, start_time, test_names):
+    """Writes the runs since start_time of the series source has for
+    branches and test_names to a snapshot in dirname.  Returns how many runs
+    were written"""
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    series = source.getTestSeries(branches, start_time, test_names)
+    if hasattr(source, 'prefetchTestData'):
+        source.prefetchTestData(series, start_time)
+
+    index = {'series': [], 'machines': {}, 'start_time': start_time}
+    count = 0
+    for s in series:
+        data = source.getTestData(s, start_time)
+        writer = columnar.SeriesWriter({'test_id': s.test_id, 'branch_id': s.branch_id,
+                                        'os_id': s.os_id})
+        for d in data:
+            writer.add(d.testrun_id, d.timestamp, d.value, d.machine_id, 0, d.buildid,
+                       getattr(d, 'run_number', None), d.revision)
+            if d.machine_id not in index['machines']:
+                index['machines'][d.machine_id] = source.getMachineName(d.machine_id)
+        filename = seriesFilename(dirname, s)
+        fp = open(filename + ".tmp", "wb")
+        writer.write(fp)
+        fp.close()
+        os.rename(filename + ".tmp", filename)
+        index['series'].append({'branch_id': s.branch_id, 'branch_name': s.branch_name,
+                                'os_id': s.os_id, 'os_name': s.os_name,
+                                'test_id': s.test_id, 'test_name': s.test_name,
+                                'test_shortname': getattr(s, 'test_shortname', s.test_name)})
+        count += len(writer)
+        log.debug("Wrote %i runs of %s", len(writer), s)
+
+    filename = os.path.join(dirname, INDEX)
+    fp = open(filename + ".tmp", "w")
+    json.dump(index, fp, indent=1, sort_keys=True)
+    fp.close()
+    os.rename(filename + ".tmp", filename)
+    return count
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    from ConfigParser import RawConfigParser
+    from datasource import openSource
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-c", "--config", dest="config", default="analysis.cfg",
+                      help="config file whose source to snapshot")
+    parser.add_option("-d", "--dir", dest="dir", help="directory to write the snapshot to")
+    parser.add_option("-b", "--branch", dest="branches", action="append",
+                      help="branches to snapshot (default: the config's)")
+    parser.add_option("-t", "--test", dest="tests", action="append", default=[],
+                      help="tests to snapshot (default: all)")
+    parser.add_option("--days", dest="days", type="int", default=30,
+                      help="how many days of runs to snapshot")
+    parser.add_option("-v", "--verbose", dest="verbosity", action="store_const",
+                      const=log.DEBUG, default=log.INFO)
+    options, args = parser.parse_args()
+    if not options.dir:
+        parser.error("No directory given")
+    log.basicConfig(level=options.verbosity, format="%(asctime)s %(message)s")
+
+    config = RawConfigParser()
+    config.read([options.config])
+    if config.has_option('main', 'source') and config.get('main', 'source') == 'snapshot':
+        parser.error("%s already reads from a snapshot" % options.config)
+    branches = options.branches
+    if not branches:
+        branches = [s for s in config.sections() if s not in ('main', 'cache', 'dashboard', 'os')]
+
+    source = openSource(config)
+    source.connect()
+    start_time = int(time.time()) - options.days * 24 * 3600
+    count = writeSnapshot(source, options.dir, branches, start_time, options.tests)
+    log.info("Wrote %i runs to %s", count, options.dir)
@@ -1,94 +1,25 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
-import time, urllib, urllib2, re, os, sys
+import time, urllib, re, os, sys
 import logging as log
 import cPickle as pickle
 from datetime import datetime
 import email.utils
-from smtplib import SMTP
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import shutil
 try:
     import simplejson as json
 except ImportError:
     import json
 
-from analyze import TalosAnalyzer
-
-def bz_request(api, path, data=None, method=None, username=None, password=None):
-    url = api + path
-    if data:
-        data = json.dumps(data)
-
-    if username and password:
-        url += "?username=%s&password=%s" % (username, password)
-
-    req = urllib2.Request(url, data, {'Accept': 'application/json', 'Content-Type': 'application/json'})
-    if method:
-        req.get_method = lambda: method
-
-    result = urllib2.urlopen(req)
-    data = result.read()
-    return json.loads(data)
-
-def bz_check_request(*args, **kw):
-    try:
-        result = bz_request(*args, **kw)
-        assert not result.get('error'), result
-    except urllib2.HTTPError, e:
-        assert 200 <= e.code < 300, e
-
-def bz_get_bug(api, bug_num):
-    try:
-        bug = bz_request(api, "/bug/%s" % bug_num)
-        return bug
-    except KeyboardInterrupt:
-        raise
-    except:
-        log.exception("Error fetching bug %s" % bug_num)
-        return None
-
-def bz_get_bug_comments(api, bug_num):
-    try:
-        comments = bz_request(api, "/bug/%s/comment" % bug_num)
-        return comments
-    except KeyboardInterrupt:
-        raise
-    except:
-        log.exception("Error fetching comments for bug %s" % bug_num)
-        return None
-
-def bz_notify_bug(api, bug_num, message, whiteboard, username, password, retries=5):
-    for i in range(retries):
-        log.debug("Getting bug %s", bug_num)
-        bug = bz_request(api, "/bug/%s" % bug_num, username=username, password=password)
-
-        wb = bug.get('whiteboard', '')
-
-        if whiteboard not in wb:
-            bug['whiteboard'] = wb + whiteboard
-            if i == 0:
-                bug['last_change_time'] = "2009-09-09T16:31:18Z"
-
-            # Add the whiteboard
-            try:
-                log.debug("Adding whiteboard status to bug %s", bug_num)
-                bz_check_request(api, "/bug/%s" % bug_num, bug, "PUT", username=username, password=password)
-            except KeyboardInterrupt:
-                raise
-            except:
-                log.exception("Problem changing whiteboard, trying again")
-                continue
-
-        # Add the comment
-        log.debug("Adding comment to bug %s", bug_num)
-        bz_check_request(api, "/bug/%s/comment" % bug_num,
-                {"text": message, "is_private": False}, "POST",
-                username=username, password=password)
-        break
-
+from analyze import TalosAnalyzer, PerfSeries
+from pushstore import openPushStore
+from httpfetch import Fetcher
+from bugzilla import BugzillaClient, BugCache
+from notify import MailQueue
+from warninghistory import WarningHistory
+from graphoutput import GraphWriter
+from dashboard import Dashboard, parseTests
+from datasource import openSource
 
 def shorten(url, login, apiKey, max_tries=10, sleep_time=30):
     params = {
@@ -143,44 +74,64 @@ def bugs_from_comments(comments):
             retval.append(int(m))
     return retval
 
-def send_msg(fromaddr, subject, msg, addrs, headers={}):
-    s = SMTP()
-    s.connect()
-
-    # Convert to ascii
-    msg = msg.encode('ascii', 'replace')
-
-    for addr in addrs:
-        m = MIMEText(msg, "plain", "ascii")
-        m['Date'] = email.utils.formatdate()
-        m['To'] = addr
-        m['Subject'] = subject
-        for k,v in headers.items():
-            m[k] = v
-
-        s.sendmail(fromaddr, [addr], m.as_string())
-    s.quit()
-
 class PushLog:
-    def __init__(self, filename, base_url):
+    def __init__(self, filename, base_url, store=None, fetcher=None):
         self.filename = filename
         self.base_url = base_url
+        if store is None:
+            store = openPushStore(filename)
+        self.store = store
+        if fetcher is None:
+            fetcher = Fetcher()
+        self.fetcher = fetcher
+        # Pushes looked up so far, {branch: {shortrev: push}}
         self.pushes = {}
+        # Pushes and push ranges fetched since the last save
+        self.new_pushes = {}
+        self.new_ranges = {}
+        # Pushes fetched since the last takeUpdates(), when tracking
+        self.updates = None
 
     def load(self):
-        try:
-            if not os.path.exists(self.filename):
-                self.pushes = {}
-                return
-            self.pushes = json.load(open(self.filename))
-        except:
-            log.exception("Couldn't load push dates from %s", self.filename)
-            self.pushes = {}
+        self.store.load()
 
     def save(self):
-        tmp = self.filename + ".tmp"
-        json.dump(self.pushes, open(tmp, "w"), indent=2, sort_keys=True)
-        os.rename(tmp, self.filename)
+        if self.new_pushes or self.new_ranges:
+            self.store.save(self.new_pushes, self.new_ranges)
+        self.new_pushes = {}
+        self.new_ranges = {}
+
+    def trackUpdates(self):
+        """Start recording newly fetched pushes for takeUpdates()"""
+        self.updates = {}
+
+    def takeUpdates(self):
+        """Returns the pushes fetched since the last call"""
+        updates = self.updates
+        self.updates = {}
+        return updates
+
+    def mergeUpdates(self, updates):
+        """Adds pushes returned by another PushLog's takeUpdates()"""
+        for branch, pushes in updates.items():
+            self.pushes.setdefault(branch, {}).update(pushes)
+            self.new_pushes.setdefault(branch, {}).update(pushes)
+
+    def lookup(self, branch, shortrevs):
+        """Returns {shortrev: push} for the shortrevs that are known"""
+        known = self.pushes.setdefault(branch, {})
+        retval = {}
+        missing = []
+        for shortrev in shortrevs:
+            if shortrev in known:
+                retval[shortrev] = known[shortrev]
+            else:
+                missing.append(shortrev)
+        if missing:
+            found = self.store.getPushes(branch, missing)
+            known.update(found)
+            retval.update(found)
+        return retval
 
     def _handleJson(self, branch, data):
         if isinstance(data, dict):
@@ -188,38 +139,48 @@ class PushLog:
                 pusher = push['user']
                 for change in push['changesets']:
                     shortrev = change["node"][:12]
-                    self.pushes[branch][shortrev] = {
-                            "date": push['date'],
-                            "comments": change['desc'],
-                            "author": change['author'],
-                            "pusher": pusher,
-                            }
+                    p = {"date": push['date'],
+                         "comments": change['desc'],
+                         "author": change['author'],
+                         "pusher": pusher,
+                         }
+                    self.pushes.setdefault(branch, {})[shortrev] = p
+                    self.new_pushes.setdefault(branch, {})[shortrev] = p
+                    if self.updates is not None:
+                        self.updates.setdefault(branch, {})[shortrev] = p
 
     def getPushDates(self, branch, repo_path, changesets):
         to_query = []
         retval = {}
-        if branch not in self.pushes:
-            self.pushes[branch] = {}
 
+        padded = []
         for c in changesets:
             # Pad with zeros to work around bug where revisions with leading
             # zeros have it stripped
-            while len(c) < 12:
-                c = "0" + c
+            padded.append(c.rjust(12, "0"))
+        known = self.lookup(branch, set(c[:12] for c in padded))
+        for c in padded:
             shortrev = c[:12]
-            if shortrev not in self.pushes[branch]:
+            if shortrev not in known:
                 to_query.append(c)
             else:
-                retval[c] = self.pushes[branch][shortrev]['date']
+                retval[c] = known[shortrev]['date']
 
         if len(to_query) > 0:
             log.debug("Fetching %i changesets", len(to_query))
+            chunks = []
             for i in range(0, len(to_query), 50):
                 chunk = to_query[i:i+50]
                 changesets = ["changeset=%s" % c for c in chunk]
                 base_url = self.base_url
                 url = "%s/%s/json-pushes?full=1&%s" % (base_url, repo_path, "&".join(changesets))
-                raw_data = urllib.urlopen(url).read()
+                chunks.append((url, chunk))
+            # The chunks are fetched concurrently
+            fetched = self.fetcher.fetchAll([url for url, chunk in chunks])
+            for url, chunk in chunks:
+                raw_data = fetched[url]
+                if isinstance(raw_data, Exception):
+                    raise raw_data
                 try:
                     data = json.loads(raw_data)
                     self._handleJson(branch, data)
@@ -238,17 +199,16 @@ class PushLog:
 
     def getPushRange(self, branch, repo_path, from_, to_):
         key = "%s-%s" % (from_, to_)
-        if branch not in self.pushes:
-            self.pushes[branch] = {"ranges": {}}
-        elif "ranges" not in self.pushes[branch]:
-            self.pushes[branch]["ranges"] = {}
-        elif key in self.pushes[branch]["ranges"]:
-            return self.pushes[branch]["ranges"][key]
+        retval = self.new_ranges.get(branch, {}).get(key)
+        if retval is None:
+            retval = self.store.getRange(branch, key)
+        if retval is not None:
+            return retval
 
         log.debug("Fetching changesets from %s to %s", from_, to_)
         base_url = self.base_url
         url = "%s/%s/json-pushes?full=1&fromchange=%s&tochange=%s" % (base_url, repo_path, from_, to_)
-        raw_data = urllib.urlopen(url).read()
+        raw_data = self.fetcher.fetch(url)
         try:
             data = json.loads(raw_data)
             self._handleJson(branch, data)
@@ -258,7 +218,7 @@ class PushLog:
             for push_id, push in pushes:
                 for c in push['changesets']:
                     retval.append(c['node'][:12])
-            self.pushes[branch]["ranges"][key] = retval
+            self.new_ranges.setdefault(branch, {})[key] = retval
             return retval
         except:
             log.exception("Error parsing %s", raw_data)
@@ -266,7 +226,7 @@ class PushLog:
 
     def getChange(self, branch, rev):
         shortrev = rev[:12]
-        return self.pushes[branch][rev]
+        return self.lookup(branch, [shortrev])[shortrev]
 
 class AnalysisRunner:
     def __init__(self, options, config):
@@ -283,13 +243,40 @@ class AnalysisRunner:
 
         log.basicConfig(level=options.verbosity, format="%(asctime)s %(message)s")
 
-        self.pushlog = PushLog(config.get('cache', 'pushlog'), config.get('main', 'base_hg_url'))
+        # How many requests to make to hg at once
+        concurrency = 4
+        if config.has_option('main', 'hg_concurrency'):
+            concurrency = config.getint('main', 'hg_concurrency')
+        self.pushlog = PushLog(config.get('cache', 'pushlog'), config.get('main', 'base_hg_url'),
+                               fetcher=Fetcher(concurrency))
         self.pushlog.load()
 
         self.loadWarningHistory()
 
-        self.dashboard_data = {}
-        self.bug_cache = {}
+        # Warning emails, sent together once the run is done
+        smtp_server = None
+        if config.has_option('main', 'smtp_server'):
+            smtp_server = config.get('main', 'smtp_server')
+        from_email = None
+        if config.has_option('main', 'from_email'):
+            from_email = config.get('main', 'from_email')
+        self.mail = MailQueue(from_email, smtp_server)
+
+        self.bugzilla = None
+        if config.has_option('main', 'bz_api'):
+            ttl = 24
+            if config.has_option('main', 'bz_cache_hours'):
+                ttl = config.getfloat('main', 'bz_cache_hours')
+            bug_file = None
+            if config.has_option('cache', 'bugzilla'):
+                bug_file = config.get('cache', 'bugzilla')
+            cache = BugCache(bug_file, ttl*3600)
+            cache.load()
+            username = password = None
+            if config.has_option('main', 'bz_username'):
+                username = config.get('main', 'bz_username')
+                password = config.get('main', 'bz_password')
+            self.bugzilla = BugzillaClient(config.get('main', 'bz_api'), username, password, cache)
 
         self.fore_window = config.getint('main', 'fore_window')
         self.back_window = config.getint('main', 'back_window')
@@ -300,62 +287,116 @@ class AnalysisRunner:
         # The id of the last test run we've looked at
         self.last_run = 0
 
-        import analyze_db as source
-        source.connect(config.get('main', 'dburl'))
-        self.source = source
+        # Whether to load the data for all series at once, and in how many
+        # queries
+        self.prefetch = True
+        if config.has_option('main', 'prefetch'):
+            self.prefetch = config.getboolean('main', 'prefetch')
+        self.prefetch_partitions = 1
+        if config.has_option('main', 'prefetch_partitions'):
+            self.prefetch_partitions = config.getint('main', 'prefetch_partitions')
+
+        # Where to keep each series' analyzer state between runs, so that
+        # only new test runs need to be fetched and analyzed
+        self.state_dir = None
+        if config.has_option('cache', 'analysis_state'):
+            self.state_dir = config.get('cache', 'analysis_state')
+        # {(test_id, branch_id, os_id): state} for the series being analyzed
+        self.states = {}
+
+        # How many processes to analyze series with
+        self.jobs = getattr(options, 'jobs', None)
+        if not self.jobs and config.has_option('main', 'workers'):
+            self.jobs = config.getint('main', 'workers')
+
+        if getattr(options, 'vectorized', False):
+            from analyze_numpy import NumpyTalosAnalyzer
+            self.analyzer = NumpyTalosAnalyzer
+        else:
+            self.analyzer = TalosAnalyzer
+
+        # Writes the graph pages as series are reported
+        self.graphs = None
+        if config.has_option('main', 'graph_dir'):
+            threads = 2
+            if config.has_option('main', 'graph_threads'):
+                threads = config.getint('main', 'graph_threads')
+            max_points = None
+            if config.has_option('main', 'graph_max_points'):
+                max_points = config.getint('main', 'graph_max_points')
+            self.graphs = GraphWriter(config.get('main', 'graph_dir'), "html", threads, max_points)
+
+        # The dashboard's data, kept up to date with the series analyzed
+        self.dashboard = None
+        if config.has_option('main', 'dashboard_dir'):
+            state_file = None
+            if config.has_option('cache', 'dashboard'):
+                state_file = config.get('cache', 'dashboard')
+            self.dashboard = Dashboard(config.get('main', 'dashboard_dir'),
+                                       parseTests(config.get('dashboard', 'tests')), state_file)
+            self.dashboard.load()
+
+        self.source = openSource(config)
+        self.source.connect()
 
     def loadWarningHistory(self):
         # Stop warning about stuff from a long time ago
         log.debug("Loading warning history")
         fn = self.config.get('cache', 'warning_history')
-        cutoff = self.options.start_time
-        try:
-            if not os.path.exists(fn):
-                self.warning_history = {}
-                return
-            self.warning_history = json.load(open(fn))
-            # Purge old warnings
-            for branch, oses in self.warning_history.items():
-                if branch in ('inactive_machines', 'bad_machines'):
-                    continue
-                for os_name, tests in oses.items():
-                    for test_name, values in tests.items():
-                        for d in values[:]:
-                            buildid, timestamp = d
-                            if timestamp < cutoff:
-                                log.debug("Removing warning %s since it's before cutoff (%s)", d, cutoff)
-                                values.remove(d)
-                            else:
-                                # Convert to tuples
-                                values.remove(d)
-                                values.append((buildid, timestamp))
-
-                        if not values:
-                            log.debug("Removing empty warning list %s %s %s", branch, os_name, test_name)
-                            del tests[test_name]
-                    if not tests:
-                        log.debug("Removing empty os list %s %s", branch, os_name)
-                        del oses[os_name]
-                if not oses:
-                    log.debug("Removing empty branch list %s", branch)
-                    del self.warning_history[branch]
-        except:
-            log.exception("Couldn't load warnings from %s", fn)
-            self.warning_history = {}
+        self.warning_history = WarningHistory(fn, self.options.start_time)
+        self.warning_history.load()
 
     def saveWarningHistory(self):
-        fn = self.config.get('cache', 'warning_history')
+        self.warning_history.save()
+
+    def analysisParams(self):
+        return (self.back_window, self.fore_window, self.threshold,
+                self.machine_threshold, self.machine_history_size)
+
+    def stateFile(self, s):
+        return os.path.join(self.state_dir, "%s-%s-%s.pickle" % (s.test_id, s.branch_id, s.os_id))
+
+    def loadStates(self, series):
+        """Loads the saved analyzer states of series, skipping any saved
+        with different analysis settings"""
+        self.states = {}
+        params = self.analysisParams()
+        for s in series:
+            fn = self.stateFile(s)
+            if not os.path.exists(fn):
+                continue
+            try:
+                state = pickle.load(open(fn, "rb"))
+            except:
+                log.exception("Couldn't load analysis state from %s", fn)
+                continue
+            if state['params'] != params:
+                log.debug("Ignoring %s since the analysis settings have changed", fn)
+                continue
+            self.states[(s.test_id, s.branch_id, s.os_id)] = state
+
+    def saveState(self, s, state):
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+        fn = self.stateFile(s)
         tmp = fn + ".tmp"
-        json.dump(self.warning_history, open(tmp, "w"), indent=2, sort_keys=True)
+        pickle.dump(state, open(tmp, "wb"), pickle.HIGHEST_PROTOCOL)
         os.rename(tmp, fn)
+        self.states[(s.test_id, s.branch_id, s.os_id)] = state
 
     def updateTimes(self, branch, data):
         # We want to fetch the changesets so we can order the data points by
         # push time, rather than by test time
-        changesets = set(d.revision for d in data)
+        if isinstance(data, PerfSeries):
+            changesets = set(data.revisions)
+        else:
+            changesets = set(d.revision for d in data)
 
         dates = self.pushlog.getPushDates(branch, self.config.get(branch, 'repo_path'), changesets)
 
+        if isinstance(data, PerfSeries):
+            data.setTimes(dates)
+            return
         for d in data:
             rev = dates.get(d.revision, None)
             if rev:
@@ -393,15 +434,11 @@ class AnalysisRunner:
     def makeBugUrl(self, bug_num):
         return "http://bugzilla.mozilla.org/show_bug.cgi?id=%s" % bug_num
 
-    def getBug(self, bug_num):
-        if bug_num in self.bug_cache:
-            return self.bug_cache[bug_num]
-
-        if self.config.has_option('main', 'bz_api'):
-            bug = bz_get_bug(self.config.get('main', 'bz_api'), bug_num)
-            if bug:
-                self.bug_cache[bug_num] = bug
-                return bug
+    def getBugs(self, bug_nums):
+        """Returns {bug_num: bug} for the bugs that could be looked up"""
+        if self.bugzilla is None:
+            return {}
+        return self.bugzilla.getBugs(bug_nums)
 
     def isTestReversed(self, test_name):
         reversed_tests = []
@@ -545,9 +582,10 @@ class AnalysisRunner:
                 bug_limit = bug_fuzzy_limit
             if bugs:
                 msg += "Bugs:\n"
+                found = self.getBugs(bugs[:bug_limit])
                 for bug_num in bugs[:bug_limit]:
                     bug_url = self.makeBugUrl(bug_num)
-                    bug = self.getBug(bug_num)
+                    bug = found.get(bug_num)
                     if bug:
                         bug_desc = bug['summary'].encode("utf8")
                         msg += "  * %(bug_url)s - %(bug_desc)s\n" % locals()
@@ -647,9 +685,6 @@ class AnalysisRunner:
                 to_=bad_rev)
 
         whiteboard = self.config.get('main', 'bz_whiteboard') % locals()
-        username = self.config.get('main', 'bz_username')
-        password = self.config.get('main', 'bz_password')
-        api = self.config.get('main', 'bz_api')
 
         graph = self.shorten(self.makeChartUrl(series, bad))
 
@@ -684,7 +719,9 @@ of the regression.""" % locals()
 
             # Look to see if this bug was previously implicated for this
             # regression
-            comments = bz_get_bug_comments(api, notify_bug)
+            comments = self.bugzilla.getComments(notify_bug)
+            if comments is None:
+                continue
             for c in comments['comments']:
                 msg = c['text']
                 if whiteboard in msg and os_name in msg and branch in msg and hg_url in msg:
@@ -692,7 +729,7 @@ of the regression.""" % locals()
                     break
             else:
                 log.info("Notifying bug %s", notify_bug)
-                bz_notify_bug(api, notify_bug, message, whiteboard, username, password)
+                self.bugzilla.notifyBug(notify_bug, message, whiteboard)
 
     def emailWarning(self, series, d, state, last_good):
         addresses = []
@@ -739,51 +776,20 @@ of the regression.""" % locals()
                 headers['References'] = headers['In-Reply-To']
             else:
                 headers = {}
-            send_msg(self.config.get('main', 'from_email'), subject, msg, addresses, headers)
+            self.mail.add(addresses, subject, msg, headers,
+                          group=(state, branch, last_good.revision, d.revision))
 
     def outputDashboard(self):
-        log.debug("Creating dashboard")
-
-        dirname = self.config.get('main', 'dashboard_dir')
-        if not os.path.exists(dirname):
-            # Copy in the rest of html
-            shutil.copytree('html/dashboard', dirname)
-            shutil.copytree('html/flot', '%s/flot' % dirname)
-            shutil.copytree('html/jquery', '%s/jquery' % dirname)
-        filename = os.path.join(dirname, 'testdata.js')
-        fp = open(filename + ".tmp", "w")
-        now = time.asctime()
-        fp.write("// Generated at %s\n" % now)
-        fp.write("gFetchTime = ")
-        json.dump(now, fp, separators=(',',':'))
-        fp.write(";\n")
-        fp.write("var gData = ")
-        # Hackity hack
-        # Don't pretend we have double precision here
-        # 8 digits of precision is plenty
-        try:
-            json.encoder.FLOAT_REPR = lambda f: "%.8g" % f
-        except:
-            pass
-        json.dump(self.dashboard_data, fp, separators=(',',':'), sort_keys=True)
-        try:
-            json.encoder.FLOAT_REPR = repr
-        except:
-            pass
-
-        fp.write(";\n")
-        fp.close()
-        os.rename(filename + ".tmp", filename)
+        self.dashboard.output(self.source.getMachineName)
+        self.dashboard.save()
 
     def outputGraphs(self, series, series_data):
         all_data = []
         good_data = []
         regressions = []
         bad_machines = {}
-        graph_dir = self.config.get('main', 'graph_dir')
         test_name = series.test_name.replace("/", "_")
-        basename = "%s/%s-%s-%s" % (graph_dir,
-                series.branch_name, series.os_name, test_name)
+        basename = "%s-%s-%s" % (series.branch_name, series.os_name, test_name)
 
         for s, d, state, skip, last_good in series_data:
             graph_point = (d.time * 1000, d.value)
@@ -806,25 +812,14 @@ of the regression.""" % locals()
             machine_name = self.source.getMachineName(machine_id)
             graphs.append({"label": "Bad Machines (%s)" % machine_name, "data": points, "lines": {"show": False}, "points": {"show": True}})
 
-        graph_file = "%s.js" % basename
-        html_file = "%s.html" % basename
-        html_template = open("html/graph_template.html").read()
-
         test_name = series.test_name
         os_name = series.os_name
         branch_name = series.branch_name
 
         title = "Talos Regression Graph for %(test_name)s on %(os_name)s %(branch_name)s" % locals()
 
-        html = html_template % dict(graph_file = os.path.basename(graph_file),
-                title=title)
-        if not os.path.exists(graph_dir):
-            os.makedirs(graph_dir)
-            # Copy in the rest of the HTML as well
-            shutil.copytree('html/flot', '%s/flot' % graph_dir)
-
-        open(html_file, "w").write(html)
-        open(graph_file, "w").write("var graph_data = %s;" % json.dumps(graphs))
+        # Written out by the graph threads
+        self.graphs.add(basename, title, graphs)
 
     def handleData(self, series, d, state, skip, last_good):
         if not skip and state != "good" and not self.options.catchup and last_good is not None:
@@ -836,56 +831,33 @@ of the regression.""" % locals()
                     self.bugComment(series, d, state, last_good)
 
     def handleDashboardSeries(self, s):
-        # Add it to our dashboard data
-        sevenDaysAgo = time.time() - 7*24*60*60
-        importantTests = []
-        for t in re.split(r"(?<!\\),", self.config.get("dashboard", "tests")):
-            t = t.replace("\\,", ",").strip()
-            importantTests.append(t)
-
-        if s.test_name not in importantTests:
+        """Brings the dashboard data of a series that wasn't analyzed this
+        run up to date"""
+        if not self.dashboard.wants(s.test_name) or self.dashboard.isUpdated(s):
             return
+        if self.config.has_option('os', s.os_name):
+            s.os_name = self.config.get('os', s.os_name)
 
-        data = self.source.getTestData(s, sevenDaysAgo)
-        if len(data) == 0:
-            return
-
-        log.info("Creating dashboard data for %s %s %s", s.branch_name, s.os_name, s.test_name)
-
-        # We want to merge the Tp3 (Memset) and Tp3 (RSS) results together
-        # for the dashboard, since they're just different names for the
-        # same thing on different platforms
-        test_name = s.test_name
-        if test_name == "Tp3 (Memset)":
-            test_name = "Tp3 (RSS)"
-        elif test_name == "Tp4 (Memset)":
-            test_name = "Tp4 (RSS)"
-        self.dashboard_data.setdefault(s.branch_name, {})
-        self.dashboard_data[s.branch_name].setdefault(test_name, {'_testid': s.test_id})
-        self.dashboard_data[s.branch_name][test_name].setdefault(s.os_name, {'_platformid': s.os_id, '_graphURL': self.makeChartUrl(s)})
-        _d = self.dashboard_data[s.branch_name][test_name][s.os_name]
-
-        for d in data:
-            if d.timestamp < sevenDaysAgo:
-                continue
-            machine_name = self.source.getMachineName(d.machine_id)
-            if machine_name not in _d:
-                _d[machine_name] = {
-                        'results': [],
-                        'stats': [],
-                        }
-            results = _d[machine_name]['results']
-            results.append(d.timestamp)
-            results.append(d.value)
-
-        for machine_name in _d:
-            if machine_name.startswith("_"):
-                continue
-            results = _d[machine_name]['results']
-            values = [results[i+1] for i in range(0, len(results), 2)]
-            _d[machine_name]['stats'] = [avg(values), max(values), min(values)]
-
-    def handleSeries(self, s):
+        sevenDaysAgo = time.time() - 7*24*60*60
+        after_id = self.dashboard.lastId(s)
+        if after_id is None:
+            log.info("Creating dashboard data for %s %s %s", s.branch_name, s.os_name, s.test_name)
+            data = self.source.getTestData(s, sevenDaysAgo)
+        else:
+            # Only the runs since the ones we have
+            data = self.source.getTestData(s, sevenDaysAgo, after_id)
+        self.dashboard.addSeries(s, data, self.makeChartUrl(s), after_id is None)
+
+    def analyzeSeries(self, s):
+        """Fetches and analyzes a series.
+
+        Returns (series, [(d, state), ...], last test run id, analyzer
+        state, dashboard points), with only the points recent enough to
+        report on, or None if the series is ignored.  The analyzer state is
+        None unless states are being kept, and the dashboard points (the
+        runs fetched from the last week) are None unless the series is on
+        the dashboard.  This runs in the worker processes when analyzing in
+        parallel, so the only state it may change is the pushlog cache."""
         if self.config.has_option('os', s.os_name):
             s.os_name = self.config.get('os', s.os_name)
 
@@ -906,67 +878,101 @@ of the regression.""" % locals()
         for i in ignore_tests:
             if re.search(i, s.test_name):
                 log.debug("Skipping %s %s %s", s.branch_name, s.os_name, s.test_name)
-                return
+                return None
 
         log.info("Processing %s %s %s", s.branch_name, s.os_name, s.test_name)
 
-        # Get all the test data for all machines running this combination
-        t = time.time()
-        data = self.source.getTestData(s, options.start_time)
-        log.debug("%.2f to fetch data", time.time() - t)
-
+        a = self.analyzer()
+        resumed = False
+        saved = self.states.get((s.test_id, s.branch_id, s.os_id))
+        if saved is not None:
+            # Carry on from where the last run stopped with just the new runs
+            t = time.time()
+            data = self.source.getTestData(s, self.options.start_time, saved['last_id'])
+            log.debug("%.2f to fetch %i new runs", time.time() - t, len(data))
+            self.updateTimes(s.branch_name, data)
+            resumed = a.resume(saved['analyzer'], data)
+            if not resumed:
+                log.info("New runs are older than analyzed ones, starting over")
+                a = self.analyzer()
+
+        if not resumed:
+            # Get all the test data for all machines running this combination
+            t = time.time()
+            data = self.source.getTestData(s, self.options.start_time)
+            log.debug("%.2f to fetch data", time.time() - t)
+            self.updateTimes(s.branch_name, data)
+            a.addData(data)
+
+        last_run = 0
         if data:
-            m = max(d.testrun_id for d in data)
-            if self.last_run < m:
-                log.debug("Setting last_run to %s", m)
-                self.last_run = m
-
-        self.updateTimes(s.branch_name, data)
-
-        a = TalosAnalyzer()
-        a.addData(data)
+            last_run = max(d.testrun_id for d in data)
 
         analysis_gen = a.analyze_t(self.back_window, self.fore_window,
                 self.threshold, self.machine_threshold,
                 self.machine_history_size)
 
-        if s.branch_name not in self.warning_history:
-            self.warning_history[s.branch_name] = {}
-        if s.os_name not in self.warning_history[s.branch_name]:
-            self.warning_history[s.branch_name][s.os_name] = {}
-        if s.test_name not in self.warning_history[s.branch_name][s.os_name]:
-            self.warning_history[s.branch_name][s.os_name][s.test_name] = []
-        warnings = self.warning_history[s.branch_name][s.os_name][s.test_name]
+        # Uncomment this for debugging!
+        #cutoff = self.options.start_time
+        cutoff = time.time() - 7*24*3600
+        results = [(d, state) for d, state in analysis_gen if d.timestamp >= cutoff]
+
+        state = None
+        if self.state_dir:
+            last_id = last_run
+            if resumed:
+                last_id = max(last_id, saved['last_id'])
+            state = {'params': self.analysisParams(),
+                     'last_id': last_id,
+                     'analyzer': a.getState(self.back_window, self.fore_window,
+                                            self.machine_history_size),
+                     'resumed': resumed,
+                     }
+        recent = None
+        if self.dashboard is not None and self.dashboard.wants(s.test_name):
+            recent = [d for d in data if d.timestamp >= cutoff]
+
+        return s, results, last_run, state, recent
+
+    def reportSeries(self, result):
+        """Records and sends out the warnings from an analyzeSeries() result"""
+        if result is None:
+            return
+        s, results, last_run, analysis_state, recent = result
+
+        if self.last_run < last_run:
+            log.debug("Setting last_run to %s", last_run)
+            self.last_run = last_run
+
+        history = self.warning_history
 
         last_good = None
         last_err = None
         last_err_good = None
-        # Uncomment this for debugging!
-        #cutoff = self.options.start_time
-        cutoff = time.time() - 7*24*3600
         series_data = []
-        for d, state in analysis_gen:
+        cutoff = time.time() - 7*24*3600
+        if analysis_state is not None and analysis_state['resumed']:
+            # Pick up where the last run's reporting left off
+            saved = self.states[(s.test_id, s.branch_id, s.os_id)]
+            last_good, last_err, last_err_good = saved['report']
+            series_data = [(s,) + p for p in saved['recent'] if p[0].timestamp >= cutoff]
+        for d, state in results:
             skip = False
-            if d.timestamp < cutoff:
-                continue
-
             if state != "good":
                 # Skip warnings about regressions we've already
                 # warned people about
-                if (d.buildid, d.timestamp) in warnings:
+                if history.seen(s.branch_name, s.os_name, s.test_name, d.buildid, d.timestamp):
                     skip = True
                 else:
-                    warnings.append((d.buildid, d.timestamp))
+                    history.add(s.branch_name, s.os_name, s.test_name, d.buildid, d.timestamp)
                     if state == "machine":
                         machine_name = self.source.getMachineName(d.machine_id)
-                        if 'bad_machines' not in self.warning_history:
-                            self.warning_history['bad_machines'] = {}
                         # When did we last warn about this machine?
-                        if self.warning_history['bad_machines'].get(machine_name, 0) > time.time() - 7*24*3600:
+                        if history.machineWarned(machine_name) > time.time() - 7*24*3600:
                             skip = True
                         else:
                             # If it was over a week ago, then send another warning
-                            self.warning_history['bad_machines'][machine_name] = time.time()
+                            history.warnMachine(machine_name)
 
                 if not last_err:
                     last_err = d
@@ -981,9 +987,40 @@ of the regression.""" % locals()
             series_data.append((s, d, state, skip, last_good))
             self.handleData(s, d, state, skip, last_good)
 
-        if self.config.has_option('main', 'graph_dir'):
+        if self.graphs is not None:
             self.outputGraphs(s, series_data)
 
+        if recent is not None:
+            # These are all the runs from the last week, or just the new ones
+            # when the analysis was resumed
+            resumed = analysis_state is not None and analysis_state['resumed']
+            dashboard_id = self.dashboard.lastId(s)
+            if not resumed:
+                self.dashboard.addSeries(s, recent, self.makeChartUrl(s), True)
+            elif dashboard_id is not None:
+                saved = self.states[(s.test_id, s.branch_id, s.os_id)]
+                if dashboard_id < saved['last_id']:
+                    # The last run stopped after saving the analysis state
+                    # but before the dashboard's, so the dashboard hasn't
+                    # seen the runs in between
+                    log.info("Rebuilding the dashboard data for %s %s %s",
+                             s.branch_name, s.os_name, s.test_name)
+                    recent = self.source.getTestData(s, cutoff)
+                    self.dashboard.addSeries(s, recent, self.makeChartUrl(s), True)
+                else:
+                    self.dashboard.addSeries(s, recent, self.makeChartUrl(s), False)
+
+        if analysis_state is not None:
+            analysis_state['report'] = (last_good, last_err, last_err_good)
+            analysis_state['recent'] = [p[1:] for p in series_data]
+            try:
+                self.saveState(s, analysis_state)
+            except:
+                log.exception("Error saving analysis state for %s", s)
+
+    def handleSeries(self, s):
+        self.reportSeries(self.analyzeSeries(s))
+
     def loadSeries(self):
         start_time = self.options.start_time
         if self.config.has_option('cache', 'last_run_file'):
@@ -998,12 +1035,7 @@ of the regression.""" % locals()
 
     def loadDashboardSeries(self):
         start_time = self.options.start_time
-        importantTests = []
-        for t in re.split(r"(?<!\\),", self.config.get("dashboard", "tests")):
-            t = t.replace("\\,", ",").strip()
-            importantTests.append(t)
-        #importantTests = []
-        series = self.source.getTestSeries(self.options.branches, start_time, importantTests, 0)
+        series = self.source.getTestSeries(self.options.branches, start_time, self.dashboard.tests, 0)
         return series
 
     def run(self):
@@ -1011,13 +1043,38 @@ of the regression.""" % locals()
         series = self.loadSeries()
         self.done = False
 
-        while not self.done:
-            if not series:
-                break
-            s = series.pop()
-            self.handleSeries(s)
+        if hasattr(self.source, 'preloadMachines'):
+            # Look up every machine's name at once rather than as each one
+            # is reported on; workers forked later get them too
+            self.source.preloadMachines()
+
+        if self.state_dir:
+            self.loadStates(series)
+            log.info("Resuming the analysis of %i of %i series", len(self.states), len(series))
+
+        if self.prefetch and series and hasattr(self.source, 'prefetchTestData'):
+            # Load the data for every series up front rather than with a
+            # query per series; if they're all being resumed, only the runs
+            # that are new to all of them are needed
+            after_id = None
+            if len(self.states) == len(series):
+                after_id = min(state['last_id'] for state in self.states.values())
+            t = time.time()
+            count = self.source.prefetchTestData(series, self.options.start_time,
+                                                 self.prefetch_partitions, after_id)
+            log.info("Prefetched %i runs for %i series in %.2fs", count,
+                     len(series), time.time() - t)
+
+        if self.jobs > 1:
+            self.runParallel(series)
+        else:
+            while not self.done:
+                if not series:
+                    break
+                s = series.pop()
+                self.handleSeries(s)
 
-        if self.config.has_option('main', 'dashboard_dir'):
+        if self.dashboard is not None:
             log.info("Getting dashboard data")
             dashboard_series = self.loadDashboardSeries()
             while not self.done:
@@ -1027,7 +1084,34 @@ of the regression.""" % locals()
                 self.handleDashboardSeries(s)
             self.outputDashboard()
 
+    def runParallel(self, series):
+        """Analyzes series in a pool of worker processes.
+
+        Results come back in the same order as handleSeries would process
+        them, and everything with side effects (warning history, pushlog
+        cache, emails, bug comments, graphs) happens here in the parent."""
+        global _worker_runner
+        import multiprocessing
+        _worker_runner = self
+        log.info("Analyzing %i series with %i workers", len(series), self.jobs)
+        pool = multiprocessing.Pool(self.jobs, _initWorker)
+        try:
+            for result, updates in pool.imap(_analyzeSeries, reversed(series)):
+                self.pushlog.mergeUpdates(updates)
+                self.reportSeries(result)
+                if self.done:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+
     def save(self, errors=False):
+        if self.graphs is not None:
+            try:
+                self.graphs.close()
+            except:
+                log.exception("Error writing graphs")
+
         try:
             self.saveWarningHistory()
         except:
@@ -1038,6 +1122,18 @@ of the regression.""" % locals()
         except:
             log.exception("Error saving pushlog")
 
+        try:
+            if len(self.mail):
+                log.info("Sent %i emails", self.mail.send())
+        except:
+            log.exception("Error sending mail")
+
+        if self.bugzilla is not None:
+            try:
+                self.bugzilla.cache.save()
+            except:
+                log.exception("Error saving bug cache")
+
         if not errors:
             try:
                 if self.config.has_option('cache', 'last_run_file'):
@@ -1045,6 +1141,19 @@ of the regression.""" % locals()
             except:
                 log.exception("Error saving last time")
 
+# The runner pool workers analyze series for; the workers are forked with a
+# copy of it
+_worker_runner = None
+
+def _initWorker():
+    # Don't share the parent's database connections
+    _worker_runner.source.connect()
+    _worker_runner.pushlog.trackUpdates()
+
+def _analyzeSeries(s):
+    result = _worker_runner.analyzeSeries(s)
+    return result, _worker_runner.pushlog.takeUpdates()
+
 if __name__ == "__main__":
     from optparse import OptionParser
     from ConfigParser import RawConfigParser
@@ -1060,6 +1169,8 @@ if __name__ == "__main__":
     parser.add_option("-c", "--config", dest="config", help="config file to read")
     parser.add_option("", "--start-time", dest="start_time", type="int", help="timestamp for when we start looking at data")
     parser.add_option("", "--catchup", dest="catchup", action="store_true", help="Don't output any warnings, just process data")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="how many processes to analyze series with")
+    parser.add_option("", "--vectorized", dest="vectorized", action="store_true", help="Analyze series with numpy")
 
     parser.set_defaults(
             branches = [],
@@ -1072,6 +1183,8 @@ if __name__ == "__main__":
             machine_addresses = [],
             config = "analysis.cfg",
             catchup = False,
+            vectorized = False,
+            jobs = None,
             )
 
     options, args = parser.parse_args()
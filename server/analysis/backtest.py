@@ -0,0 +1,243 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Replays a snapshot's series through the analysis with a grid of parameters.
+
+Each parameter can be given a list of values, and every combination of them
+is tried on every series, e.g.
+
+    python backtest.py -s snapshot/ --fore-window 3,5,8 --threshold 7,9,12 -j 4
+
+Parameters that aren't given come from the config file.  For each
+combination this reports how many points were regressions and bad machines,
+how many regression warnings would have gone out, how long after a
+regressing run its warning could go out (the fore window has to fill up
+first), and how long the analysis took.
+
+The series are loaded once, before the worker processes are forked, so the
+workers share their arrays rather than each loading a copy.  Points are
+ordered by when they ran rather than by push date, as there's no pushlog
+offline."""
+import sys
+import time
+import itertools
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from analyze import TalosAnalyzer, median
+from analyze_snapshot import SnapshotSource
+
+# The analysis parameters, in analyze_t's order, and their types
+PARAMS = [
+    ('back_window', int),
+    ('fore_window', int),
+    ('threshold', float),
+    ('machine_threshold', float),
+    ('machine_history_size', int),
+    ]
+
+# The series being backtested, loaded before the workers are forked so that
+# they share them
+_series = []
+_analyzer = TalosAnalyzer
+
+
+def parseValues(name, value):
+    """Returns the list of values in a comma separated string"""
+    kind = dict(PARAMS)[name]
+    try:
+        return [kind(v) for v in value.split(",") if v.strip()]
+    except ValueError:
+        raise ValueError("Bad %s values %r" % (name, value))
+
+
+def configurations(grid):
+    """Returns every combination of the values in grid, {name: [value,
+    ...]}, as tuples of parameters in PARAMS order"""
+    return list(itertools.product(*[grid[name] for name, kind in PARAMS]))
+
+
+def backtestSeries(data, params, analyzer=TalosAnalyzer):
+    """Analyzes one series with params.  Returns its counts and the delays
+    (in seconds) before each regression warning could have gone out"""
+    back_window, fore_window = params[0], params[1]
+    a = analyzer()
+    a.addData(data)
+    t = time.time()
+    results = list(a.analyze_t(*params))
+    elapsed = time.time() - t
+
+    counts = {'points': len(results), 'good': 0, 'regression': 0, 'machine': 0, 'warnings': 0}
+    delays = []
+    last_good = last_err = last_err_good = None
+    for n, (d, state) in enumerate(results):
+        counts[state] += 1
+        if state == "good":
+            last_err = None
+            last_good = d
+            continue
+        # Consecutive warnings after the same good point are only sent once,
+        # as in AnalysisRunner.reportSeries
+        if not last_err:
+            last_err = d
+            last_err_good = last_good
+        elif last_err_good == last_good:
+            continue
+        if state == "regression":
+            counts['warnings'] += 1
+            # Point n of the results is back_window + n of the data, and it's
+            # classified once the last point of its fore window comes in
+            delays.append(a.data[back_window + n + fore_window - 1].timestamp - d.timestamp)
+    return counts, delays, elapsed
+
+
+def _backtest(task):
+    config_index, params, series_index = task
+    counts, delays, elapsed = backtestSeries(_series[series_index], params, _analyzer)
+    return config_index, counts, delays, elapsed
+
+
+class Backtest:
+    def __init__(self, series, configs, jobs=None, analyzer=TalosAnalyzer):
+        """series is a list of PerfSeries, and configs a list of parameter
+        tuples in PARAMS order"""
+        self.series = series
+        self.configs = configs
+        self.jobs = jobs
+        self.analyzer = analyzer
+
+    def run(self):
+        """Returns a summary dict for each configuration, in order"""
+        global _series, _analyzer
+        _series, _analyzer = self.series, self.analyzer
+        tasks = [(c, params, i) for c, params in enumerate(self.configs)
+                 for i in range(len(self.series))]
+
+        summaries = []
+        for params in self.configs:
+            summary = dict(zip([name for name, kind in PARAMS], params))
+            summary.update({'series': len(self.series), 'points': 0, 'good': 0,
+                            'regression': 0, 'machine': 0, 'warnings': 0, 'seconds': 0.0,
+                            'delays': []})
+            summaries.append(summary)
+
+        start = time.time()
+        if self.jobs and self.jobs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                chunksize = max(1, len(tasks) // (self.jobs * 4))
+                for result in pool.imap_unordered(_backtest, tasks, chunksize):
+                    self._add(summaries, result)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for task in tasks:
+                self._add(summaries, _backtest(task))
+        log.info("Backtested %i configurations on %i series in %.1fs",
+                 len(self.configs), len(self.series), time.time() - start)
+
+        for summary in summaries:
+            delays = summary.pop('delays')
+            summary['median_delay'] = median(delays)
+            summary['mean_delay'] = None
+            if delays:
+                summary['mean_delay'] = float(sum(delays)) / len(delays)
+        return summaries
+
+    def _add(self, summaries, result):
+        config_index, counts, delays, elapsed = result
+        summary = summaries[config_index]
+        for name, count in counts.items():
+            summary[name] += count
+        summary['delays'].extend(delays)
+        summary['seconds'] += elapsed
+
+
+def formatHours(seconds):
+    if seconds is None:
+        return "-"
+    return "%.1fh" % (seconds / 3600.0)
+
+
+def printSummaries(summaries, out=sys.stdout):
+    columns = ["back", "fore", "thresh", "m_thresh", "m_hist", "regress", "machine",
+               "warnings", "med.delay", "mean.delay", "seconds"]
+    print >> out, " ".join("%9s" % c for c in columns)
+    for s in summaries:
+        row = [s['back_window'], s['fore_window'], "%g" % s['threshold'],
+               "%g" % s['machine_threshold'], s['machine_history_size'],
+               s['regression'], s['machine'], s['warnings'],
+               formatHours(s['median_delay']), formatHours(s['mean_delay']),
+               "%.2f" % s['seconds']]
+        print >> out, " ".join("%9s" % v for v in row)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    from ConfigParser import RawConfigParser
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-c", "--config", dest="config", default="analysis.cfg",
+                      help="config file for the parameters that aren't given")
+    parser.add_option("-s", "--snapshot", dest="snapshot",
+                      help="snapshot directory (default: the config's snapshot_dir)")
+    parser.add_option("-b", "--branch", dest="branches", action="append", default=[])
+    parser.add_option("-t", "--test", dest="tests", action="append", default=[])
+    parser.add_option("", "--start-time", dest="start_time", type="int", default=0,
+                      help="timestamp for when we start looking at data")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="how many processes to use")
+    parser.add_option("", "--vectorized", dest="vectorized", action="store_true",
+                      help="Analyze series with numpy")
+    parser.add_option("", "--json", dest="json", help="also write the results to this file")
+    parser.add_option("-v", "--verbose", dest="verbosity", action="store_const",
+                      const=log.DEBUG, default=log.INFO)
+    for name, kind in PARAMS:
+        parser.add_option("--" + name.replace("_", "-"), dest=name,
+                          help="comma separated %s values to try" % name)
+    options, args = parser.parse_args()
+    log.basicConfig(level=options.verbosity, format="%(asctime)s %(message)s")
+
+    config = RawConfigParser()
+    config.read([options.config])
+
+    grid = {}
+    try:
+        for name, kind in PARAMS:
+            value = getattr(options, name)
+            if value is None:
+                if not config.has_option('main', name):
+                    parser.error("No %s values given or in %s" % (name, options.config))
+                value = config.get('main', name)
+            grid[name] = parseValues(name, value)
+    except ValueError, e:
+        parser.error(str(e))
+
+    snapshot = options.snapshot
+    if not snapshot and config.has_option('main', 'snapshot_dir'):
+        snapshot = config.get('main', 'snapshot_dir')
+    if not snapshot:
+        parser.error("No snapshot given")
+    branches = options.branches
+    if not branches:
+        branches = [s for s in config.sections() if s not in ('main', 'cache', 'dashboard', 'os')]
+
+    source = SnapshotSource(snapshot)
+    if not branches:
+        branches = sorted(set(s.branch_name for s in source.series))
+    series = source.getTestSeries(branches, options.start_time, options.tests)
+    data = [source.getTestData(s, options.start_time) for s in series]
+    log.info("Loaded %i runs of %i series", sum(len(d) for d in data), len(series))
+
+    analyzer = TalosAnalyzer
+    if options.vectorized:
+        from analyze_numpy import NumpyTalosAnalyzer
+        analyzer = NumpyTalosAnalyzer
+    summaries = Backtest(data, configurations(grid), options.jobs, analyzer).run()
+    printSummaries(summaries)
+    if options.json:
+        json.dump(summaries, open(options.json, "w"), indent=1, sort_keys=True)
@@ -0,0 +1,387 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Benchmarks the stages of the analysis on synthetic series.
+
+    python benchmark.py --length 5000 --machines 6 --steps 3
+
+times each stage (analyze, calc_t, addData, analyze_t, the numpy analyze_t
+when numpy is there, and AnalysisRunner.handleSeries end to end over a
+snapshot and a local pushlog server), and reports its throughput in points
+per second and its peak memory.  Each stage runs in a fresh process, so the
+memory one stage leaves behind isn't counted against the next.
+
+Results are appended to a JSON history file.  A run fails (exit status 1)
+if a stage's throughput drops, or its memory grows, by more than the
+tolerance compared to the median of the last few runs with the same
+parameters."""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from analyze import PerfSeries, TalosAnalyzer, analyze, calc_t, median, numpy
+from datasource import DataSource, TestSeries
+
+STAGES = ['analyze', 'calc_t', 'addData', 'analyze_t', 'analyze_t_numpy', 'handleSeries']
+
+# The analysis parameters the stages run with, as in analysis.cfg.template
+BACK_WINDOW = 30
+FORE_WINDOW = 5
+THRESHOLD = 9.0
+MACHINE_THRESHOLD = 15.0
+MACHINE_HISTORY_SIZE = 5
+
+# Memory growth below this many kB is noise, whatever the tolerance
+MEMORY_SLACK = 1024
+
+# How long each timing of a stage runs it for, in seconds
+MIN_TIME = 0.2
+
+# How many of the last matching runs the baseline is the median of
+BASELINE_RUNS = 5
+
+
+def syntheticSeries(length, machines=3, noise=1.0, steps=0, seed=0, interval=600, end=None):
+    """Returns a PerfSeries of length runs, one every interval seconds up to
+    end, cycling through machines.  Values are 100 plus gaussian noise with
+    a standard deviation of noise, and steps is how many times the level
+    jumps, by 5 to 20 times the noise, at random points.  Run i is of push
+    i, whose revision is "%012x" % i"""
+    rnd = random.Random(seed)
+    if end is None:
+        end = int(time.time())
+    start = end - length * interval
+    jumps = sorted(rnd.randrange(length) for i in range(steps))
+    level = 100.0
+    data = PerfSeries()
+    for i in xrange(length):
+        while jumps and jumps[0] == i:
+            jumps.pop(0)
+            level += rnd.choice((-1, 1)) * rnd.uniform(5, 20) * noise
+        t = start + i * interval
+        data.append(i + 1, i % machines + 1, t, level + rnd.gauss(0, noise), i + 1, t,
+                    "%012x" % i, 0)
+    return data
+
+
+class SyntheticSource(DataSource):
+    """count synthetic series of one test on one branch, on as many
+    platforms"""
+    def __init__(self, count, **kw):
+        self.series = [TestSeries(1, "Bench", os_id, "os%i" % os_id, 1, "Ts", "ts")
+                       for os_id in range(1, count + 1)]
+        self.data = dict((s, syntheticSeries(seed=s.os_id, **kw)) for s in self.series)
+
+    def getTestSeries(self, branches, start_time, test_names, last_run=None):
+        return list(self.series)
+
+    def getTestData(self, series, start_time, after_id=None):
+        return self.data[series]
+
+    def getMachineName(self, machine_id):
+        return "talos-bench-%i" % machine_id
+
+
+def pushesHandler(interval, end):
+    """A json-pushes handler with a push per revision of syntheticSeries"""
+    def handler(method, path, query, body):
+        pushes = {}
+        for c in query.get('changeset', []):
+            i = int(c, 16)
+            pushes[str(i + 1)] = {'user': "bench@example.com",
+                                  'date': end - (i + 1) * interval,
+                                  'changesets': [{'node': c, 'desc': "Push %i" % i,
+                                                  'author': "bench@example.com"}]}
+        return 200, pushes
+    return handler
+
+
+def runAnalyze(data):
+    values = data.values
+    for i in xrange(BACK_WINDOW, len(values)):
+        analyze(values[i - BACK_WINDOW:i])
+    return len(values) - BACK_WINDOW
+
+
+def runCalcT(data):
+    values = data.values
+    for i in xrange(BACK_WINDOW, len(values) - FORE_WINDOW + 1):
+        calc_t(values[i - BACK_WINDOW:i], values[i:i + FORE_WINDOW])
+    return len(values) - BACK_WINDOW - FORE_WINDOW + 1
+
+
+def runAddData(data):
+    TalosAnalyzer().addData(data)
+    return len(data)
+
+
+def runAnalyzeT(analyzer):
+    def run(a):
+        return len(list(a.analyze_t(BACK_WINDOW, FORE_WINDOW, THRESHOLD,
+                                    MACHINE_THRESHOLD, MACHINE_HISTORY_SIZE)))
+
+    def prepare(data):
+        a = analyzer()
+        a.addData(data)
+        return a
+    return prepare, run
+
+
+class RunnerStage:
+    """Runs AnalysisRunner.handleSeries over a snapshot of params['series']
+    synthetic series, with the pushes served from a local server"""
+    def __init__(self, params):
+        from ConfigParser import RawConfigParser
+        from optparse import Values
+        from analyze_snapshot import writeSnapshot
+        from stubserver import StubServer
+
+        self.dir = tempfile.mkdtemp(prefix="benchmark")
+        self.points = params['series'] * params['length']
+        end = int(time.time())
+        source = SyntheticSource(params['series'], length=params['length'],
+                                 machines=params['machines'], noise=params['noise'],
+                                 steps=params['steps'], end=end)
+        writeSnapshot(source, os.path.join(self.dir, "snapshot"), ["Bench"], 0, [])
+        self.server = StubServer(pushesHandler(600, end))
+
+        config = self.config = RawConfigParser()
+        for section in ('main', 'cache', 'Bench'):
+            config.add_section(section)
+        for name, value in [('source', 'snapshot'), ('snapshot_dir', os.path.join(self.dir, "snapshot")),
+                            ('base_hg_url', self.server.url), ('base_graph_url', "http://graphs"),
+                            ('fore_window', FORE_WINDOW), ('back_window', BACK_WINDOW),
+                            ('threshold', THRESHOLD), ('machine_threshold', MACHINE_THRESHOLD),
+                            ('machine_history_size', MACHINE_HISTORY_SIZE)]:
+            config.set('main', name, str(value))
+        config.set('cache', 'pushlog', os.path.join(self.dir, "pushlog.json"))
+        config.set('cache', 'warning_history', os.path.join(self.dir, "warning_history.json"))
+        config.set('Bench', 'repo_path', "bench")
+        self.options = Values({'branches': ["Bench"], 'tests': [], 'output': os.devnull,
+                               'verbosity': log.WARN, 'start_time': 0, 'catchup': False,
+                               'jobs': None, 'vectorized': False})
+        # Fill the pushlog cache, so that the timed runs don't wait on it
+        runner = self.runner()
+        log.getLogger().setLevel(log.WARN)
+        self.run(runner)
+        runner.pushlog.save()
+
+    def runner(self):
+        from analyze_talos import AnalysisRunner
+        runner = AnalysisRunner(self.options, self.config)
+        runner.series = runner.source.getTestSeries(["Bench"], 0, [])
+        return runner
+
+    def run(self, runner):
+        for s in runner.series:
+            runner.handleSeries(s)
+        return self.points
+
+    def close(self):
+        self.server.stop()
+        shutil.rmtree(self.dir, True)
+
+
+def _memory():
+    """Returns (current, peak) resident memory in kB, or Nones where /proc
+    isn't there"""
+    current = peak = None
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("VmRSS:"):
+                current = int(line.split()[1])
+            elif line.startswith("VmHWM:"):
+                peak = int(line.split()[1])
+    except IOError:
+        pass
+    return current, peak
+
+
+def _resetPeak():
+    """Starts the peak resident memory over from the current one"""
+    try:
+        open("/proc/self/clear_refs", "w").write("5")
+        return True
+    except IOError:
+        return False
+
+
+def runStage(stage, params):
+    """Times a stage params['repeat'] times, each time running it over and
+    over for at least MIN_TIME seconds.  Returns {'points' (in one pass),
+    'seconds' (per pass), 'rate' (the best points per second), 'peak_kb'
+    (the most memory a pass took above what it started with, or None if
+    that's unknown)}"""
+    close = None
+    if stage == 'handleSeries':
+        r = RunnerStage(params)
+        prepare, run, close = lambda data: r.runner(), r.run, r.close
+        data = None
+    else:
+        data = syntheticSeries(params['length'], params['machines'], params['noise'],
+                               params['steps'], params['seed'])
+        prepare = lambda data: data
+        run = {'analyze': runAnalyze, 'calc_t': runCalcT, 'addData': runAddData}.get(stage)
+        if stage == 'analyze_t':
+            prepare, run = runAnalyzeT(TalosAnalyzer)
+        elif stage == 'analyze_t_numpy':
+            from analyze_numpy import NumpyTalosAnalyzer
+            prepare, run = runAnalyzeT(NumpyTalosAnalyzer)
+
+    try:
+        best = None
+        peak_kb = None
+        for i in range(params['repeat']):
+            points = elapsed = passes = 0
+            while elapsed < MIN_TIME or not passes:
+                arg = prepare(data)
+                can_reset = _resetPeak()
+                start_kb = _memory()[0]
+                t = time.time()
+                points = run(arg)
+                elapsed += time.time() - t
+                passes += 1
+                peak = _memory()[1]
+                if can_reset and peak is not None and start_kb is not None:
+                    peak_kb = max(peak_kb, peak - start_kb)
+                del arg
+            rate = points * passes / max(elapsed, 1e-9)
+            best = max(best, rate)
+    finally:
+        if close is not None:
+            close()
+    return {'points': points, 'seconds': points / best, 'rate': best, 'peak_kb': peak_kb}
+
+
+def runStages(stages, params):
+    """Runs each stage in a process of its own.  Returns {stage: result}"""
+    import multiprocessing
+    results = {}
+    for stage in stages:
+        pool = multiprocessing.Pool(1)
+        try:
+            results[stage] = pool.apply(runStage, (stage, params))
+        finally:
+            pool.terminate()
+            pool.join()
+        log.debug("%s: %r", stage, results[stage])
+    return results
+
+
+def loadHistory(filename):
+    if not os.path.exists(filename):
+        return []
+    return json.load(open(filename))
+
+
+def saveHistory(filename, history):
+    tmp = filename + ".tmp"
+    json.dump(history, open(tmp, "w"), indent=1, sort_keys=True)
+    os.rename(tmp, filename)
+
+
+def baseline(history, params):
+    """Returns {stage: {'rate', 'peak_kb'}} with the medians of the last
+    BASELINE_RUNS runs in history with the same params"""
+    runs = [h['results'] for h in history if h['params'] == params][-BASELINE_RUNS:]
+    retval = {}
+    for stage in STAGES:
+        found = [r[stage] for r in runs if stage in r]
+        if not found:
+            continue
+        retval[stage] = {'rate': median([r['rate'] for r in found]), 'peak_kb': None}
+        peaks = [r['peak_kb'] for r in found if r['peak_kb'] is not None]
+        if peaks:
+            retval[stage]['peak_kb'] = median(peaks)
+    return retval
+
+
+def compare(results, base, tolerance):
+    """Returns a description of each way results are worse than base by
+    more than tolerance (a fraction)"""
+    problems = []
+    for stage in STAGES:
+        if stage not in results or stage not in base:
+            continue
+        r, b = results[stage], base[stage]
+        if r['rate'] < b['rate'] * (1 - tolerance):
+            problems.append("%s: %.0f points/s, down from %.0f" % (stage, r['rate'], b['rate']))
+        if r['peak_kb'] is not None and b['peak_kb'] is not None and \
+                r['peak_kb'] > b['peak_kb'] * (1 + tolerance) + MEMORY_SLACK:
+            problems.append("%s: %i kB peak, up from %i kB" % (stage, r['peak_kb'], b['peak_kb']))
+    return problems
+
+
+def printResults(results, base, out=sys.stdout):
+    print >> out, "%-16s %9s %10s %13s %10s %10s" % ("stage", "points", "seconds", "points/s",
+                                                    "peak kB", "vs. base")
+    for stage in STAGES:
+        if stage not in results:
+            continue
+        r = results[stage]
+        change = "-"
+        if stage in base:
+            change = "%+.1f%%" % ((r['rate'] / base[stage]['rate'] - 1) * 100)
+        peak = "-"
+        if r['peak_kb'] is not None:
+            peak = "%i" % r['peak_kb']
+        print >> out, "%-16s %9i %10.4f %13.0f %10s %10s" % (stage, r['points'], r['seconds'],
+                                                             r['rate'], peak, change)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] [STAGE ...]")
+    parser.add_option("--length", dest="length", type="int", default=2000,
+                      help="runs per series")
+    parser.add_option("--machines", dest="machines", type="int", default=4)
+    parser.add_option("--noise", dest="noise", type="float", default=1.0,
+                      help="standard deviation of the values")
+    parser.add_option("--steps", dest="steps", type="int", default=3,
+                      help="how many times each series' level changes")
+    parser.add_option("--series", dest="series", type="int", default=4,
+                      help="how many series handleSeries runs over")
+    parser.add_option("--seed", dest="seed", type="int", default=0)
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="how many times to time each stage, keeping the best")
+    parser.add_option("--history", dest="history", default="benchmark_history.json",
+                      help="JSON file to compare with and add the results to")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.25,
+                      help="fraction a stage may get slower or bigger by before failing")
+    parser.add_option("--no-record", dest="record", action="store_false", default=True,
+                      help="don't add the results to the history")
+    parser.add_option("-v", "--verbose", dest="verbosity", action="store_const",
+                      const=log.DEBUG, default=log.INFO)
+    options, stages = parser.parse_args()
+    log.basicConfig(level=options.verbosity, format="%(asctime)s %(message)s")
+
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("Unknown stage %s; stages are %s" % (stage, ", ".join(STAGES)))
+    if not stages:
+        stages = [s for s in STAGES if s != 'analyze_t_numpy' or numpy is not None]
+
+    params = dict((name, getattr(options, name)) for name in
+                  ('length', 'machines', 'noise', 'steps', 'series', 'seed', 'repeat'))
+    results = runStages(stages, params)
+
+    history = loadHistory(options.history)
+    base = baseline(history, params)
+    printResults(results, base)
+    problems = compare(results, base, options.tolerance)
+    if options.record:
+        history.append({'time': int(time.time()), 'params': params, 'results': results})
+        saveHistory(options.history, history)
+    if problems:
+        for problem in problems:
+            print "REGRESSION: %s" % problem
+        sys.exit(1)
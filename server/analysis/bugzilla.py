@@ -0,0 +1,188 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""A client for the Bugzilla REST API.
+
+Requests go over kept-alive connections, bugs are fetched many to a
+request, and bugs and comments are cached (on disk, with a BugCache) for a
+while so that later runs don't look them up again."""
+import os
+import time
+import urllib
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from httpfetch import ConnectionPool
+
+# How many bugs to ask for in one request
+BATCH_SIZE = 100
+
+
+class BugzillaError(Exception):
+    pass
+
+
+class BugCache:
+    """Bugs and bug comments with when they were fetched, kept in a JSON
+    file when filename is given"""
+    def __init__(self, filename=None, ttl=24*3600, comment_ttl=3600):
+        self.filename = filename
+        self.ttl = ttl
+        self.comment_ttl = comment_ttl
+        self.entries = {'bugs': {}, 'comments': {}}
+        self.dirty = False
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            entries = json.load(open(self.filename))
+        except:
+            log.exception("Couldn't load bugs from %s", self.filename)
+            return
+        now = time.time()
+        for kind, ttl in (('bugs', self.ttl), ('comments', self.comment_ttl)):
+            for key, (fetched, value) in entries.get(kind, {}).items():
+                if now - fetched < ttl:
+                    self.entries[kind][key] = (fetched, value)
+
+    def save(self):
+        if not self.filename or not self.dirty:
+            return
+        tmp = self.filename + ".tmp"
+        json.dump(self.entries, open(tmp, "w"))
+        os.rename(tmp, self.filename)
+        self.dirty = False
+
+    def get(self, kind, bug_num):
+        entry = self.entries[kind].get(str(bug_num))
+        if entry is None:
+            return None
+        ttl = kind == 'bugs' and self.ttl or self.comment_ttl
+        if time.time() - entry[0] >= ttl:
+            return None
+        return entry[1]
+
+    def put(self, kind, bug_num, value):
+        self.entries[kind][str(bug_num)] = (time.time(), value)
+        self.dirty = True
+
+    def forget(self, kind, bug_num):
+        if self.entries[kind].pop(str(bug_num), None) is not None:
+            self.dirty = True
+
+
+class BugzillaClient:
+    def __init__(self, api, username=None, password=None, cache=None, pool=None):
+        self.api = api.rstrip("/")
+        self.username = username
+        self.password = password
+        if cache is None:
+            cache = BugCache()
+        self.cache = cache
+        if pool is None:
+            pool = ConnectionPool(1)
+        self.pool = pool
+
+    def request(self, path, data=None, method=None, auth=False, params={}):
+        params = dict(params)
+        if auth and self.username and self.password:
+            params['username'] = self.username
+            params['password'] = self.password
+        url = self.api + path
+        if params:
+            url += "?" + urllib.urlencode(sorted(params.items()))
+        if data is not None:
+            data = json.dumps(data)
+        if method is None:
+            method = data is None and 'GET' or 'POST'
+        status, body = self.pool.request(url, method, data,
+                {'Accept': 'application/json', 'Content-Type': 'application/json'})
+        try:
+            result = json.loads(body)
+        except ValueError:
+            result = None
+        if not 200 <= status < 300:
+            raise BugzillaError("%s %s returned %s: %s" % (method, path, status, body[:200]))
+        if isinstance(result, dict) and result.get('error'):
+            raise BugzillaError("%s %s failed: %s" % (method, path, result))
+        return result
+
+    def getBugs(self, bug_nums):
+        """Returns {bug_num: bug} for the bugs that could be found"""
+        retval = {}
+        missing = []
+        for bug_num in bug_nums:
+            bug = self.cache.get('bugs', bug_num)
+            if bug is not None:
+                retval[bug_num] = bug
+            elif bug_num not in missing:
+                missing.append(bug_num)
+        for i in range(0, len(missing), BATCH_SIZE):
+            chunk = missing[i:i+BATCH_SIZE]
+            try:
+                result = self.request("/bug", params={'id': ",".join(str(b) for b in chunk)})
+                bugs = result['bugs']
+            except KeyboardInterrupt:
+                raise
+            except:
+                log.exception("Error fetching bugs %s", chunk)
+                continue
+            for bug in bugs:
+                bug_num = int(bug['id'])
+                self.cache.put('bugs', bug_num, bug)
+                retval[bug_num] = bug
+        return retval
+
+    def getBug(self, bug_num):
+        return self.getBugs([bug_num]).get(bug_num)
+
+    def getComments(self, bug_num):
+        """Returns the bug's comments, or None if they can't be fetched"""
+        comments = self.cache.get('comments', bug_num)
+        if comments is not None:
+            return comments
+        try:
+            comments = self.request("/bug/%s/comment" % bug_num)
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("Error fetching comments for bug %s", bug_num)
+            return None
+        self.cache.put('comments', bug_num, comments)
+        return comments
+
+    def notifyBug(self, bug_num, message, whiteboard, retries=5):
+        """Adds whiteboard to the bug's status whiteboard, and message as a
+        comment"""
+        for i in range(retries):
+            log.debug("Getting bug %s", bug_num)
+            bug = self.request("/bug/%s" % bug_num, auth=True)
+
+            wb = bug.get('whiteboard', '')
+
+            if whiteboard not in wb:
+                bug['whiteboard'] = wb + whiteboard
+                if i == 0:
+                    bug['last_change_time'] = "2009-09-09T16:31:18Z"
+
+                # Add the whiteboard
+                try:
+                    log.debug("Adding whiteboard status to bug %s", bug_num)
+                    self.request("/bug/%s" % bug_num, bug, "PUT", auth=True)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    log.exception("Problem changing whiteboard, trying again")
+                    continue
+
+            # Add the comment
+            log.debug("Adding comment to bug %s", bug_num)
+            self.request("/bug/%s/comment" % bug_num,
+                    {"text": message, "is_private": False}, "POST", auth=True)
+            break
+        self.cache.forget('bugs', bug_num)
+        self.cache.forget('comments', bug_num)
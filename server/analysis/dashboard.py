@@ -0,0 +1,244 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""The data behind the perf dashboard.
+
+Dashboard keeps the last week of results of each machine for the dashboard's
+tests, fed with the points the analysis already has, and can keep them
+between runs so that only new runs need adding.  The data is written out as
+testdata.js, which lists the branches, and a testdata-<branch>.js for each
+branch, which the dashboard loads for the branch it shows."""
+import os
+import re
+import time
+import bisect
+import shutil
+import cPickle as pickle
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+def parseTests(value):
+    """Splits the [dashboard] tests option, a comma separated list where
+    commas in test names are escaped with \\"""
+    tests = []
+    for t in re.split(r"(?<!\\),", value):
+        tests.append(t.replace("\\,", ",").strip())
+    return tests
+
+
+def dashboardName(test_name):
+    # We want to merge the Tp3 (Memset) and Tp3 (RSS) results together
+    # for the dashboard, since they're just different names for the
+    # same thing on different platforms
+    if test_name == "Tp3 (Memset)":
+        return "Tp3 (RSS)"
+    elif test_name == "Tp4 (Memset)":
+        return "Tp4 (RSS)"
+    return test_name
+
+
+def shortFloat(f):
+    # Don't pretend we have double precision here; 8 digits of precision is
+    # plenty
+    return float("%.8g" % f)
+
+
+class MachineWindow:
+    """A machine's recent (timestamp, value) points, in timestamp order, with
+    their total, lowest and highest value kept as points come and go"""
+    def __init__(self):
+        self.points = []
+        self.total = 0.0
+        self.lo = None
+        self.hi = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, timestamp, value):
+        bisect.insort(self.points, (timestamp, value))
+        self.total += value
+        if self.lo is None or value < self.lo:
+            self.lo = value
+        if self.hi is None or value > self.hi:
+            self.hi = value
+
+    def expire(self, cutoff):
+        """Drops the points from before cutoff"""
+        cut = bisect.bisect_left(self.points, (cutoff,))
+        if not cut:
+            return
+        expired = [v for t, v in self.points[:cut]]
+        del self.points[:cut]
+        if self.lo in expired or self.hi in expired or not self.points:
+            values = [v for t, v in self.points]
+            self.total = float(sum(values))
+            self.lo = self.hi = None
+            if values:
+                self.lo = min(values)
+                self.hi = max(values)
+        else:
+            self.total -= sum(expired)
+
+    def stats(self):
+        """Returns [average, highest, lowest]"""
+        return [self.total / len(self.points), self.hi, self.lo]
+
+
+class Dashboard:
+    def __init__(self, dirname, tests, state_file=None, days=7, html_dir="html"):
+        self.dirname = dirname
+        self.tests = tests
+        self.state_file = state_file
+        self.window = days * 24 * 3600
+        self.html_dir = html_dir
+        # (test_id, branch_id, os_id) -> {'branch': branch name, 'test':
+        # test name, 'os': os name, 'graph_url': url, 'last_id': the
+        # greatest test run id added, 'machines': {machine_id: MachineWindow}}
+        self.series = {}
+        # The series brought up to date this run
+        self.updated = set()
+
+    def load(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            self.series = pickle.load(open(self.state_file, "rb"))
+        except:
+            log.exception("Couldn't load dashboard data from %s", self.state_file)
+            self.series = {}
+
+    def save(self):
+        if not self.state_file:
+            return
+        tmp = self.state_file + ".tmp"
+        pickle.dump(self.series, open(tmp, "wb"), pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.state_file)
+
+    def wants(self, test_name):
+        return test_name in self.tests
+
+    def _key(self, s):
+        return (s.test_id, s.branch_id, s.os_id)
+
+    def lastId(self, s):
+        """Returns the greatest test run id added for the series, or None if
+        it has no data"""
+        entry = self.series.get(self._key(s))
+        if entry is None:
+            return None
+        return entry['last_id']
+
+    def isUpdated(self, s):
+        return self._key(s) in self.updated
+
+    def addSeries(self, s, data, graph_url, replace=False):
+        """Adds the points of data that are newer than the ones the series
+        has, or replaces its points with them"""
+        key = self._key(s)
+        entry = self.series.get(key)
+        if entry is None or replace:
+            entry = self.series[key] = {'last_id': -1, 'machines': {}}
+        entry['branch'] = s.branch_name
+        entry['test'] = dashboardName(s.test_name)
+        entry['os'] = s.os_name
+        entry['graph_url'] = graph_url
+
+        cutoff = time.time() - self.window
+        after_id = entry['last_id']
+        machines = entry['machines']
+        for d in data:
+            if d.testrun_id <= after_id:
+                continue
+            entry['last_id'] = max(entry['last_id'], d.testrun_id)
+            if d.timestamp < cutoff:
+                continue
+            if d.machine_id not in machines:
+                machines[d.machine_id] = MachineWindow()
+            machines[d.machine_id].add(d.timestamp, d.value)
+        self.updated.add(key)
+
+    def buildData(self, getMachineName):
+        """Returns {branch: {test: {os: {machine name: {'results': [time,
+        value, ...], 'stats': [avg, max, min]}}}}} for the last week"""
+        cutoff = time.time() - self.window
+        cells = {}
+        for key in sorted(self.series):
+            entry = self.series[key]
+            for machine_id, w in entry['machines'].items():
+                w.expire(cutoff)
+                if not w:
+                    del entry['machines'][machine_id]
+            if not entry['machines']:
+                continue
+            tests = cells.setdefault(entry['branch'], {})
+            oses = tests.setdefault(entry['test'], {'_testid': key[0]})
+            cell = oses.setdefault(entry['os'], {'_platformid': key[2], '_graphURL': entry['graph_url']})
+            for machine_id, w in entry['machines'].items():
+                machine_name = getMachineName(machine_id)
+                if machine_name is None:
+                    continue
+                cell.setdefault(machine_name, []).append(w)
+
+        for tests in cells.values():
+            for oses in tests.values():
+                for os_name, cell in oses.items():
+                    if os_name.startswith("_"):
+                        continue
+                    for machine_name, windows in cell.items():
+                        if machine_name.startswith("_"):
+                            continue
+                        if len(windows) == 1:
+                            points = windows[0].points
+                            stats = windows[0].stats()
+                        else:
+                            points = sorted(p for w in windows for p in w.points)
+                            stats = [sum(w.total for w in windows) / len(points),
+                                     max(w.hi for w in windows),
+                                     min(w.lo for w in windows)]
+                        results = []
+                        for t, v in points:
+                            results.append(t)
+                            results.append(shortFloat(v))
+                        cell[machine_name] = {
+                                'results': results,
+                                'stats': [shortFloat(v) for v in stats],
+                                }
+        return cells
+
+    def shardName(self, branch):
+        return "testdata-%s.js" % re.sub(r"[^\w.-]", "_", branch)
+
+    def _writeFile(self, filename, data):
+        filename = os.path.join(self.dirname, filename)
+        fp = open(filename + ".tmp", "w")
+        fp.write(data)
+        fp.close()
+        os.rename(filename + ".tmp", filename)
+
+    def output(self, getMachineName):
+        log.debug("Creating dashboard")
+        if not os.path.exists(self.dirname):
+            # Copy in the rest of html
+            shutil.copytree(os.path.join(self.html_dir, 'dashboard'), self.dirname)
+            shutil.copytree(os.path.join(self.html_dir, 'flot'), '%s/flot' % self.dirname)
+            shutil.copytree(os.path.join(self.html_dir, 'jquery'), '%s/jquery' % self.dirname)
+
+        cells = self.buildData(getMachineName)
+        shards = {}
+        for branch, tests in sorted(cells.items()):
+            shards[branch] = self.shardName(branch)
+            self._writeFile(shards[branch], "gData[%s] = %s;\n" % (
+                json.dumps(branch), json.dumps(tests, separators=(',',':'), sort_keys=True)))
+
+        # The index goes last, so it only lists branches that are written
+        now = time.asctime()
+        index = ["// Generated at %s\n" % now]
+        index.append("gFetchTime = %s;\n" % json.dumps(now))
+        index.append("var gData = %s;\n" % json.dumps(dict((b, None) for b in shards), sort_keys=True))
+        index.append("var gShards = %s;\n" % json.dumps(shards, sort_keys=True))
+        self._writeFile('testdata.js', "".join(index))
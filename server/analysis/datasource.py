@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Where the analysis gets its test data from.
+
+A DataSource finds the series to analyze and loads their runs.  There are
+three: DBSource reads the graph server database (analyze_db),
+GraphAPISource a graph server's web API (analyze_graphapi), and
+SnapshotSource columnar files written from either (analyze_snapshot).
+openSource() makes the one the config's [main] source option names."""
+
+
+class TestSeries:
+    def __init__(self, branch_id, branch_name, os_id, os_name, test_id, test_name, test_shortname):
+        self.branch_id = branch_id
+        self.branch_name = branch_name
+        self.os_id = os_id
+        self.os_name = os_name
+        self.test_id = test_id
+        self.test_name = test_name
+        self.test_shortname = test_shortname
+
+    def __eq__(self, o):
+        return (self.branch_id, self.os_id, self.test_id) == (o.branch_id, o.os_id, o.test_id)
+
+    def __hash__(self):
+        return hash((self.branch_id, self.os_id, self.test_id))
+
+    def __str__(self):
+        return "%s %s %s" % (self.branch_name, self.os_name, self.test_shortname)
+
+
+class DataSource:
+    """The methods AnalysisRunner uses.  Sources may also have
+    prefetchTestData(series, start_time, partitions, after_id), to load the
+    runs of many series at once, and preloadMachines(), to look up every
+    machine's name at once."""
+
+    def connect(self):
+        """Sets up connections; called again in each worker process"""
+        pass
+
+    def getTestSeries(self, branches, start_time, test_names, last_run=None):
+        """Returns the TestSeries on branches with runs since start_time (and
+        with an id greater than last_run, if given), of test_names or of
+        every test if that's empty"""
+        raise NotImplementedError
+
+    def getTestData(self, series, start_time, after_id=None):
+        """Returns the runs of series after start_time as a PerfSeries; with
+        after_id, only the runs with a greater id"""
+        raise NotImplementedError
+
+    def getMachinesForTest(self, series):
+        """Returns the ids of the machines that have run series"""
+        raise NotImplementedError
+
+    def getMachineName(self, machine_id):
+        raise NotImplementedError
+
+
+def openSource(config):
+    """Returns the DataSource the config's [main] source option names: db
+    (the default, using dburl), graphapi (using graph_api_url, and
+    graph_export_url if it's set) or snapshot (using snapshot_dir)"""
+    kind = 'db'
+    if config.has_option('main', 'source'):
+        kind = config.get('main', 'source')
+    if kind == 'db':
+        from analyze_db import DBSource
+        return DBSource(config.get('main', 'dburl'))
+    elif kind == 'graphapi':
+        from analyze_graphapi import GraphAPISource
+        export_url = None
+        if config.has_option('main', 'graph_export_url'):
+            export_url = config.get('main', 'graph_export_url')
+        return GraphAPISource(config.get('main', 'graph_api_url'), export_url)
+    elif kind == 'snapshot':
+        from analyze_snapshot import SnapshotSource
+        return SnapshotSource(config.get('main', 'snapshot_dir'))
+    raise ValueError("Unknown source %r" % kind)
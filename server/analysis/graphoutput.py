@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Writing out the static regression graph pages.
+
+GraphWriter writes each series' page and flot data on a pool of threads
+while the analysis carries on.  Files are only written when their content
+has changed since the last run, going by hashes kept in graph_dir, so an
+unchanged series doesn't touch its files."""
+import os
+import math
+import shutil
+import hashlib
+import threading
+import Queue
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+def downsample(points, max_points):
+    """Thins [(x, y), ...] out to about max_points, keeping the lowest and
+    highest point of each stretch so that spikes still show"""
+    if not max_points or len(points) <= max_points:
+        return points
+    size = int(math.ceil(len(points) / (max_points / 2.0)))
+    retval = []
+    for i in range(0, len(points), size):
+        indexes = range(i, min(i + size, len(points)))
+        lo = min(indexes, key=lambda k: points[k][1])
+        hi = max(indexes, key=lambda k: points[k][1])
+        for k in sorted(set([lo, hi])):
+            retval.append(points[k])
+    return retval
+
+
+class GraphWriter:
+    def __init__(self, graph_dir, html_dir="html", threads=2, max_points=None):
+        self.graph_dir = graph_dir
+        self.html_dir = html_dir
+        self.threads = threads
+        # How many points of the "Value" line to plot, or None for all
+        self.max_points = max_points
+        self.hash_file = os.path.join(graph_dir, "graph_hashes.json")
+        # filename -> md5 of what was last written to it
+        self.hashes = {}
+        self.written = 0
+        self.unchanged = 0
+        self.template = None
+        self.workers = []
+        self.queue = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.template = open(os.path.join(self.html_dir, "graph_template.html")).read()
+        if not os.path.exists(self.graph_dir):
+            os.makedirs(self.graph_dir)
+            # Copy in the rest of the HTML as well
+            shutil.copytree(os.path.join(self.html_dir, 'flot'), '%s/flot' % self.graph_dir)
+        if os.path.exists(self.hash_file):
+            try:
+                self.hashes = json.load(open(self.hash_file))
+            except:
+                log.exception("Couldn't load graph hashes from %s", self.hash_file)
+        if self.threads > 0:
+            # Bounded, so that graphs waiting to be written don't pile up
+            self.queue = Queue.Queue(self.threads * 4)
+            for i in range(self.threads):
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                t.start()
+                self.workers.append(t)
+
+    def add(self, basename, title, graphs):
+        """Writes basename.html and basename.js for graphs, a list of flot
+        series"""
+        if self.template is None:
+            self.start()
+        if self.queue is None:
+            self.write(basename, title, graphs)
+        else:
+            self.queue.put((basename, title, graphs))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.write(*item)
+            except:
+                log.exception("Error writing graph %s", item[0])
+
+    def write(self, basename, title, graphs):
+        if self.max_points:
+            for g in graphs:
+                if g['label'] == "Value":
+                    g['data'] = downsample(g['data'], self.max_points)
+        graph_file = "%s.js" % basename
+        html = self.template % dict(graph_file=graph_file, title=title)
+        self.writeFile("%s.html" % basename, html)
+        self.writeFile(graph_file, "var graph_data = %s;" % json.dumps(graphs))
+
+    def writeFile(self, name, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        digest = hashlib.md5(data).hexdigest()
+        path = os.path.join(self.graph_dir, name)
+        self.lock.acquire()
+        try:
+            if self.hashes.get(name) == digest and os.path.exists(path):
+                self.unchanged += 1
+                return
+        finally:
+            self.lock.release()
+        tmp = path + ".tmp"
+        f = open(tmp, "w")
+        f.write(data)
+        f.close()
+        os.rename(tmp, path)
+        self.lock.acquire()
+        try:
+            self.hashes[name] = digest
+            self.written += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Waits for the queued graphs to be written, and saves the hashes"""
+        if self.template is None:
+            return
+        for t in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+        self.queue = None
+        tmp = self.hash_file + ".tmp"
+        json.dump(self.hashes, open(tmp, "w"))
+        os.rename(tmp, self.hash_file)
+        log.info("Wrote %i graph files, %i were unchanged", self.written, self.unchanged)
@@ -11,6 +11,19 @@ function init() {
   
   // Which tree are we monitoring?
   gTree = gArgs["tree"] || DEFAULT_TREE;
+
+  // Each tree's data is in its own file, which we load for the one shown
+  if (!gData[gTree] && gShards[gTree]) {
+    var script = document.createElement("script");
+    script.src = gShards[gTree];
+    script.onload = showTree;
+    document.getElementsByTagName("head")[0].appendChild(script);
+  } else {
+    showTree();
+  }
+}
+
+function showTree() {
   gTests = gData[gTree];
   buildTreesHeaderAndFooter();
   
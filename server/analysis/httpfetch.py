@@ -0,0 +1,204 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Fetching URLs over kept-alive connections, a few at a time.
+
+Fetcher.fetch() retries failed requests with exponential backoff, and
+callers asking for a URL that's already being fetched wait for that request
+rather than making their own.  Fetcher.fetchAll() fetches a list of URLs
+with up to concurrency threads."""
+import os
+import time
+import socket
+import httplib
+import urlparse
+import threading
+import Queue
+import logging as log
+
+
+class FetchError(Exception):
+    """A URL couldn't be fetched; status and body are the last response's,
+    if there was one"""
+    def __init__(self, message, status=None, body=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.body = body
+
+
+class ConnectionPool:
+    """Idle HTTP connections kept for reuse, up to size per host"""
+    def __init__(self, size=4, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _get(self, scheme, netloc):
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # Forked; the idle connections belong to the parent
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _put(self, scheme, netloc, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.size and self._pid == os.getpid():
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def request(self, url, method='GET', body=None, headers={}):
+        """Returns (status, response body)"""
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn, reused = self._get(parts.scheme, parts.netloc)
+        try:
+            conn.request(method, path, body, headers)
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # The server may have dropped the idle connection; try once
+            # more on a new one
+            return self.request(url, method, body, headers)
+        try:
+            resp = conn.getresponse()
+            data = resp.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            # The server may have acted on the request before failing, so
+            # only requests that can safely be made twice are tried again
+            if not reused or method not in ('GET', 'HEAD'):
+                raise
+            return self.request(url, method, body, headers)
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put(parts.scheme, parts.netloc, conn)
+        return resp.status, data
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Fetcher:
+    def __init__(self, concurrency=4, retries=3, backoff=1.0, timeout=60, pool=None):
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        if pool is None:
+            pool = ConnectionPool(self.concurrency, timeout)
+        self.pool = pool
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, url):
+        tries = 0
+        while True:
+            try:
+                status, data = self.pool.request(url)
+                if status < 400:
+                    return data
+                error = FetchError("%s returned %s" % (url, status), status, data)
+                if status < 500 and status != 429:
+                    raise error
+            except (httplib.HTTPException, socket.error), e:
+                error = FetchError("Couldn't fetch %s: %s" % (url, e))
+            if tries >= self.retries:
+                raise error
+            delay = self.backoff * 2 ** tries
+            log.debug("%s; retrying in %.1fs", error, delay)
+            time.sleep(delay)
+            tries += 1
+
+    def fetch(self, url):
+        """Returns the body of url, raising FetchError if it can't be
+        fetched"""
+        self._lock.acquire()
+        try:
+            call = self._inflight.get(url)
+            owner = call is None
+            if owner:
+                call = self._inflight[url] = _Call()
+        finally:
+            self._lock.release()
+
+        if owner:
+            try:
+                call.result = self._fetch(url)
+            except Exception, e:
+                call.error = e
+            self._lock.acquire()
+            try:
+                del self._inflight[url]
+            finally:
+                self._lock.release()
+            call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def fetchAll(self, urls):
+        """Returns {url: body} for urls, with the exception instead of the
+        body for any that couldn't be fetched"""
+        todo = []
+        seen = set()
+        for url in urls:
+            if url not in seen:
+                seen.add(url)
+                todo.append(url)
+        results = {}
+
+        def work(url):
+            try:
+                results[url] = self.fetch(url)
+            except Exception, e:
+                results[url] = e
+
+        if len(todo) <= 1 or self.concurrency == 1:
+            for url in todo:
+                work(url)
+            return results
+
+        queue = Queue.Queue()
+        for url in todo:
+            queue.put(url)
+
+        def worker():
+            while True:
+                try:
+                    url = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                work(url)
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.concurrency, len(todo)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results
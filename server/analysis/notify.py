@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Queued email delivery.
+
+Warnings are queued over a run and sent together at the end over one SMTP
+session.  A recipient gets one message per group (the push range of a
+regression), with the warnings of every series that regressed on that range
+gathered into a digest."""
+import email.utils
+from smtplib import SMTP, SMTPServerDisconnected
+from email.mime.text import MIMEText
+import logging as log
+
+
+class MailQueue:
+    def __init__(self, fromaddr, server=None):
+        self.fromaddr = fromaddr
+        # host[:port]; the local mail server by default
+        self.server = server
+        # (recipient, group) -> [(subject, msg, headers), ...]
+        self.queued = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, addrs, subject, msg, headers={}, group=None):
+        """Queues a message to addrs; messages to the same address in the
+        same group are sent as one"""
+        for addr in addrs:
+            key = (addr, group)
+            if key not in self.queued:
+                self.queued[key] = []
+                self.order.append(key)
+            self.queued[key].append((subject, msg, dict(headers)))
+
+    def messages(self):
+        """Returns [(addr, MIMEText), ...] for the queued messages"""
+        retval = []
+        for key in self.order:
+            addr, group = key
+            items = self.queued[key]
+            subject, msg, headers = items[0]
+            if len(items) > 1:
+                subject = "%s (and %i more)" % (subject, len(items) - 1)
+                parts = ["%i warnings:\n" % len(items)]
+                for s, m, h in items:
+                    parts.append("%s\n%s\n%s" % (s, "-" * min(len(s), 72), m))
+                msg = ("\n\n" + "=" * 72 + "\n\n").join(parts)
+            # Convert to ascii
+            msg = msg.encode('ascii', 'replace')
+            m = MIMEText(msg, "plain", "ascii")
+            m['Date'] = email.utils.formatdate()
+            m['To'] = addr
+            m['Subject'] = subject
+            for k, v in headers.items():
+                m[k] = v
+            retval.append((addr, m))
+        return retval
+
+    def _connect(self):
+        s = SMTP()
+        if self.server:
+            s.connect(self.server)
+        else:
+            s.connect()
+        return s
+
+    def send(self):
+        """Sends everything queued over one connection, and empties the
+        queue.  Returns how many messages were sent"""
+        messages = self.messages()
+        self.queued = {}
+        self.order = []
+        if not messages:
+            return 0
+        s = self._connect()
+        sent = 0
+        try:
+            for addr, m in messages:
+                try:
+                    s.sendmail(self.fromaddr, [addr], m.as_string())
+                except SMTPServerDisconnected:
+                    # Reconnect once, for servers that limit the messages
+                    # per connection
+                    s = self._connect()
+                    s.sendmail(self.fromaddr, [addr], m.as_string())
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    log.exception("Couldn't send mail to %s", addr)
+                    continue
+                sent += 1
+        finally:
+            try:
+                s.quit()
+            except:
+                pass
+        return sent
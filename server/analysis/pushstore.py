@@ -0,0 +1,161 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Storage for the PushLog cache.
+
+A store holds pushes, {branch: {shortrev: push}}, and the changesets of
+push ranges, {branch: {"from-to": [shortrev, ...]}}.  PushLog asks it for
+just the revisions it needs and hands it only what it fetched since the
+last save."""
+import os
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    from pysqlite2 import dbapi2 as sqlite
+except ImportError:
+    import sqlite3 as sqlite
+
+# How many revisions to look up per query; SQLite allows 999 parameters
+LOOKUP_SIZE = 500
+
+
+class JsonPushStore:
+    """Everything in one JSON file, loaded whole and rewritten on save"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.pushes = {}
+
+    def load(self):
+        try:
+            if not os.path.exists(self.filename):
+                self.pushes = {}
+                return
+            self.pushes = json.load(open(self.filename))
+        except:
+            log.exception("Couldn't load push dates from %s", self.filename)
+            self.pushes = {}
+
+    def getPushes(self, branch, shortrevs):
+        pushes = self.pushes.get(branch, {})
+        retval = {}
+        for shortrev in shortrevs:
+            if shortrev in pushes and shortrev != "ranges":
+                retval[shortrev] = pushes[shortrev]
+        return retval
+
+    def getRange(self, branch, key):
+        return self.pushes.get(branch, {}).get("ranges", {}).get(key)
+
+    def save(self, pushes, ranges):
+        for branch, p in pushes.items():
+            self.pushes.setdefault(branch, {}).update(p)
+        for branch, r in ranges.items():
+            self.pushes.setdefault(branch, {}).setdefault("ranges", {}).update(r)
+        tmp = self.filename + ".tmp"
+        json.dump(self.pushes, open(tmp, "w"), indent=2, sort_keys=True)
+        os.rename(tmp, self.filename)
+
+
+class SqlitePushStore:
+    """A SQLite database, indexed by branch and revision.  It's opened on
+    first use, and saving only writes what's new."""
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+        self._pid = None
+
+    def _conn(self):
+        # A connection mustn't be used on both sides of a fork, so worker
+        # processes open their own
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite.connect(self.filename)
+            self._pid = os.getpid()
+            self._db.execute("""CREATE TABLE IF NOT EXISTS pushes (
+                branch TEXT NOT NULL,
+                shortrev TEXT NOT NULL,
+                date INTEGER,
+                comments TEXT,
+                author TEXT,
+                pusher TEXT,
+                PRIMARY KEY (branch, shortrev))""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS push_ranges (
+                branch TEXT NOT NULL,
+                range_key TEXT NOT NULL,
+                revisions TEXT NOT NULL,
+                PRIMARY KEY (branch, range_key))""")
+            self._db.commit()
+        return self._db
+
+    def load(self):
+        pass
+
+    def getPushes(self, branch, shortrevs):
+        shortrevs = list(shortrevs)
+        retval = {}
+        if not shortrevs:
+            return retval
+        db = self._conn()
+        for i in range(0, len(shortrevs), LOOKUP_SIZE):
+            chunk = shortrevs[i:i+LOOKUP_SIZE]
+            sql = """SELECT shortrev, date, comments, author, pusher FROM pushes
+                     WHERE branch = ? AND shortrev IN (%s)""" % ",".join("?" * len(chunk))
+            for shortrev, date, comments, author, pusher in db.execute(sql, [branch] + chunk):
+                retval[shortrev] = {"date": date,
+                                    "comments": comments,
+                                    "author": author,
+                                    "pusher": pusher,
+                                    }
+        return retval
+
+    def getRange(self, branch, key):
+        row = self._conn().execute(
+            "SELECT revisions FROM push_ranges WHERE branch = ? AND range_key = ?",
+            (branch, key)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(self, pushes, ranges):
+        db = self._conn()
+        rows = []
+        for branch, p in pushes.items():
+            for shortrev, push in p.items():
+                rows.append((branch, shortrev, push['date'], push['comments'],
+                             push['author'], push['pusher']))
+        db.executemany("""INSERT OR REPLACE INTO pushes
+                          (branch, shortrev, date, comments, author, pusher)
+                          VALUES (?, ?, ?, ?, ?, ?)""", rows)
+        rows = []
+        for branch, r in ranges.items():
+            for key, revisions in r.items():
+                rows.append((branch, key, json.dumps(revisions)))
+        db.executemany("""INSERT OR REPLACE INTO push_ranges (branch, range_key, revisions)
+                          VALUES (?, ?, ?)""", rows)
+        db.commit()
+
+
+def openPushStore(filename):
+    """Returns the store for a pushlog cache file: SQLite for .sqlite and
+    .db files, JSON otherwise"""
+    if os.path.splitext(filename)[1] in ('.sqlite', '.db'):
+        return SqlitePushStore(filename)
+    return JsonPushStore(filename)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        print >> sys.stderr, "Usage: %s pushlog.json pushlog.sqlite" % sys.argv[0]
+        sys.exit(1)
+    # Copy a JSON pushlog cache into a SQLite one
+    source = JsonPushStore(sys.argv[1])
+    source.load()
+    pushes = {}
+    ranges = {}
+    for branch, p in source.pushes.items():
+        pushes[branch] = dict(p)
+        ranges[branch] = pushes[branch].pop("ranges", {})
+    openPushStore(sys.argv[2]).save(pushes, ranges)
@@ -0,0 +1,112 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Local stand-ins for the web services the analysis talks to, for tests.
+
+StubServer runs a keep-alive HTTP server on a thread and answers each
+request with handler(method, path, query, body), which returns (status,
+object to send as JSON, or a str to send as it is); a status of None
+closes the connection without answering.  It records the requests it got
+and how many connections were made."""
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stub.connections += 1
+
+    def _handle(self):
+        stub = self.server.stub
+        parts = urlparse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = length and self.rfile.read(length) or None
+        query = urlparse.parse_qs(parts.query)
+        stub.requests.append((self.command, self.path, body))
+        status, result = stub.handler(self.command, parts.path, query, body)
+        if status is None:
+            # Hang up without answering
+            self.close_connection = 1
+            return
+        if isinstance(result, str):
+            data = result
+            content_type = 'application/octet-stream'
+        else:
+            data = json.dumps(result)
+            content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer:
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self.connections = 0
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.stub = self
+        self.url = "http://127.0.0.1:%i" % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def pushesHandler(pushes, fail=0):
+    """A json-pushes handler serving pushes, {"push id": push}, failing the
+    first fail requests with a 503"""
+    state = {'fail': fail}
+
+    def handler(method, path, query, body):
+        if state['fail']:
+            state['fail'] -= 1
+            return 503, {"error": "try again"}
+        if not path.endswith("/json-pushes"):
+            return 404, {"error": "not found"}
+
+        def pushOf(rev):
+            for push_id, push in pushes.items():
+                for c in push['changesets']:
+                    if c['node'].startswith(rev):
+                        return int(push_id)
+
+        retval = {}
+        if 'fromchange' in query:
+            # The pushes after the one with fromchange, up to the one with
+            # tochange
+            lo = pushOf(query['fromchange'][0])
+            hi = pushOf(query['tochange'][0])
+            for push_id, push in pushes.items():
+                if lo < int(push_id) <= hi:
+                    retval[push_id] = push
+        else:
+            wanted = set(pushOf(c) for c in query.get('changeset', []))
+            for push_id, push in pushes.items():
+                if int(push_id) in wanted:
+                    retval[push_id] = push
+        return 200, retval
+    return handler
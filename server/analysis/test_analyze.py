@@ -0,0 +1,245 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import random
+import cPickle as pickle
+
+import pytest
+
+import analyze as analyze_module
+from analyze import analyze, calc_t, median, PerfDatum, PerfSeries, RollingStats, TalosAnalyzer
+try:
+    from analyze_numpy import NumpyTalosAnalyzer
+except ImportError:
+    NumpyTalosAnalyzer = None
+
+
+def reference_analyze_t(a, j, k, threshold, machine_threshold, machine_history_size):
+    """The original, window-rebuilding analyze_t"""
+    good_data = []
+
+    for i in range(j, len(a.data)-k+1):
+        di = a.data[i]
+        jw = [d.value for d in good_data[-j:]]
+        kw = [d.value for d in a.data[i:i+k]]
+
+        my_history = a.machine_history[di.machine_id]
+        my_history_index = my_history.index(di)
+        my_data = [d.value for d in a.machine_history[di.machine_id][my_history_index-machine_history_size+1:my_history_index+1]]
+        other_data = []
+        l = len(good_data)-1
+        while len(other_data) < k*2 and l > 0:
+            dl = good_data[l]
+            if dl.machine_id != di.machine_id:
+                other_data.insert(0, dl.value)
+            l -= 1
+
+        stats = (analyze(jw), analyze(kw))
+
+        if len(jw) >= j:
+            t = calc_t(jw, kw)
+        else:
+            t = 0
+
+        if len(other_data) >= k*2 and len(my_data) >= machine_history_size:
+            m_t = calc_t(other_data, my_data)
+        else:
+            m_t = 0
+
+        if abs(m_t) >= machine_threshold:
+            last_other = None
+            l = len(good_data)-1
+            while l >= 0:
+                dl = good_data[l]
+                if dl.machine_id != di.machine_id:
+                    last_other = dl
+                    break
+                l -= 1
+            yield di, "machine", stats, last_other
+        elif abs(t) <= threshold:
+            good_data.append(di)
+            yield di, "good", stats, None
+        else:
+            good_data.append(di)
+            yield di, "regression", stats, None
+
+
+def make_data(seed, n=600, machines=6):
+    rnd = random.Random(seed)
+    data = []
+    base = 100.0
+    for i in range(n):
+        if rnd.random() < 0.02:
+            # A regression (or improvement)
+            base *= rnd.choice([0.8, 1.25])
+        machine_id = rnd.randrange(machines)
+        value = base + rnd.gauss(0, 1)
+        if machine_id == 0:
+            # A bad machine
+            value += 15
+        if rnd.random() < 0.1:
+            # Flat stretches and repeated values
+            value = round(base)
+        timestamp = 1000 + i // 2
+        d = PerfDatum(i, machine_id, timestamp, value, 20100101000000 + i // 3, timestamp)
+        data.append(d)
+        if rnd.random() < 0.02:
+            # A duplicate of the same result
+            data.append(PerfDatum(i, machine_id, timestamp, value, d.buildid, timestamp))
+    return data
+
+
+def analyzer_for(data):
+    a = TalosAnalyzer()
+    a.addData(data)
+    return a
+
+
+def check_same(data, *args, **kw):
+    expected = TalosAnalyzer()
+    expected.addData(data)
+    actual = kw.get('analyzer', TalosAnalyzer)()
+    actual.addData(data)
+    results = list(actual.analyze_t(*args))
+    reference = list(reference_analyze_t(expected, *args))
+    assert len(results) == len(reference)
+    for (d, state), (ref_d, ref_state, stats, last_other) in zip(results, reference):
+        assert d is ref_d
+        assert state == ref_state
+        if state == "good":
+            for got, want in zip((d.historical_stats, d.forward_stats), stats):
+                assert got['n'] == want['n']
+                assert abs(got['avg'] - want['avg']) <= 1e-9 * abs(want['avg'])
+                assert abs(got['variance'] - want['variance']) <= 1e-6 * (want['variance'] + 1e-9)
+        else:
+            assert (d.historical_stats, d.forward_stats) == stats
+        if state == "machine":
+            assert getattr(d, "last_other", None) is last_other
+    return [state for d, state in results]
+
+
+def test_median():
+    assert median([3, 1, 2]) == 2
+    assert median([4, 1, 3, 2]) == 2.5
+    assert median([]) is None
+
+
+def test_same_classifications():
+    for seed in range(5):
+        states = check_same(make_data(seed), 30, 5, 9, 15, 5)
+        assert "good" in states
+        assert "regression" in states
+        assert "machine" in states
+
+
+def test_window_sizes():
+    data = make_data(42, n=300)
+    for args in [(1, 1, 0, 0, 0), (5, 12, 3, 2, 1), (12, 5, 9, 15, 20), (50, 3, 2.5, 7, 2)]:
+        check_same(data, *args)
+
+
+def test_pickle():
+    data = make_data(1, n=100)
+    results = list(analyzer_for(data).analyze_t(30, 5, 9, 15, 5))
+    copied = pickle.loads(pickle.dumps(results, 2))
+    for (d, state), (c, copied_state) in zip(results, copied):
+        assert d == c
+        assert (d.testrun_id, d.historical_stats, d.forward_stats) == \
+            (c.testrun_id, c.historical_stats, c.forward_stats)
+
+
+def check_resume(cls, data, args, splits):
+    full = [(d.testrun_id, state) for d, state in analyzer_for(data).analyze_t(*args)]
+    data = sorted(data)
+    results = []
+    state = None
+    for part in zip([0] + splits, splits + [len(data)]):
+        a = cls()
+        new = [PerfDatum(d.testrun_id, d.machine_id, d.timestamp, d.value, d.buildid, d.time)
+               for d in data[part[0]:part[1]]]
+        if state is None:
+            a.addData(new)
+        else:
+            assert a.resume(state, new)
+        results.extend((d.testrun_id, s) for d, s in a.analyze_t(*args))
+        state = pickle.loads(pickle.dumps(a.getState(*args[:2] + args[-1:]), 2))
+    assert results == full
+
+
+def test_resume():
+    data = make_data(7, n=400)
+    for cls in filter(None, [TalosAnalyzer, NumpyTalosAnalyzer]):
+        check_resume(cls, data, (30, 5, 9, 15, 5), [20, 100, 101, 250])
+        check_resume(cls, data, (5, 3, 3, 2, 3), [3, 50, 300, 398])
+
+
+def test_resume_out_of_order():
+    data = sorted(make_data(7, n=100))
+    a = analyzer_for(data[:50])
+    list(a.analyze_t(10, 5, 9, 15, 5))
+    assert not TalosAnalyzer().resume(a.getState(10, 5, 5), data[20:21])
+
+
+def test_rolling_stats():
+    rnd = random.Random(1)
+    stats = RollingStats(7)
+    values = []
+    for i in range(500):
+        v = rnd.choice([1.0, 2.0, rnd.gauss(1000, 0.01)])
+        stats.push(v)
+        values = (values + [v])[-7:]
+        want = analyze(values)
+        got = stats.stats()
+        assert got['n'] == want['n']
+        assert abs(got['avg'] - want['avg']) <= 1e-9 * abs(want['avg'])
+        assert abs(got['variance'] - want['variance']) <= 1e-6 * want['variance'] + 1e-12
+        if len(set(values)) == 1:
+            assert got == want
+
+
+@pytest.mark.skipif(NumpyTalosAnalyzer is None, reason="needs numpy")
+def test_numpy_same_classifications():
+    for seed in range(5):
+        check_same(make_data(seed), 30, 5, 9, 15, 5, analyzer=NumpyTalosAnalyzer)
+    data = make_data(42, n=300)
+    for args in [(1, 1, 0, 0, 0), (5, 12, 3, 2, 1), (12, 5, 9, 15, 20), (50, 3, 2.5, 7, 2)]:
+        check_same(data, *args, analyzer=NumpyTalosAnalyzer)
+
+
+def check_perf_series(data):
+    series = PerfSeries.fromData(data)
+    assert len(series) == len(data)
+    for d, s in zip(data, series):
+        assert (d.testrun_id, d.machine_id, d.timestamp, d.value, d.buildid, d.time, d.revision) == \
+            (s.testrun_id, s.machine_id, s.timestamp, s.value, s.buildid, s.time, s.revision)
+
+    expected = analyzer_for(data)
+    a = TalosAnalyzer()
+    a.addData(series)
+    key = lambda d: (d.testrun_id, d.value, d.time)
+    assert map(key, a.data) == map(key, expected.data)
+    assert sorted(a.machine_history) == sorted(expected.machine_history)
+    for machine_id, history in a.machine_history.items():
+        assert map(key, history) == map(key, expected.machine_history[machine_id])
+    assert [(d.testrun_id, s) for d, s in a.analyze_t(30, 5, 9, 15, 5)] == \
+        [(d.testrun_id, s) for d, s in expected.analyze_t(30, 5, 9, 15, 5)]
+
+
+def test_perf_series(monkeypatch):
+    data = make_data(3, n=300)
+    # Out of order, with ties, and with changed times for some revisions
+    random.Random(3).shuffle(data)
+    for i, d in enumerate(data):
+        d.revision = "rev%d" % (d.buildid % 7)
+        if i % 5 == 0:
+            d.buildid = None
+    check_perf_series(data)
+
+    series = PerfSeries.fromData(data).take(range(0, len(data), 3))
+    assert len(series.revisions) == len(set(d.revision for d in data[::3]))
+    series.setTimes({"rev3": 5000})
+    for d, s in zip(data[::3], series):
+        assert s.time == (d.revision == "rev3" and 5000 or d.time)
+
+    monkeypatch.setattr(analyze_module, "numpy", None)
+    check_perf_series(data)
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import pytest
+
+sa = pytest.importorskip("sqlalchemy")
+
+from datasource import TestSeries
+
+SCHEMA = [
+    "CREATE TABLE machines (id INTEGER PRIMARY KEY, os_id INTEGER, name TEXT, is_active INTEGER)",
+    "CREATE TABLE builds (id INTEGER PRIMARY KEY, branch_id INTEGER)",
+    "CREATE TABLE tests (id INTEGER PRIMARY KEY, name TEXT)",
+    "CREATE TABLE test_runs (id INTEGER PRIMARY KEY, machine_id INTEGER, build_id INTEGER, "
+    "test_id INTEGER)",
+    ]
+
+MACHINES = [(1, 1, "talos-r3-fed-001", 1),
+            (2, 1, "talos-r3-fed-002", 1),
+            (3, 2, "talos-r3-xp-001", 1),
+            (4, 1, "talos-r3-fed-stage", 1),
+            (5, 1, "talos-r3-fed-old", 0)]
+
+
+def series(branch_id, os_id, test_id):
+    return TestSeries(branch_id, "Branch %i" % branch_id, os_id, "OS %i" % os_id,
+                      test_id, "Test %i" % test_id, "t%i" % test_id)
+
+
+@pytest.fixture
+def analyze_db(monkeypatch):
+    import analyze_db
+    for name in ('db', 'goodNameClause', '_name_cache', '_machines_cache'):
+        monkeypatch.setattr(analyze_db, name, getattr(analyze_db, name))
+
+    # One in-memory database per thread, which the tests stay on
+    engine = sa.create_engine("sqlite://")
+    for statement in SCHEMA:
+        engine.execute(statement)
+    for row in MACHINES:
+        engine.execute("INSERT INTO machines VALUES (?, ?, ?, ?)", row)
+    engine.execute("INSERT INTO builds VALUES (1, 1)")
+    engine.execute("INSERT INTO builds VALUES (2, 2)")
+    engine.execute("INSERT INTO tests VALUES (1, 'tp')")
+    engine.execute("INSERT INTO tests VALUES (2, 'ts')")
+    run_id = 0
+    for machine_id in (1, 2, 3, 4, 5):
+        for build_id, test_id in [(1, 1), (2, 1), (1, 2)]:
+            if (machine_id, test_id) == (2, 2):
+                continue
+            run_id += 1
+            engine.execute("INSERT INTO test_runs VALUES (?, ?, ?, ?)",
+                           (run_id, machine_id, build_id, test_id))
+    analyze_db.connect(engine)
+    analyze_db.refreshMachines()
+    return analyze_db
+
+
+def test_preload_machines(analyze_db):
+    wanted = [series(1, 1, 1), series(1, 1, 2), series(2, 1, 1), series(1, 2, 1),
+              series(1, 3, 1)]
+    analyze_db.preloadMachines(wanted)
+
+    assert analyze_db.getMachineName(2) == "talos-r3-fed-002"
+    assert analyze_db.getMachineName(1000) is None
+    assert sorted(analyze_db.getMachinesForTest(series(1, 1, 1))) == [1, 2]
+    assert analyze_db.getMachinesForTest(series(1, 1, 2)) == [1]
+    assert sorted(analyze_db.getMachinesForTest(series(2, 1, 1))) == [1, 2]
+    assert analyze_db.getMachinesForTest(series(1, 2, 1)) == [3]
+    assert analyze_db.getMachinesForTest(series(1, 3, 1)) == []
+
+    # Everything above came from the preload
+    analyze_db.db.bind.execute("DELETE FROM test_runs")
+    analyze_db.db.bind.execute("DELETE FROM machines WHERE id = 2")
+    assert sorted(analyze_db.getMachinesForTest(series(1, 1, 1))) == [1, 2]
+    assert analyze_db.getMachineName(2) == "talos-r3-fed-002"
+
+    # Series that weren't preloaded, and machines added since, are looked up
+    analyze_db.db.bind.execute("INSERT INTO machines VALUES (6, 1, 'talos-r3-fed-006', 1)")
+    analyze_db.db.bind.execute("INSERT INTO test_runs VALUES (100, 6, 2, 2)")
+    assert analyze_db.getMachineName(6) == "talos-r3-fed-006"
+    assert analyze_db.getMachinesForTest(series(2, 1, 2)) == [6]
+
+    analyze_db.refreshMachines()
+    assert analyze_db.getMachineName(2) is None
+    assert analyze_db.getMachinesForTest(series(1, 1, 1)) == []
+
+
+def test_preload_names_only(analyze_db):
+    analyze_db.preloadMachines()
+    assert analyze_db.getMachineName(3) == "talos-r3-xp-001"
+    assert analyze_db._machines_cache == {}
+    assert analyze_db.getMachinesForTest(series(1, 2, 1)) == [3]
@@ -0,0 +1,54 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import random
+
+import pytest
+
+from analyze import PerfSeries
+from backtest import Backtest, backtestSeries, configurations, parseValues
+
+
+def series(seed, jump_at=150):
+    rnd = random.Random(seed)
+    data = PerfSeries()
+    for i in range(300):
+        value = 100 + rnd.gauss(0, 1)
+        if i >= jump_at:
+            value += 20
+        # A run every hour
+        data.append(i, i % 3, 1000 + i * 3600, value, i, 1000 + i * 3600, "rev%i" % i)
+    return data
+
+
+def test_grid():
+    assert parseValues('threshold', "7, 9.5") == [7.0, 9.5]
+    with pytest.raises(ValueError):
+        parseValues('fore_window', "5,x")
+    grid = {'back_window': [30], 'fore_window': [3, 5], 'threshold': [9.0],
+            'machine_threshold': [15.0], 'machine_history_size': [5, 0]}
+    assert configurations(grid) == [(30, 3, 9.0, 15.0, 5), (30, 3, 9.0, 15.0, 0),
+                                    (30, 5, 9.0, 15.0, 5), (30, 5, 9.0, 15.0, 0)]
+
+
+def test_series():
+    counts, delays, elapsed = backtestSeries(series(1), (30, 5, 9.0, 15.0, 5))
+    assert counts['points'] == 300 - 30 - 5 + 1
+    assert counts['warnings'] == 1
+    # The jump is seen once the fore window holds enough of it, and the
+    # warning waits for the rest of the window to come in
+    assert 0 < delays[0] <= 4 * 3600
+
+
+@pytest.mark.parametrize("jobs", [None, 2])
+def test_backtest(jobs):
+    data = [series(seed) for seed in range(4)] + [series(9, jump_at=1000)]
+    configs = [(30, 3, 9.0, 15.0, 5), (30, 8, 9.0, 15.0, 5), (30, 5, 1000.0, 15.0, 5)]
+    summaries = Backtest(data, configs, jobs).run()
+    assert [s['fore_window'] for s in summaries] == [3, 8, 5]
+    assert [s['warnings'] for s in summaries] == [4, 4, 0]
+    # A longer fore window finds regressions later
+    assert summaries[0]['median_delay'] < summaries[1]['median_delay']
+    assert summaries[2]['median_delay'] is None
+    assert summaries[0]['series'] == 5
+    assert summaries[0]['points'] == 5 * (300 - 30 - 3 + 1)
@@ -0,0 +1,44 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from benchmark import syntheticSeries, runStage, baseline, compare
+
+PARAMS = {'length': 300, 'machines': 3, 'noise': 1.0, 'steps': 2, 'series': 2,
+          'seed': 1, 'repeat': 1}
+
+
+def test_synthetic_series():
+    data = syntheticSeries(500, machines=4, noise=0.5, steps=1, seed=3, end=10000000)
+    assert len(data) == 500
+    assert set(data.machine_ids) == set([1, 2, 3, 4])
+    assert data.timestamps[-1] == 10000000 - 600
+    # The level jumps by at least 5 times the noise, leaving the rest of the
+    # values more than 3 times the noise away from where they started
+    far = lambda data: len([v for v in data.values if abs(v - 100) > 1.5])
+    assert far(data) > 5
+    assert far(syntheticSeries(500, machines=4, noise=0.5, steps=0, seed=3)) < 5
+    assert list(syntheticSeries(50, seed=3, end=1)) == list(syntheticSeries(50, seed=3, end=1))
+
+
+def test_stages():
+    for stage in ['analyze_t', 'handleSeries']:
+        result = runStage(stage, PARAMS)
+        assert result['rate'] > 0
+        assert result['points'] == {'analyze_t': 300 - 30 - 5 + 1, 'handleSeries': 600}[stage]
+
+
+def test_compare():
+    params = dict(PARAMS)
+    history = [{'params': dict(params, length=10), 'results': {'analyze': {'rate': 1.0, 'peak_kb': 1}}}]
+    for rate in [90.0, 100.0, 110.0]:
+        history.append({'params': params, 'results': {'analyze': {'rate': rate, 'peak_kb': 2000},
+                                                      'addData': {'rate': 5.0, 'peak_kb': None}}})
+    base = baseline(history, params)
+    assert base == {'analyze': {'rate': 100.0, 'peak_kb': 2000},
+                    'addData': {'rate': 5.0, 'peak_kb': None}}
+
+    results = {'analyze': {'rate': 85.0, 'peak_kb': 3000}, 'addData': {'rate': 3.0, 'peak_kb': 10}}
+    assert compare(results, base, 0.2) == ["addData: 3 points/s, down from 5"]
+    results['analyze']['peak_kb'] = 4000
+    assert compare(results, base, 0.2) == ["analyze: 4000 kB peak, up from 2000 kB",
+                                           "addData: 3 points/s, down from 5"]
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import pytest
+
+from bugzilla import BugzillaClient, BugCache
+from stubserver import StubServer
+
+
+class FakeBugzilla:
+    """Just enough of the REST API for the client"""
+    def __init__(self):
+        self.bugs = {}
+        for i in range(1, 250):
+            self.bugs[i] = {"id": i, "summary": "Bug %i" % i, "whiteboard": ""}
+        self.comments = {}
+
+    def __call__(self, method, path, query, body):
+        parts = path.strip("/").split("/")
+        if parts == ["bug"]:
+            ids = [int(i) for i in query['id'][0].split(",")]
+            return 200, {"bugs": [self.bugs[i] for i in ids if i in self.bugs]}
+        bug_num = int(parts[1])
+        if bug_num not in self.bugs:
+            return 404, {"error": True, "message": "No such bug"}
+        if len(parts) == 2:
+            if method == "PUT":
+                self.bugs[bug_num]['whiteboard'] = json.loads(body)['whiteboard']
+                return 200, {"ok": 1}
+            return 200, self.bugs[bug_num]
+        if method == "POST":
+            self.comments.setdefault(bug_num, []).append({"text": json.loads(body)['text']})
+            return 201, {"ref": "comment"}
+        return 200, {"comments": self.comments.get(bug_num, [])}
+
+
+@pytest.fixture
+def server(request):
+    server = StubServer(FakeBugzilla())
+    request.addfinalizer(server.stop)
+    return server
+
+
+def test_get_bugs(server, tmpdir):
+    cache = BugCache(str(tmpdir.join("bugs.json")))
+    client = BugzillaClient(server.url, cache=cache)
+    bugs = client.getBugs(range(1, 151) + [5, 1000])
+    assert sorted(bugs) == range(1, 151)
+    assert bugs[42]['summary'] == "Bug 42"
+    # Two batches over one connection
+    assert len(server.requests) == 2
+    assert server.connections == 1
+
+    assert client.getBug(42)['summary'] == "Bug 42"
+    assert client.getBug(1000) is None
+    assert len(server.requests) == 3
+
+    # Later runs use the cache on disk
+    cache.save()
+    cache = BugCache(str(tmpdir.join("bugs.json")))
+    cache.load()
+    client = BugzillaClient(server.url, cache=cache)
+    assert sorted(client.getBugs([1, 2, 3])) == [1, 2, 3]
+    assert len(server.requests) == 3
+
+    cache = BugCache(str(tmpdir.join("bugs.json")), ttl=0)
+    cache.load()
+    assert client.getBugs([1]) and BugzillaClient(server.url, cache=cache).getBugs([1])
+    assert len(server.requests) == 4
+
+
+def test_notify_bug(server):
+    client = BugzillaClient(server.url, "user", "pass")
+    assert client.getComments(7) == {"comments": []}
+    client.notifyBug(7, "It regressed", "[regression]")
+    assert client.getBug(7)['whiteboard'] == "[regression]"
+    assert client.getComments(7) == {"comments": [{"text": "It regressed"}]}
+    assert [r for r in server.requests if r[0] != "GET"][0][1] == \
+        "/bug/7?password=pass&username=user"
+    assert client.getComments(1000) is None
+
+
+def test_notify_bug_not_resent():
+    class HangUp(FakeBugzilla):
+        def __call__(self, method, path, query, body):
+            status, result = FakeBugzilla.__call__(self, method, path, query, body)
+            if method == "POST":
+                # The comment is added, but the answer never arrives
+                return None, None
+            return status, result
+
+    fake = HangUp()
+    server = StubServer(fake)
+    try:
+        client = BugzillaClient(server.url, "user", "pass")
+        with pytest.raises(Exception):
+            client.notifyBug(7, "It regressed", "[regression]")
+        assert fake.comments == {7: [{"text": "It regressed"}]}
+        assert [r[0] for r in server.requests] == ["GET", "PUT", "POST"]
+    finally:
+        server.stop()
@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from analyze import PerfDatum
+from dashboard import Dashboard, MachineWindow, parseTests
+
+HTML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "html")
+
+
+class Series:
+    def __init__(self, test_id, test_name, os_id=1, os_name="XP"):
+        self.test_id = test_id
+        self.test_name = test_name
+        self.branch_id = 1
+        self.branch_name = "Firefox"
+        self.os_id = os_id
+        self.os_name = os_name
+
+
+def points(start, end, now, machines=3):
+    # Run i is from 300 - i hours ago
+    return [PerfDatum(i, i % machines, now - (300 - i) * 3600, 100 + i % 10 + 1 / 3.0, i, now, "abc")
+            for i in range(start, end)]
+
+
+def test_parse_tests():
+    assert parseTests(r"Ts, Tp4 (RSS), Ts\, Cold") == ["Ts", "Tp4 (RSS)", "Ts, Cold"]
+
+
+def test_machine_window():
+    w = MachineWindow()
+    for t, v in [(3, 5.0), (1, 1.0), (2, 9.0), (4, 2.0)]:
+        w.add(t, v)
+    assert [t for t, v in w.points] == [1, 2, 3, 4]
+    assert w.stats() == [17.0 / 4, 9.0, 1.0]
+    w.expire(3)
+    assert w.stats() == [3.5, 5.0, 2.0]
+    w.expire(10)
+    assert len(w) == 0
+
+
+def test_incremental(tmpdir):
+    now = time.time()
+    state_file = str(tmpdir.join("dashboard.pickle"))
+    names = lambda machine_id: "talos-%i" % machine_id
+    ts, memset = Series(1, "Ts"), Series(2, "Tp3 (Memset)")
+
+    full = Dashboard(str(tmpdir.join("full")), ["Ts", "Tp3 (Memset)"], html_dir=HTML_DIR)
+    full.addSeries(ts, points(0, 300, now), "http://graphs/ts")
+    full.addSeries(memset, points(250, 300, now), "http://graphs/memset")
+
+    # The same, over two runs
+    dashboard = Dashboard(str(tmpdir.join("inc")), ["Ts"], state_file, html_dir=HTML_DIR)
+    dashboard.addSeries(ts, points(0, 200, now), "http://graphs/ts")
+    dashboard.addSeries(memset, points(250, 300, now), "http://graphs/memset")
+    dashboard.save()
+    dashboard = Dashboard(str(tmpdir.join("inc")), ["Ts"], state_file, html_dir=HTML_DIR)
+    dashboard.load()
+    assert dashboard.lastId(ts) == 199
+    assert not dashboard.isUpdated(ts)
+    # Runs that were already added are skipped
+    dashboard.addSeries(ts, points(150, 300, now), "http://graphs/ts")
+    assert dashboard.isUpdated(ts)
+
+    data = full.buildData(names)
+    assert dashboard.buildData(names) == data
+    cell = data["Firefox"]["Ts"]["XP"]
+    assert cell["_graphURL"] == "http://graphs/ts"
+    # Only the last week is kept
+    assert len(cell["talos-0"]["results"]) == 2 * len([i for i in range(300)
+                                                        if i % 3 == 0 and i > 300 - 7 * 24])
+    assert "Tp3 (RSS)" in data["Firefox"]
+
+    dashboard.output(names)
+    index = open(str(tmpdir.join("inc", "testdata.js"))).read()
+    assert 'var gShards = {"Firefox": "testdata-Firefox.js"};' in index
+    shard = open(str(tmpdir.join("inc", "testdata-Firefox.js"))).read()
+    prefix = 'gData["Firefox"] = '
+    assert shard.startswith(prefix)
+    assert json.loads(shard[len(prefix):-2]) == data["Firefox"]
+    assert "100.33333," in shard
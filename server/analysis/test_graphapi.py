@@ -0,0 +1,146 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+from cStringIO import StringIO
+
+import pytest
+
+from analyze_graphapi import GraphAPISource, columnar
+from httpfetch import Fetcher
+from stubserver import StubServer
+
+NOW = int(time.time())
+
+
+class FakeGraphServer:
+    """The /test and /test/runs API, and the columnar export"""
+    def __init__(self, batch=True):
+        self.batch = batch
+        # (test_id, branch_id, os_id, machine_id, run id, date_run, average)
+        self.runs = []
+        for i in range(40):
+            self.runs.append((1, 2, 3, 10 + i % 2, 100 + i, NOW - (40 - i) * 3600, 50.0 + i))
+        self.runs.append((1, 2, 3, 10, 200, NOW - 3600, None))
+        self.runs.append((5, 2, 3, 10, 300, NOW - 3600, 7.0))
+
+    def tests(self):
+        tests = []
+        for test_id, branch_id, os_id, machine_id, run_id, date, average in self.runs:
+            tests.append({"id": test_id, "name": "Test %i" % test_id,
+                          "machine": {"id": machine_id, "name": "talos-%i" % machine_id},
+                          "os": {"id": os_id, "name": "XP"},
+                          "branch": {"id": branch_id, "name": "Firefox"}})
+        tests.append(dict(tests[0], id=6, name="Tp4 NoChrome"))
+        return {"stat": "ok", "tests": tests}
+
+    def matching(self, query, since):
+        return [r for r in self.runs if r[0] == int(query['id'][0]) and
+                r[1] == int(query['branchid'][0]) and r[5] >= since and
+                ('machineid' not in query or r[3] == int(query['machineid'][0])) and
+                ('platformid' not in query or r[2] == int(query['platformid'][0]))]
+
+    def __call__(self, method, path, query, body):
+        if path == "/test":
+            return 200, self.tests()
+        if path == "/test/runs":
+            if 'platformid' in query and not self.batch:
+                return 400, {"error": "You must provide one machineid *or* platformid"}
+            runs = self.matching(query, NOW - int(query['days'][0]) * 24 * 3600)
+            if not runs:
+                # As api_cgi answers
+                return 404, {"stat": "fail", "code": "102",
+                             "message": "No test runs found for test id %s" % query['id'][0]}
+            items = []
+            for test_id, branch_id, os_id, machine_id, run_id, date, average in runs:
+                item = [run_id, [run_id, 2000 + run_id, "rev%09d" % run_id], date, average, 0, []]
+                if self.batch:
+                    item.append(machine_id)
+                items.append(item)
+            return 200, {"stat": "ok", "test_runs": items}
+        if path == "/export":
+            writer = columnar.SeriesWriter()
+            for test_id, branch_id, os_id, machine_id, run_id, date, average in \
+                    self.matching(query, int(query['since'][0]) + 1):
+                writer.add(run_id, date, average, machine_id, run_id, 2000 + run_id, 0, "rev%09d" % run_id)
+            buf = StringIO()
+            writer.write(buf)
+            return 200, buf.getvalue()
+        return 404, {"error": "not found"}
+
+
+@pytest.fixture
+def server(request):
+    def make(fake):
+        stub = StubServer(fake)
+        request.addfinalizer(stub.stop)
+        return stub
+    return make
+
+
+def check_source(source, stub):
+    series = source.getTestSeries(["Firefox"], 0, [])
+    assert [(s.test_id, s.branch_id, s.os_id) for s in series] == [(1, 2, 3), (5, 2, 3)]
+    s = series[0]
+    assert source.getMachinesForTest(s) == [10, 11]
+    assert source.getMachineName(11) == "talos-11"
+
+    # /test/runs works in days, so there can be more than asked for
+    assert source.prefetchTestData(series, NOW - 20 * 3600) >= 20
+    requests = len(stub.requests)
+    data = source.getTestData(s, NOW - 20 * 3600)
+    assert sorted(d.testrun_id for d in data) == range(121, 140)
+    d = [d for d in data if d.testrun_id == 130][0]
+    assert (d.machine_id, d.timestamp, d.value, d.buildid, d.revision) == \
+        (10, NOW - 10 * 3600, 80.0, 2130, "rev000000130")
+    # Later starts and only new runs come from what was fetched
+    data = source.getTestData(s, NOW - 10 * 3600, 135)
+    assert sorted(d.testrun_id for d in data) == range(136, 140)
+    assert len(stub.requests) == requests
+
+
+def test_batch(server):
+    stub = server(FakeGraphServer())
+    source = GraphAPISource(stub.url, fetcher=Fetcher(4, backoff=0))
+    check_source(source, stub)
+    # One request for the list of tests, and one per series
+    assert len(stub.requests) == 3
+    assert source.batch
+
+
+@pytest.mark.parametrize("batch", [True, False])
+def test_no_runs(server, batch):
+    fake = FakeGraphServer(batch)
+    # Test 7 has a run, but not in the days asked for
+    fake.runs.append((7, 2, 3, 11, 400, NOW - 100 * 24 * 3600, 3.0))
+    stub = server(fake)
+    source = GraphAPISource(stub.url, fetcher=Fetcher(4, backoff=0))
+    series = source.getTestSeries(["Firefox"], 0, [])
+    empty = [s for s in series if s.test_id == 7][0]
+    assert len(source.getTestData(empty, NOW - 20 * 3600)) == 0
+    # An empty series doesn't turn batches off, nor is it fetched again
+    assert source.batch == batch
+    assert len(source.getTestData(empty, NOW - 10 * 3600)) == 0
+    requests = len(stub.requests)
+    assert len(source.getTestData(series[0], NOW - 20 * 3600)) == 19
+    runs = [r[1] for r in stub.requests[requests:]]
+    if batch:
+        assert len(runs) == 1 and 'platformid' in runs[0]
+    else:
+        assert len(runs) == 2 and all('machineid' in r for r in runs)
+
+
+def test_per_machine(server):
+    stub = server(FakeGraphServer(batch=False))
+    source = GraphAPISource(stub.url, fetcher=Fetcher(4, backoff=0))
+    check_source(source, stub)
+    assert not source.batch
+    # Once batches have failed, machines are fetched one at a time
+    assert len([r for r in stub.requests if 'machineid' in r[1]]) == 3
+
+
+def test_export(server):
+    stub = server(FakeGraphServer())
+    source = GraphAPISource(stub.url, stub.url + "/export", Fetcher(4, backoff=0))
+    check_source(source, stub)
+    assert [r[1].split("?")[0] for r in stub.requests] == ["/test", "/export", "/export"]
@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from graphoutput import GraphWriter, downsample
+
+HTML_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "html")
+
+
+def test_downsample():
+    points = [(i, i % 10) for i in range(1000)]
+    points[500] = (500, 100)
+    thinned = downsample(points, 100)
+    assert len(thinned) <= 100
+    assert thinned == sorted(thinned)
+    assert (500, 100) in thinned
+    assert min(p[1] for p in thinned) == 0
+    assert downsample(points[:50], 100) == points[:50]
+    assert downsample(points, None) == points
+
+
+def test_graph_writer(tmpdir):
+    graph_dir = str(tmpdir.join("graphs"))
+    graphs = [{"label": "Value", "data": [(i * 1000, i) for i in range(100)]}]
+
+    writer = GraphWriter(graph_dir, HTML_DIR, threads=2, max_points=20)
+    for i in range(10):
+        writer.add("Firefox-XP-Ts%i" % i, "Ts %i" % i, [dict(g) for g in graphs])
+    writer.close()
+    assert (writer.written, writer.unchanged) == (20, 0)
+    assert os.path.exists(os.path.join(graph_dir, "flot"))
+    assert "Firefox-XP-Ts3.js" in open(os.path.join(graph_dir, "Firefox-XP-Ts3.html")).read()
+    data = open(os.path.join(graph_dir, "Firefox-XP-Ts3.js")).read()
+    assert data.startswith("var graph_data = ")
+    assert len(json.loads(data[len("var graph_data = "):-1])[0]['data']) <= 20
+
+    # Only the graphs that changed are written again
+    os.remove(os.path.join(graph_dir, "Firefox-XP-Ts9.js"))
+    writer = GraphWriter(graph_dir, HTML_DIR, threads=0, max_points=20)
+    for i in range(10):
+        title = "Ts %i" % i
+        if i == 0:
+            title = "Ts (new)"
+        writer.add("Firefox-XP-Ts%i" % i, title, [dict(g) for g in graphs])
+    writer.close()
+    assert (writer.written, writer.unchanged) == (2, 18)
+    assert "Ts (new)" in open(os.path.join(graph_dir, "Firefox-XP-Ts0.html")).read()
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import threading
+
+import pytest
+
+from httpfetch import Fetcher, FetchError
+from stubserver import StubServer, pushesHandler
+from pushstore import JsonPushStore
+from analyze_talos import PushLog
+
+
+def make_pushes(n):
+    pushes = {}
+    for i in range(n):
+        node = "%012x" % (i + 1) + "f" * 28
+        pushes[str(i + 1)] = {"date": 1280000000 + i, "user": "pusher%i" % i,
+                              "changesets": [{"node": node, "desc": "Bug %i" % i,
+                                              "author": "author%i" % i}]}
+    return pushes
+
+
+@pytest.fixture
+def server(request):
+    server = StubServer(pushesHandler(make_pushes(120)))
+    request.addfinalizer(server.stop)
+    return server
+
+
+def make_pushlog(server, tmpdir, **kw):
+    return PushLog(str(tmpdir.join("pushlog.json")), server.url,
+                   JsonPushStore(str(tmpdir.join("pushlog.json"))),
+                   Fetcher(backoff=0.01, **kw))
+
+
+def test_push_dates(server, tmpdir):
+    pushlog = make_pushlog(server, tmpdir)
+    revs = ["%012x" % (i + 1) for i in range(120)]
+    dates = pushlog.getPushDates("Firefox", "mozilla-central", revs + ["ffffffffffff"])
+    assert dates == dict((rev, 1280000000 + i) for i, rev in enumerate(revs))
+    # 120 changesets go in 3 requests over kept-alive connections
+    assert len(server.requests) == 3
+    assert server.connections <= 3
+
+    assert pushlog.getPushRange("Firefox", "mozilla-central", revs[10], revs[13]) == revs[11:14]
+    assert pushlog.getChange("Firefox", revs[12])["author"] == "author12"
+
+    pushlog.getPushDates("Firefox", "mozilla-central", revs)
+    assert len(server.requests) == 4
+
+
+def test_retry(server, tmpdir):
+    server.handler = pushesHandler(make_pushes(3), fail=2)
+    pushlog = make_pushlog(server, tmpdir)
+    assert pushlog.getPushDates("Firefox", "mozilla-central", ["000000000001"]) == \
+        {"000000000001": 1280000000}
+    assert len(server.requests) == 3
+
+    server.handler = pushesHandler(make_pushes(3), fail=10)
+    with pytest.raises(FetchError):
+        make_pushlog(server, tmpdir, retries=1).getPushDates("Firefox", "mozilla-central", ["2"])
+
+
+def test_coalescing(server):
+    release = threading.Event()
+    handler = server.handler
+
+    def slow(*args):
+        release.wait(5)
+        return handler(*args)
+    server.handler = slow
+
+    fetcher = Fetcher(concurrency=4)
+    url = server.url + "/mozilla-central/json-pushes?changeset=000000000001"
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(fetcher.fetch(url)))
+               for i in range(5)]
+    for t in threads:
+        t.start()
+    while not server.requests:
+        pass
+    release.set()
+    for t in threads:
+        t.join()
+    assert len(results) == 5 and len(set(results)) == 1
+    assert len(server.requests) == 1
+
+    fetched = fetcher.fetchAll([url, url, url + "&x=1"])
+    assert sorted(fetched) == [url, url + "&x=1"]
+    assert len(server.requests) == 3
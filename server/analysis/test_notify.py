@@ -0,0 +1,66 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import email
+import smtpd
+import asyncore
+import threading
+
+import pytest
+
+from notify import MailQueue
+
+
+class RecordingServer(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.received = []
+        self.sessions = 0
+
+    def handle_accept(self):
+        self.sessions += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((mailfrom, rcpttos, email.message_from_string(data)))
+
+
+@pytest.fixture
+def server(request):
+    server = RecordingServer()
+    thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        server.close()
+        thread.join()
+    request.addfinalizer(stop)
+    return server
+
+
+def test_digests(server):
+    queue = MailQueue("talos@example.com", "127.0.0.1:%i" % server.socket.getsockname()[1])
+    for test in ("Ts", "Tp4", "Tdhtml"):
+        queue.add(["dev@example.com", "author@example.com"], "%s regressed" % test,
+                  u"%s got slower \u2639" % test, {"In-Reply-To": "<talosbustage-abc>"},
+                  group=("regression", "Firefox", "abc", "def"))
+    queue.add(["dev@example.com"], "Ts regressed", "On another push", group=("regression", "Firefox", "def", "123"))
+    assert queue.send() == 3
+    assert len(queue) == 0
+    assert server.sessions == 1
+
+    assert [(r[1], r[2]['Subject']) for r in server.received] == [
+        (["dev@example.com"], "Ts regressed (and 2 more)"),
+        (["author@example.com"], "Ts regressed (and 2 more)"),
+        (["dev@example.com"], "Ts regressed"),
+        ]
+    digest = server.received[0][2]
+    assert digest['In-Reply-To'] == "<talosbustage-abc>"
+    body = digest.get_payload()
+    assert "3 warnings" in body
+    assert "Tp4 got slower ?" in body and "Tdhtml got slower ?" in body
+    assert server.received[2][2].get_payload() == "On another push"
+
+    assert queue.send() == 0
+    assert server.sessions == 1
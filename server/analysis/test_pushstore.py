@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from pushstore import openPushStore, JsonPushStore, SqlitePushStore
+from analyze_talos import PushLog
+
+PUSH = {"date": 1280000000, "comments": "Bug 1 - Fix it", "author": "a@b", "pusher": "c@d"}
+
+
+def check_store(filename):
+    store = openPushStore(filename)
+    store.load()
+    assert store.getPushes("Firefox", ["abcdef012345"]) == {}
+    assert store.getRange("Firefox", "a-b") is None
+    store.save({"Firefox": {"abcdef012345": PUSH, "000000000001": dict(PUSH, date=5)}},
+               {"Firefox": {"a-b": ["abcdef012345"]}})
+
+    store = openPushStore(filename)
+    store.load()
+    revs = ["abcdef012345", "000000000001", "ffffffffffff"] + ["%012x" % i for i in range(2000)]
+    pushes = store.getPushes("Firefox", revs)
+    assert sorted(pushes) == ["000000000001", "abcdef012345"]
+    assert pushes["abcdef012345"] == PUSH
+    assert store.getPushes("TraceMonkey", revs) == {}
+    assert store.getRange("Firefox", "a-b") == ["abcdef012345"]
+
+    pushlog = PushLog(filename, "http://localhost:1", store)
+    pushlog.load()
+    # Everything comes from the store, so nothing is fetched
+    assert pushlog.getPushDates("Firefox", "mozilla-central", ["abcdef012345", "1"]) == \
+        {"abcdef012345": 1280000000, "000000000001": 5}
+    assert pushlog.getChange("Firefox", "abcdef0123456789") == PUSH
+    assert pushlog.getPushRange("Firefox", "mozilla-central", "a", "b") == ["abcdef012345"]
+    pushlog.mergeUpdates({"Firefox": {"0123456789ab": PUSH}})
+    pushlog.save()
+    store = openPushStore(filename)
+    store.load()
+    assert store.getPushes("Firefox", ["0123456789ab", "abcdef012345"]) == \
+        {"0123456789ab": PUSH, "abcdef012345": PUSH}
+
+
+def test_json_store(tmpdir):
+    filename = str(tmpdir.join("pushlog.json"))
+    assert isinstance(openPushStore(filename), JsonPushStore)
+    check_store(filename)
+
+
+def test_sqlite_store(tmpdir):
+    filename = str(tmpdir.join("pushlog.sqlite"))
+    assert isinstance(openPushStore(filename), SqlitePushStore)
+    check_store(filename)
@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from ConfigParser import RawConfigParser
+
+import pytest
+
+from analyze import PerfSeries
+from analyze_snapshot import SnapshotSource, writeSnapshot, seriesFilename, columnar
+import datasource
+from datasource import DataSource, openSource
+
+
+class FakeSource(DataSource):
+    def __init__(self):
+        self.series = [datasource.TestSeries(1, "Firefox", 2, "XP", 3, "Ts", "ts"),
+                       datasource.TestSeries(1, "Firefox", 2, "XP", 4, "Tp4", "tp4"),
+                       datasource.TestSeries(5, "TraceMonkey", 2, "XP", 3, "Ts", "ts")]
+
+    def getTestSeries(self, branches, start_time, test_names, last_run=None):
+        return [s for s in self.series if s.branch_name in branches]
+
+    def getTestData(self, series, start_time, after_id=None):
+        data = PerfSeries()
+        for i in range(20):
+            data.append(series.test_id * 100 + i, 10 + i % 3, 1000 + i * 10, i * 1.5,
+                        i or None, 1000 + i * 10, "rev%i" % i, i % 2)
+        return data
+
+    def getMachineName(self, machine_id):
+        return "talos-%i" % machine_id
+
+
+@pytest.fixture(params=["numpy", "array"])
+def snapshot(request, tmpdir, monkeypatch):
+    if request.param == "array":
+        monkeypatch.setattr(columnar, "numpy", None)
+    dirname = str(tmpdir.join("snapshot"))
+    assert writeSnapshot(FakeSource(), dirname, ["Firefox"], 0, []) == 40
+    return dirname
+
+
+def test_series(snapshot):
+    source = SnapshotSource(snapshot)
+    assert [str(s) for s in source.getTestSeries(["Firefox"], 0, [])] == \
+        ["Firefox XP ts", "Firefox XP tp4"]
+    assert [s.test_id for s in source.getTestSeries(["Firefox"], 0, ["Tp4"])] == [4]
+    # Only series with runs after start_time, and after last_run
+    assert source.getTestSeries(["Firefox"], 1190, []) == []
+    assert [s.test_id for s in source.getTestSeries(["Firefox"], 0, [], 400)] == [4]
+    assert source.getTestSeries(["TraceMonkey"], 0, []) == []
+
+
+def test_data(snapshot):
+    source = SnapshotSource(snapshot)
+    s = source.getTestSeries(["Firefox"], 0, [])[0]
+    assert source.getMachinesForTest(s) == [10, 11, 12]
+    assert source.getMachineName(11) == "talos-11"
+
+    expected = list(FakeSource().getTestData(s, 0))
+    data = list(source.getTestData(s, 0))
+    assert [(d.testrun_id, d.machine_id, d.timestamp, d.value, d.buildid, d.time,
+             d.revision, d.run_number) for d in data] == \
+           [(d.testrun_id, d.machine_id, d.timestamp, d.value, d.buildid, d.time,
+             d.revision, d.run_number) for d in expected]
+    assert [d.testrun_id for d in source.getTestData(s, 1100)] == range(311, 320)
+    assert [d.testrun_id for d in source.getTestData(s, 1100, 315)] == range(316, 320)
+
+
+def test_missing_values(snapshot):
+    s = datasource.TestSeries(1, "Firefox", 2, "XP", 3, "Ts", "ts")
+    writer = columnar.SeriesWriter()
+    writer.add(1, 1000, 5.0, 10, 1, 1, 0, "abc")
+    writer.add(2, 1010, None, 10, 2, 2, 0, "abc")
+    writer.write(open(seriesFilename(snapshot, s), "wb"))
+    source = SnapshotSource(snapshot)
+    assert [d.testrun_id for d in source.getTestData(s, 0)] == [1]
+
+
+def test_open_source(snapshot):
+    config = RawConfigParser()
+    config.add_section('main')
+    config.set('main', 'source', 'snapshot')
+    config.set('main', 'snapshot_dir', snapshot)
+    assert isinstance(openSource(config), SnapshotSource)
+    config.set('main', 'source', 'carrier-pigeon')
+    with pytest.raises(ValueError):
+        openSource(config)
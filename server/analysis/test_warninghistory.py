@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import warninghistory
+from warninghistory import WarningHistory
+
+
+def lines(filename):
+    return open(filename).read().splitlines()
+
+
+def test_old_format(tmpdir):
+    filename = str(tmpdir.join("warning_history.json"))
+    now = time.time()
+    json.dump({
+        "Firefox": {"XP": {"Ts": [["20100101", 100], ["20100102", 200]]}},
+        "bad_machines": {"talos-1": now - 3600, "talos-2": now - 30*24*3600},
+        "inactive_machines": {},
+        }, open(filename, "w"))
+
+    history = WarningHistory(filename, 150)
+    history.load()
+    assert not history.seen("Firefox", "XP", "Ts", "20100101", 100)
+    assert history.seen("Firefox", "XP", "Ts", "20100102", 200)
+    assert not history.seen("Firefox", "Vista", "Ts", "20100102", 200)
+    assert history.machineWarned("talos-1") == now - 3600
+    assert history.machineWarned("talos-3") == 0
+
+    # The old file is replaced by a log of what's still needed
+    history.save()
+    assert [json.loads(l) for l in lines(filename)] == [
+        ["w", "Firefox", "XP", "Ts", "20100102", 200],
+        ["m", "talos-1", now - 3600],
+        ]
+
+
+def test_append_and_compact(tmpdir, monkeypatch):
+    monkeypatch.setattr(warninghistory, "COMPACT_SLACK", 0)
+    filename = str(tmpdir.join("warning_history.json"))
+    history = WarningHistory(filename, 0)
+    history.load()
+    for i in range(5):
+        history.add("Firefox", "XP", "Ts", "b%i" % i, i)
+    history.warnMachine("talos-1", 1000)
+    history.save()
+    assert len(lines(filename)) == 6
+
+    # Later runs only append what's new
+    history = WarningHistory(filename, 0)
+    history.load()
+    assert history.seen("Firefox", "XP", "Ts", "b4", 4)
+    history.add("Firefox", "XP", "Ts", "b5", 5)
+    history.save()
+    assert len(lines(filename)) == 7
+
+    # A partly written record is skipped, and the file rewritten
+    open(filename, "a").write('["w", "Firefox"')
+    history = WarningHistory(filename, 0)
+    history.load()
+    assert history.seen("Firefox", "XP", "Ts", "b5", 5)
+    history.save()
+    assert len(lines(filename)) == 6
+
+    # Once most of the records have expired, they're dropped
+    history = WarningHistory(filename, 5)
+    history.load()
+    history.add("Firefox", "XP", "Ts", "b6", 6)
+    history.save()
+    assert [json.loads(l) for l in lines(filename)] == [
+        ["w", "Firefox", "XP", "Ts", "b5", 5],
+        ["w", "Firefox", "XP", "Ts", "b6", 6],
+        ]
@@ -0,0 +1,140 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""The warnings that have been sent, so they aren't sent again.
+
+The history is kept in a log file with one JSON record per line:
+["w", branch, os, test, buildid, timestamp] for a warning about a point and
+["m", machine name, time] for a warning about a machine.  Saving appends
+the new records; once most of the file is expired or superseded records,
+it's rewritten with just the live ones.  The JSON dict that older versions
+wrote is read as well, and replaced on the next save."""
+import os
+import time
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# How many dead records a log may hold before it's always compacted
+COMPACT_SLACK = 1000
+
+
+class WarningHistory:
+    def __init__(self, filename, cutoff, machine_window=7*24*3600):
+        self.filename = filename
+        # Warnings about points from before cutoff are forgotten, as are
+        # machine warnings older than machine_window
+        self.cutoff = cutoff
+        self.machine_window = machine_window
+        self._reset()
+
+    def _reset(self):
+        # (branch, os_name, test_name) -> set([(buildid, timestamp), ...])
+        self.warnings = {}
+        # machine name -> when it was last warned about
+        self.bad_machines = {}
+        # Records not written yet, how many records the file has, and
+        # whether it needs rewriting
+        self.pending = []
+        self.records = 0
+        self.rewrite = False
+
+    def load(self):
+        self._reset()
+        if not os.path.exists(self.filename):
+            return
+        try:
+            f = open(self.filename)
+            if f.read(1) == "{":
+                f.seek(0)
+                self._loadDict(json.load(f))
+                self.rewrite = True
+                return
+            f.seek(0)
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Probably a partly written last record
+                    self.rewrite = True
+                    continue
+                self.records += 1
+                self._apply(record)
+        except:
+            log.exception("Couldn't load warnings from %s", self.filename)
+            self._reset()
+
+    def _loadDict(self, history):
+        for name, t in history.get('bad_machines', {}).items():
+            self._apply(["m", name, t])
+        for branch, oses in history.items():
+            if branch in ('inactive_machines', 'bad_machines'):
+                continue
+            for os_name, tests in oses.items():
+                for test_name, values in tests.items():
+                    for buildid, timestamp in values:
+                        self._apply(["w", branch, os_name, test_name, buildid, timestamp])
+
+    def _apply(self, record):
+        if record[0] == "w":
+            branch, os_name, test_name, buildid, timestamp = record[1:]
+            if timestamp >= self.cutoff:
+                self.warnings.setdefault((branch, os_name, test_name), set()).add((buildid, timestamp))
+        elif record[0] == "m":
+            name, t = record[1:]
+            self.bad_machines[name] = max(t, self.bad_machines.get(name, 0))
+
+    def seen(self, branch, os_name, test_name, buildid, timestamp):
+        """Returns whether there's been a warning about this point"""
+        return (buildid, timestamp) in self.warnings.get((branch, os_name, test_name), ())
+
+    def add(self, branch, os_name, test_name, buildid, timestamp):
+        record = ["w", branch, os_name, test_name, buildid, timestamp]
+        self._apply(record)
+        self.pending.append(record)
+
+    def machineWarned(self, name):
+        """Returns when there was last a warning about a machine, or 0"""
+        return self.bad_machines.get(name, 0)
+
+    def warnMachine(self, name, t=None):
+        if t is None:
+            t = time.time()
+        record = ["m", name, t]
+        self._apply(record)
+        self.pending.append(record)
+
+    def liveRecords(self):
+        """Returns the records needed to rebuild the history"""
+        records = []
+        for (branch, os_name, test_name), values in sorted(self.warnings.items()):
+            for buildid, timestamp in sorted(values):
+                records.append(["w", branch, os_name, test_name, buildid, timestamp])
+        since = time.time() - self.machine_window
+        for name, t in sorted(self.bad_machines.items()):
+            if t > since:
+                records.append(["m", name, t])
+        return records
+
+    def save(self):
+        if not self.pending and not self.rewrite:
+            return
+        live = self.liveRecords()
+        if self.rewrite or self.records + len(self.pending) > 2 * len(live) + COMPACT_SLACK:
+            tmp = self.filename + ".tmp"
+            f = open(tmp, "w")
+            for record in live:
+                f.write(json.dumps(record) + "\n")
+            f.close()
+            os.rename(tmp, self.filename)
+            self.records = len(live)
+            self.rewrite = False
+        else:
+            f = open(self.filename, "a")
+            for record in self.pending:
+                f.write(json.dumps(record) + "\n")
+            f.close()
+            self.records += len(self.pending)
+        self.pending = []
@@ -1,14 +1,14 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
-from graphsdb import db
-import MySQLdb.cursors
+from graphsdb import db, read_db, MySQLdb
 from webob import exc
 from datetime import datetime, timedelta
 from time import mktime
 
 
 #Get an array of all tests by build and os
+@read_db.pooled
 def getTests(id, attribute, req):
     if attribute == 'short':
         result = getTestOptions()
@@ -33,7 +33,7 @@ def getTests(id, attribute, req):
                                 INNER JOIN branches on (builds.branch_id = branches.id)
             WHERE machines.is_active <> 0
             ORDER BY branches.id, machines.id"""
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     cursor.execute(sql)
     tests = []
     #fetch row count first, then check for length
@@ -118,7 +118,7 @@ def getTestOptions():
     platformMap = results['platformMap'] = {}
     branchMap = results['branchMap'] = {}
     sql = """SELECT tests.id AS id, tests.pretty_name AS name FROM tests"""
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     cursor.execute(sql)
     for row in cursor.fetchall():
         testMap[row['id']] = {'name': row['name'],
@@ -126,7 +126,7 @@ def getTestOptions():
                               'branchIds': set(),
                               }
     sql = """SELECT os_list.id AS id, os_list.name AS name FROM os_list"""
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     cursor.execute(sql)
     for row in cursor.fetchall():
         platformMap[row['id']] = {'name': row['name'],
@@ -134,7 +134,7 @@ def getTestOptions():
                                   'branchIds': set(),
                                   }
     sql = """SELECT branches.id AS id, branches.name AS name FROM branches"""
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     cursor.execute(sql)
     for row in cursor.fetchall():
         branchMap[row['id']] = {'name': row['name'],
@@ -151,7 +151,7 @@ def getTestOptions():
     return results
 
 
-def get_test_combos():
+def get_test_combos(conn=read_db):
     """Select the test combinations (not in the form we send to the browser,
     just a list of rows)"""
     sql = """
@@ -160,11 +160,12 @@ def get_test_combos():
            valid_test_combinations.os_id AS os_id
     FROM valid_test_combinations
     """
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = conn.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     cursor.execute(sql)
     return cursor.fetchall()
 
 
+@db.pooled
 def update_valid_test_combinations(reporter=None):
     """Updates the list of valid test combinations"""
     sql = """SELECT last_updated FROM valid_test_combinations_updated"""
@@ -176,7 +177,7 @@ def update_valid_test_combinations(reporter=None):
     else:
         last_updated = last_updated['last_updated']
     existing_combos = set()
-    for row in get_test_combos():
+    for row in get_test_combos(db):
         existing_combos.add((row['test_id'], row['os_id'], row['branch_id']))
     sql = """
     SELECT test_runs.test_id AS test_id,
@@ -191,7 +192,9 @@ def update_valid_test_combinations(reporter=None):
     ORDER BY test_runs.date_run
     LIMIT 100000
     """
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    # Stream the rows; the new combinations are inserted once the result
+    # has been read, as nothing else can run on the connection before then
+    cursor = db.cursor(cursorclass=MySQLdb.cursors.SSDictCursor)
     cursor.execute(sql, (last_updated,))
     new_last_updated = last_updated
     if reporter:
@@ -200,44 +203,52 @@ def update_valid_test_combinations(reporter=None):
         else:
             reporter('Updating combos since %s' % last_updated)
     count = 0
-    for row in cursor.fetchall():
-        count += 1
-        if reporter and (not count % 1000):
-            reporter('Read %s records' % count)
-        if not count % 10000:
-            # Just update every so often
-            update_combos_last_updated(new_last_updated)
-            db.commit()
-        try:
+    new_combos = []
+    try:
+        for row in cursor.iterrows():
+            count += 1
+            if reporter and (not count % 1000):
+                reporter('Read %s records' % count)
             key = (row['test_id'], row['os_id'], row['branch_id'])
             if key not in existing_combos:
-                sql = """
-                INSERT INTO valid_test_combinations (test_id, os_id, branch_id)
-                VALUES (%s, %s, %s)
-                """
-                cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
-                cursor.execute(sql, key)
+                new_combos.append(key)
                 existing_combos.add(key)
-        except:
-            # This way if things are interrupted we can still record our progress
-            if new_last_updated > last_updated:
-                if reporter:
-                    reporter('Exception; updated last_updated to %s'
-                             % new_last_updated)
-                try:
-                    update_combos_last_updated(new_last_updated)
-                    db.commit()
-                except:
-                    pass
-            raise
-        new_last_updated = max(row['date_run'], new_last_updated)
+            new_last_updated = max(row['date_run'], new_last_updated)
+    except:
+        # This way if things are interrupted we can still record our progress
+        if new_last_updated > last_updated:
+            if reporter:
+                reporter('Exception; updated last_updated to %s'
+                         % new_last_updated)
+            try:
+                cursor.close()
+                insert_test_combos(new_combos)
+                update_combos_last_updated(new_last_updated)
+                db.commit()
+            except:
+                pass
+        raise
+    cursor.close()
     if reporter:
         reporter('Finished completely (%s items), updating last_updated to %s'
                  % (count, new_last_updated))
+    insert_test_combos(new_combos)
     update_combos_last_updated(new_last_updated)
     db.commit()
 
 
+def insert_test_combos(combos):
+    """Adds (test_id, os_id, branch_id) rows to valid_test_combinations"""
+    if not combos:
+        return
+    sql = """
+    INSERT INTO valid_test_combinations (test_id, os_id, branch_id)
+    VALUES (%s, %s, %s)
+    """
+    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor.executemany(sql, combos)
+
+
 def update_combos_last_updated(last_updated):
     """Sets the valid_test_combinations_updated.last_updated field"""
     sql = """
@@ -249,6 +260,7 @@ def update_combos_last_updated(last_updated):
 
 
 #Get a list of test runs for a test id and branch and os with annotations
+@read_db.pooled
 def getTestRuns(id, attribute, req):
 
     machineid = int(req.params.get('machineid', -1))
@@ -259,69 +271,93 @@ def getTestRuns(id, attribute, req):
     age = datetime.utcnow() - timedelta(days=days)
 
     if platformid == -1 and machineid != -1:
-        sql = """
-    SELECT test_runs.*, builds.id as build_id, builds.ref_build_id, builds.ref_changeset
-    FROM test_runs INNER JOIN builds ON (builds.id = test_runs.build_id)
-                   INNER JOIN branches ON (builds.branch_id = branches.id)
-                   INNER JOIN machines ON (test_runs.machine_id = machines.id)
-    WHERE test_runs.test_id = %s
-          AND machines.id = %s
-          AND branches.id = %s
-          AND machines.is_active <> 0
-          AND date_run >= %s
-    ORDER BY date_run ASC
-"""
-
-        cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
-        cursor.execute(sql, (id, machineid, branchid, mktime(age.timetuple())))
+        joins = ""
+        where = "machines.id = %s"
+        params = (id, machineid, branchid, mktime(age.timetuple()))
     elif machineid == -1 and platformid != -1:
-        sql = """
-    SELECT test_runs.*, builds.id as build_id, builds.ref_build_id, builds.ref_changeset
+        joins = "INNER JOIN os_list ON (machines.os_id = os_list.id)"
+        where = "os_list.id = %s"
+        params = (id, platformid, branchid, mktime(age.timetuple()))
+    else:
+        raise exc.HTTPBadRequest("You must provide one machineid *or* platformid")
+
+    tables = """
     FROM test_runs INNER JOIN builds ON (builds.id = test_runs.build_id)
                    INNER JOIN branches ON (builds.branch_id = branches.id)
                    INNER JOIN machines ON (test_runs.machine_id = machines.id)
-                   INNER JOIN os_list ON (machines.os_id = os_list.id)
-    WHERE test_runs.test_id = %s
-          AND os_list.id = %s
-          AND branches.id = %s
+                   %s""" % joins
+    conditions = """
+    WHERE test_runs.test_id = %%s
+          AND %s
+          AND branches.id = %%s
           AND machines.is_active <> 0
-          AND date_run >= %s
-    ORDER BY date_run ASC
-"""
-        cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
-        cursor.execute(sql, (id, platformid, branchid, mktime(age.timetuple())))
-    else:
-        raise exc.HTTPBadRequest("You must provide one machineid *or* platformid")
+          AND date_run >= %%s
+""" % where
 
-    if cursor.rowcount > 0:
-        rows = cursor.fetchall()
-        averages = {}
-        ave_totals = {}
-        testRuns = []
-        for row in rows:
-            row_avg = 0
-            if row['average'] != None:
-                row_avg = row['average']
-            averages[row['ref_changeset']] = averages.get(row['ref_changeset'], 0) + row_avg
-            ave_totals[row['ref_changeset']] = ave_totals.get(row['ref_changeset'], 0) + 1
-            annotations = getAnnotations(row['id'], 'array')
-            testRuns.append([row['id'], [row['build_id'], row['ref_build_id'], row['ref_changeset']], row['date_run'], row_avg, row['run_number'], annotations, row['machine_id']])
+    # Look up the annotations for all the runs at once, before the runs
+    # themselves are streamed
+    annotations = getRunsAnnotations(tables, conditions, params)
 
+    sql = """
+    SELECT test_runs.*, builds.id as build_id, builds.ref_build_id, builds.ref_changeset""" + tables + conditions + """
+    ORDER BY date_run ASC
+"""
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.SSDictCursor)
+    cursor.execute(sql, params)
+
+    averages = {}
+    ave_totals = {}
+    testRuns = []
+    min_avg = max_avg = first_run = last_run = None
+    for row in cursor.iterrows():
+        row_avg = 0
+        if row['average'] != None:
+            row_avg = row['average']
+        averages[row['ref_changeset']] = averages.get(row['ref_changeset'], 0) + row_avg
+        ave_totals[row['ref_changeset']] = ave_totals.get(row['ref_changeset'], 0) + 1
+        if not testRuns:
+            min_avg = max_avg = row['average']
+            first_run = last_run = row['date_run']
+        else:
+            min_avg = min(min_avg, row['average'])
+            max_avg = max(max_avg, row['average'])
+            first_run = min(first_run, row['date_run'])
+            last_run = max(last_run, row['date_run'])
+        testRuns.append([row['id'], [row['build_id'], row['ref_build_id'], row['ref_changeset']], row['date_run'], row_avg, row['run_number'], annotations.get(row['id'], []), row['machine_id']])
+    cursor.close()
+
+    if testRuns:
         averages = dict(
             (changeset, total / ave_totals[changeset])
             for changeset, total in averages.iteritems())
         result = {'age': mktime(age.timetuple()), 'stat': 'ok', 'test_runs': testRuns,
                   'averages': averages,
-                  'min': min(row['average'] for row in rows),
-                  'max': max(row['average'] for row in rows),
-                  'date_range': [min(r['date_run'] for r in rows),
-                                 max(r['date_run'] for r in rows)]}
+                  'min': min_avg,
+                  'max': max_avg,
+                  'date_range': [first_run, last_run]}
     else:
         result = {'stat': 'fail', 'code': '102', 'message': 'No test runs found for test id ' + str(id)}
 
     return result
 
 
+def getRunsAnnotations(tables, conditions, params):
+    """Returns {test_run_id: [[note, bug_id], ...]} for the runs selected by
+    getTestRuns"""
+    sql = """
+    SELECT annotations.test_run_id, annotations.note, annotations.bug_id""" + tables + """
+                   INNER JOIN annotations ON (annotations.test_run_id = test_runs.id)""" + conditions + """
+    ORDER BY annotations.id
+"""
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor.execute(sql, params)
+    annotations = {}
+    for row in cursor.fetchall():
+        annotations.setdefault(row['test_run_id'], []).append([row['note'], row['bug_id']])
+    return annotations
+
+
+@read_db.pooled
 def getTestRun(id, attribute, req):
     if attribute == 'values':
         return getTestRunValues(id)
@@ -333,7 +369,7 @@ def getTestRun(id, attribute, req):
         sql = """SELECT test_runs.*, builds.id as build_id, builds.ref_build_id as ref_build_id, builds.ref_changeset as changeset
                 FROM test_runs INNER JOIN builds ON (test_runs.build_id = builds.id)
                 WHERE test_runs.id = %s"""
-        cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+        cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
         cursor.execute(sql, (id))
 
         if cursor.rowcount == 1:
@@ -373,7 +409,7 @@ def getLatestTestRunValues(id, req):
                LIMIT 1
                     """
 
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     cursor.execute(sql, (id, machineid, branchid))
 
     if cursor.rowcount == 1:
@@ -399,7 +435,7 @@ def getTestRunValues(id):
             LEFT JOIN pages ON(test_run_values.page_id = pages.id)
             WHERE test_run_values.test_run_id = %s"""
 
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     cursor.execute(sql, (id))
 
     testRunValues = []
@@ -420,7 +456,7 @@ def getTestRunValues(id):
 
 
 def getAnnotations(test_run_id, returnType='dictionary'):
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     sql = "SELECT * FROM annotations WHERE test_run_id = %s"
     annotations = []
     cursor.execute(sql, (test_run_id))
@@ -437,6 +473,7 @@ def getAnnotations(test_run_id, returnType='dictionary'):
 
 #Get a specific test by id. Fetched based on last test run for the test. This is required to get the machine it was run on
 # as the machine could change per test
+@read_db.pooled
 def getTest(id, attribute, req):
     if(attribute == 'runs'):
         return getTestRuns(id)
@@ -459,7 +496,7 @@ def getTest(id, attribute, req):
         ORDER BY
             test_runs.date_run DESC
         LIMIT 1"""
-        cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+        cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
         cursor.execute(sql, (id,))
 
         if cursor.rowcount == 1:
@@ -485,7 +522,7 @@ def getRevisionValues(req):
               'revisions': {},
               }
 
-    cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
     for rev in revisions:
         testRuns = result['revisions'].setdefault(rev, {})
         sql = """SELECT
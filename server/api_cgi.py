@@ -8,15 +8,17 @@ try:
 except ImportError:
     import json
 from api import getTests, getTest, getTestRun, getTestRuns
+from graphsdb import instrumented
 from webob.dec import wsgify
 from webob import Response
 
 try:
-    from graphsdb import db
+    from graphsdb import read_db as db
 except Exception, x:
     db = None
 
 
+@instrumented
 @wsgify
 def application(req):
     if db is None:
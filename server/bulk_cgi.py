@@ -9,7 +9,7 @@ import cgi
 import time
 import re
 
-from graphsdb import db
+from graphsdb import db, instrumented
 
 from webob.dec import wsgify
 from webob import Response
@@ -32,7 +32,9 @@ def checkString(var):
     return bool(reString.match(var))
 
 
+@instrumented
 @wsgify
+@db.pooled
 def application(req):
     resp = Response(content_type='text/plain')
     link_format = "RETURN:%s:%.2f:%sshow=%d\n"
@@ -6,14 +6,18 @@
 
 from webob.dec import wsgify
 from webob import Response
-import MySQLdb
 from pyfomatic import collect
-from graphsdb import db
+from graphsdb import db, MySQLdb, instrumented
 
 
+@instrumented
 @wsgify
+@db.pooled
 def application(req):
     (responseText, errorCode) = collect.handleRequest(req, db, MySQLdb)
+    if req.method == 'POST' and errorCode is None:
+        # collect commits on the cursor's connection
+        db.wrote()
     return Response(
         responseText,
         content_type='text/plain',
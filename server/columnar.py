@@ -0,0 +1,252 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Compact columnar files for bulk series export.
+
+A file is laid out as:
+
+    8 bytes   magic ("GRCOL" + version)
+    4 bytes   little endian length of the JSON header
+    header    JSON: {"rows": n, "meta": {...}, "columns": [...]}
+    columns   one fixed-width little endian array per column, each starting
+              on an 8 byte boundary
+
+Every column in the header records its name, numpy-style dtype ("<u4",
+"<f8", "|S12", ...), absolute byte offset and size, so consumers can
+memory-map the file and view each column in place, e.g.
+
+    numpy.memmap(filename, dtype=col['dtype'], mode='r',
+                 offset=col['offset'], shape=(rows,))
+"""
+import os
+import sys
+import mmap
+import struct
+from array import array
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+MAGIC = "GRCOL\x00\x01\x00"
+ALIGN = 8
+
+# The columns written for each exported series, in file order
+SERIES_COLUMNS = [
+    ('id', '<u8'),
+    ('date_run', '<u4'),
+    ('value', '<f8'),
+    ('machine_id', '<u4'),
+    ('build_id', '<u4'),
+    ('ref_build_id', '<u8'),
+    ('run_number', '<u1'),
+    ('revision', '|S12'),
+    ]
+
+
+class FormatError(Exception):
+    pass
+
+
+def _typecode(dtype):
+    """Returns the array module typecode matching a fixed-width dtype"""
+    kind, size = dtype[1], int(dtype[2:])
+    if kind == 'u':
+        candidates = 'BHIL'
+    elif kind == 'i':
+        candidates = 'bhil'
+    elif kind == 'f':
+        candidates = 'fd'
+    else:
+        raise FormatError("No array type for %s" % dtype)
+    for code in candidates:
+        if array(code).itemsize == size:
+            return code
+    raise FormatError("No array type for %s on this platform" % dtype)
+
+
+def _pack(dtype, values):
+    """Returns the raw little endian bytes for a column"""
+    if dtype[1] == 'S':
+        width = int(dtype[2:])
+        return "".join((v or "")[:width].ljust(width, "\0") for v in values)
+    a = values
+    if not isinstance(a, array) or a.typecode != _typecode(dtype):
+        a = array(_typecode(dtype), values)
+    if sys.byteorder == 'big':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tostring()
+
+
+def _unpack(dtype, data, rows):
+    """Turns raw column bytes back into an array (or list of strings)"""
+    if dtype[1] == 'S':
+        width = int(dtype[2:])
+        return [data[i:i+width].rstrip("\0") for i in range(0, rows * width, width)]
+    a = array(_typecode(dtype))
+    a.fromstring(data)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def writeColumns(fp, columns, meta=None):
+    """Writes columns, a list of (name, dtype, values), to a file object"""
+    rows = None
+    for name, dtype, values in columns:
+        if rows is None:
+            rows = len(values)
+        elif len(values) != rows:
+            raise FormatError("Column %s has %i rows, expected %i" % (name, len(values), rows))
+    rows = rows or 0
+
+    packed = [(name, dtype, _pack(dtype, values)) for name, dtype, values in columns]
+
+    # The header size depends on the offsets and the offsets depend on the
+    # header size, so lay it out until it stops growing
+    header_len = 0
+    while True:
+        offset = len(MAGIC) + 4 + header_len
+        descs = []
+        for name, dtype, data in packed:
+            offset += -offset % ALIGN
+            descs.append({'name': name, 'dtype': dtype, 'offset': offset, 'size': len(data)})
+            offset += len(data)
+        header = json.dumps({'rows': rows, 'meta': meta or {}, 'columns': descs},
+                            separators=(',', ':'), sort_keys=True)
+        if len(header) <= header_len:
+            header = header.ljust(header_len)
+            break
+        header_len = len(header) + 16
+
+    fp.write(MAGIC)
+    fp.write(struct.pack("<I", len(header)))
+    fp.write(header)
+    pos = len(MAGIC) + 4 + len(header)
+    for desc, (name, dtype, data) in zip(descs, packed):
+        fp.write("\0" * (desc['offset'] - pos))
+        fp.write(data)
+        pos = desc['offset'] + len(data)
+
+
+def writeArrow(fp, columns, meta=None, format='arrow'):
+    """Writes columns as an Arrow IPC file or Parquet file (needs pyarrow)"""
+    if pyarrow is None:
+        raise FormatError("pyarrow is required for %s output" % format)
+    names = [name for name, dtype, values in columns]
+    arrays = [pyarrow.array(list(values)) for name, dtype, values in columns]
+    table = pyarrow.Table.from_arrays(arrays, names)
+    if meta:
+        table = table.replace_schema_metadata(
+            dict((str(k), json.dumps(v)) for k, v in meta.items()))
+    if format == 'parquet':
+        pyarrow.parquet.write_table(table, fp)
+    else:
+        writer = pyarrow.RecordBatchFileWriter(fp, table.schema)
+        writer.write_table(table)
+        writer.close()
+
+
+def readHeader(buf):
+    """Parses the header at the start of a buffer"""
+    if buf[:len(MAGIC)] != MAGIC:
+        raise FormatError("Not a columnar file")
+    start = len(MAGIC) + 4
+    header_len = struct.unpack("<I", buf[len(MAGIC):start])[0]
+    return json.loads(buf[start:start + header_len])
+
+
+def readColumns(buf):
+    """Returns ({name: column}, meta) for a whole file held in a string,
+    with the columns as arrays (or lists of strings)"""
+    header = readHeader(buf)
+    columns = {}
+    for c in header['columns']:
+        data = buf[c['offset']:c['offset'] + c['size']]
+        columns[c['name']] = _unpack(c['dtype'], data, header['rows'])
+    return columns, header['meta']
+
+
+class ColumnarFile(object):
+    """A memory-mapped columnar file.
+
+    Columns are numpy arrays viewing the mapping directly when numpy is
+    available, and arrays copied out of it otherwise."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        fp = open(filename, "rb")
+        try:
+            size = os.fstat(fp.fileno()).st_size
+            if size == 0:
+                raise FormatError("%s is empty" % filename)
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        header = readHeader(self._map)
+        self.rows = header['rows']
+        self.meta = header['meta']
+        self.columns = dict((c['name'], c) for c in header['columns'])
+        self.names = [c['name'] for c in header['columns']]
+        self._cache = {}
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            c = self.columns[name]
+            if numpy is not None:
+                self._cache[name] = numpy.frombuffer(self._map, dtype=c['dtype'],
+                        count=self.rows, offset=c['offset'])
+            else:
+                data = self._map[c['offset']:c['offset'] + c['size']]
+                self._cache[name] = _unpack(c['dtype'], data, self.rows)
+        return self._cache[name]
+
+    def close(self):
+        self._cache = {}
+        self._map.close()
+
+
+class SeriesWriter(object):
+    """Accumulates test runs into compact column arrays"""
+
+    def __init__(self, meta=None):
+        self.meta = meta or {}
+        self.columns = []
+        for name, dtype in SERIES_COLUMNS:
+            if dtype[1] == 'S':
+                self.columns.append((name, dtype, []))
+            else:
+                self.columns.append((name, dtype, array(_typecode(dtype))))
+
+    def __len__(self):
+        return len(self.columns[0][2])
+
+    def add(self, id, date_run, value, machine_id, build_id, ref_build_id,
+            run_number, revision):
+        if value is None:
+            value = float('nan')
+        row = (id, date_run, value, machine_id, build_id, ref_build_id or 0,
+               run_number or 0, revision)
+        for (name, dtype, values), v in zip(self.columns, row):
+            values.append(v)
+
+    def write(self, fp, format='columnar'):
+        if format == 'columnar':
+            writeColumns(fp, self.columns, self.meta)
+        else:
+            writeArrow(fp, self.columns, self.meta, format)
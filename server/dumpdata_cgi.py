@@ -4,14 +4,140 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import MySQLdb.cursors
-from graphsdb import db
+import zlib
+
+from graphsdb import read_db, instrumented, MySQLdb
 
 from webob.dec import wsgify
 from webob import Response
+from webob import exc
+
+# How many runs to pull per keyset range when streaming
+PAGE_SIZE = 5000
+# How many rows to format before handing a chunk to the server
+CHUNK_ROWS = 500
+
+
+def getTestInfo(id):
+    """Returns the test name and the machine/build of its most recent run"""
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
+    sql = """SELECT tests.id, tests.name, machines.name AS machine_name, builds.ref_build_id
+        FROM tests INNER JOIN test_runs ON (tests.id = test_runs.test_id)
+        INNER JOIN builds ON (builds.id = test_runs.build_id)
+        INNER JOIN machines ON (test_runs.machine_id = machines.id) WHERE tests.id = %s
+        ORDER BY test_runs.date_run DESC LIMIT 1"""
+
+    cursor.execute(sql, (id,))
+    return cursor.fetchone()
+
+
+def makeRunsQuery(id, start, end, filters):
+    """Builds the test_runs query and parameters for a test and its optional
+    branch/machine/platform filters"""
+    sql = """SELECT test_runs.id, date_run, average, builds.ref_build_id FROM test_runs
+            INNER JOIN builds ON (test_runs.build_id = builds.id)"""
+    where = ["test_runs.test_id = %s"]
+    params = [id]
+
+    if filters.get('platformid') is not None:
+        sql += " INNER JOIN machines ON (test_runs.machine_id = machines.id)"
+        where.append("machines.os_id = %s")
+        params.append(filters['platformid'])
+    if filters.get('branchid') is not None:
+        where.append("builds.branch_id = %s")
+        params.append(filters['branchid'])
+    if filters.get('machineid') is not None:
+        where.append("test_runs.machine_id = %s")
+        params.append(filters['machineid'])
+    if start is not False:
+        where.append("date_run > %s AND date_run < %s")
+        params.extend([start, end])
+
+    return sql + " WHERE " + " AND ".join(where), params
+
+
+def iterRuns(id, start, end, filters, page_size=PAGE_SIZE):
+    """Yields the runs of a test ordered by (date_run, id).
+
+    Rows are read through a server-side cursor one keyset range at a time,
+    so only page_size rows are ever outstanding on the connection."""
+    sql, params = makeRunsQuery(id, start, end, filters)
+    last = None
+    while True:
+        page_sql = sql
+        page_params = list(params)
+        if last is not None:
+            page_sql += " AND (date_run > %s OR (date_run = %s AND test_runs.id > %s))"
+            page_params.extend([last[0], last[0], last[1]])
+        page_sql += " ORDER BY date_run, test_runs.id LIMIT %d" % page_size
+
+        cursor = read_db.cursor(cursorclass=MySQLdb.cursors.SSDictCursor)
+        cursor.execute(page_sql, page_params)
+        count = 0
+        try:
+            for row in cursor.iterrows(CHUNK_ROWS):
+                count += 1
+                last = (row['date_run'], row['id'])
+                yield row
+        finally:
+            cursor.close()
+
+        if count < page_size:
+            return
 
 
+def formatRun(test, row):
+    return '%s%s,%s,%s\n' % (test['id'], row['date_run'],
+                             row['average'], row['ref_build_id'])
+
+
+def iterExport(id, start, end, filters):
+    """Yields the export as a series of text chunks.
+
+    A streamed export outlives the request handler, so it holds its own
+    pooled connection until the server has consumed it."""
+    with read_db.connection():
+        test = getTestInfo(id)
+        if test is None:
+            return
+        yield "dataset,machine,branch,test\n"
+        yield ','.join([str(test['id']), test['machine_name'],
+                        str(test['ref_build_id']), test['name']]) + '\n'
+        yield "dataset,time,value,buildid,data\n"
+
+        chunk = []
+        for row in iterRuns(id, start, end, filters):
+            chunk.append(formatRun(test, row))
+            if len(chunk) >= CHUNK_ROWS:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+
+
+def gzipIter(chunks, level=6):
+    """Compresses an iterable of strings into a gzip stream on the fly"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def getIntParam(req, name):
+    value = req.params.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise exc.HTTPBadRequest("Invalid %s: %r" % (name, value))
+
+
+@instrumented
 @wsgify
+@read_db.pooled
 def application(req):
     resp = Response(content_type='text/plain')
     resp.headers['Access-Control-Allow-Origin'] = '*'
@@ -29,40 +155,25 @@ def application(req):
         if len(selections) == 2:
             start, end = int(selections[0]), int(selections[1])
         else:
-            start = False
-
-        cursor = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
-        sql = """SELECT tests.id, tests.name, machines.name AS machine_name, builds.ref_build_id, MAX(test_runs.date_run)
-            FROM tests INNER JOIN test_runs ON (tests.id = test_runs.test_id)
-            INNER JOIN builds ON (builds.id = test_runs.build_id)
-            INNER JOIN machines ON (test_runs.machine_id = machines.id) WHERE tests.id = %s GROUP BY tests.id"""
-
-        cursor.execute(sql, (id))
-
-        if cursor.rowcount == 1:
-            test = cursor.fetchone()
-            resp.write("dataset,machine,branch,test\n")
-            resp.write(','.join([str(test['id']), test['machine_name'],
-                                 str(test['ref_build_id']), test['name']]))
-            resp.write('\n')
-            resp.write("dataset,time,value,buildid,data\n")
-
-            sql = """SELECT date_run, average, builds.ref_build_id FROM test_runs INNER JOIN builds ON(test_runs.build_id = builds.id)
-                    WHERE test_runs.test_id = %s"""
-            params = (id,)
-
-            if start:
-                sql = sql + " AND date_run > %s AND date_run < %s"
-                params = (id, start, end)
-
-            cursor.execute(sql, params)
-
-            if cursor.rowcount > 0:
-                rows = cursor.fetchall()
-                for row in rows:
-                    resp.write('%s%s,%s,%s\n' %
-                               (test['id'], row['date_run'],
-                                row['average'], row['ref_build_id']))
+            start, end = False, None
+
+        filters = {}
+        for name in ('branchid', 'machineid', 'platformid'):
+            filters[name] = getIntParam(req, name)
+
+        if req.params.get('stream'):
+            # Stream the export rather than building it in memory; this is
+            # what full-history exports should use
+            chunks = iterExport(id, start, end, filters)
+            resp.headers['Vary'] = 'Accept-Encoding'
+            if 'gzip' in req.accept_encoding:
+                resp.content_encoding = 'gzip'
+                chunks = gzipIter(chunks)
+            resp.app_iter = chunks
+            return resp
+
+        for chunk in iterExport(id, start, end, filters):
+            resp.write(chunk)
     else:
         resp.write("Test not found")
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Exports every run of one (test, branch, os) series as a columnar file.
+#
+# incoming query string:
+# id=testid&branchid=branchid&platformid=osid
+#  (REQUIRED) the series to export
+# since=timestamp
+#  (OPTIONAL) only export the runs after this date_run
+# format=columnar|arrow|parquet
+#  columnar (the default) is described in columnar.py; arrow and parquet
+#  are only available when pyarrow is installed
+
+from cStringIO import StringIO
+
+from graphsdb import read_db, instrumented, MySQLdb
+import columnar
+
+from webob.dec import wsgify
+from webob import Response
+from webob import exc
+
+FORMATS = {'columnar': ('application/octet-stream', 'grcol'),
+           'arrow': ('application/vnd.apache.arrow.file', 'arrow'),
+           'parquet': ('application/octet-stream', 'parquet'),
+           }
+
+
+def iterSeriesRuns(test_id, branch_id, os_id, fetch_size=1000, since=None):
+    """Yields the runs of a series (after since, if given) ordered by
+    date_run through a server-side cursor"""
+    params = [test_id, branch_id, os_id]
+    since_clause = ""
+    if since is not None:
+        since_clause = "AND test_runs.date_run > %s"
+        params.append(since)
+    sql = """SELECT test_runs.id, test_runs.date_run, test_runs.average,
+                    test_runs.machine_id, test_runs.build_id, test_runs.run_number,
+                    builds.ref_build_id, builds.ref_changeset
+             FROM test_runs INNER JOIN builds ON (builds.id = test_runs.build_id)
+                            INNER JOIN machines ON (test_runs.machine_id = machines.id)
+             WHERE test_runs.test_id = %%s
+                   AND builds.branch_id = %%s
+                   AND machines.os_id = %%s
+                   %s
+             ORDER BY test_runs.date_run, test_runs.id""" % since_clause
+    cursor = read_db.cursor(cursorclass=MySQLdb.cursors.SSDictCursor)
+    cursor.execute(sql, params)
+    try:
+        for row in cursor.iterrows(fetch_size):
+            yield row
+    finally:
+        cursor.close()
+
+
+def buildSeries(test_id, branch_id, os_id, since=None):
+    """Returns a columnar.SeriesWriter holding every run of a series, or
+    those after since"""
+    writer = columnar.SeriesWriter({'test_id': test_id, 'branch_id': branch_id,
+                                    'os_id': os_id})
+    for row in iterSeriesRuns(test_id, branch_id, os_id, since=since):
+        writer.add(row['id'], row['date_run'], row['average'],
+                   row['machine_id'], row['build_id'], row['ref_build_id'],
+                   row['run_number'], row['ref_changeset'])
+    return writer
+
+
+@instrumented
+@wsgify
+@read_db.pooled
+def application(req):
+    try:
+        test_id = int(req.params['id'])
+        branch_id = int(req.params['branchid'])
+        os_id = int(req.params['platformid'])
+    except (KeyError, ValueError):
+        raise exc.HTTPBadRequest("You must provide an id, branchid and platformid")
+    since = None
+    if 'since' in req.params:
+        try:
+            since = int(req.params['since'])
+        except ValueError:
+            raise exc.HTTPBadRequest("since must be a timestamp")
+
+    format = req.params.get('format', 'columnar')
+    if format not in FORMATS:
+        raise exc.HTTPBadRequest("Unknown format: %r" % format)
+    if format != 'columnar' and columnar.pyarrow is None:
+        raise exc.HTTPBadRequest("The %s format is not available" % format)
+
+    writer = buildSeries(test_id, branch_id, os_id, since)
+    if not len(writer):
+        raise exc.HTTPNotFound("No test runs found")
+
+    content_type, ext = FORMATS[format]
+    buf = StringIO()
+    writer.write(buf, format)
+
+    resp = Response(content_type=content_type)
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s-%s-%s.%s' % (
+        test_id, branch_id, os_id, ext)
+    resp.body = buf.getvalue()
+    return resp
@@ -14,7 +14,7 @@ from webob.dec import wsgify
 from webob import Response
 from webob import exc
 
-from graphsdb import db
+from graphsdb import read_db, instrumented
 #
 # All objects are returned in the form:
 # {
@@ -61,7 +61,7 @@ from graphsdb import db
 
 
 def doTestInfo(fo, id):
-    cur = db.cursor()
+    cur = read_db.cursor()
     row = {}
     cur.execute("SELECT dataset_info.*, dataset_branchinfo.branchid FROM dataset_info JOIN dataset_branchinfo ON dataset_branchinfo.dataset_id = dataset_info.id WHERE dataset_info.id= ? LIMIT 1", (id,))
 
@@ -75,7 +75,7 @@ def doTestInfo(fo, id):
 
 
 def doFindDiscreteTest(fo, testname, date, machine):
-    cur = db.cursor()
+    cur = read_db.cursor()
     row = {}
     cur.execute("SELECT id FROM dataset_info WHERE test=? AND date=? AND machine=?", (testname, date, machine))
 
@@ -89,7 +89,7 @@ def doFindDiscreteTest(fo, testname, date, machine):
 
 
 def doFindContinuousTest(fo, testname, machine, branch):
-    cur = db.cursor()
+    cur = read_db.cursor()
     row = {}
     cur.execute("SELECT id FROM dataset_info WHERE test=? AND machine=? AND branch=?", (testname, machine, branch))
 
@@ -111,7 +111,7 @@ def doGetList(fo, type, branch, machine, testname):
         s1 = "SELECT DISTINCT machine FROM dataset_info"
     if testname:
         s1 = "SELECT DISTINCT test FROM dataset_info"
-    cur = db.cursor()
+    cur = read_db.cursor()
     cur.execute(s1 + " WHERE type = ?", (type,))
     for row in cur:
         results.append({"value": row[0]})
@@ -131,7 +131,7 @@ def doListTests(fo, type, datelimit, branch, machine, testname, graphby):
     if testname:
         s1 += " AND test = '" + testname + "' "
 
-    cur = db.cursor()
+    cur = read_db.cursor()
     if graphby and graphby == 'bydata':
         cur.execute("SELECT id, machine, test, test_type, dataset_extra_data.data, extra_data, branch FROM dataset_extra_data JOIN dataset_info di ON dataset_extra_data.dataset_id = dataset_info.id WHERE type = ? AND test_type != ? AND (date >= ?) " + s1 + " GROUP BY machine,test,test_type,dataset_extra_data.data, extra_data, branch", (type, "baseline", datelimit))
     elif type == 'discrete' and graphby and graphby == 'buildid':
@@ -189,7 +189,7 @@ def doSendAllResults(fo, setids):
     datasets = {}
     data = {}
     fo.write("{ resultcode: 0,")
-    cur = db.cursor()
+    cur = read_db.cursor()
     setids = [int(x) for x in setids.split(",")]
 
     datasets[setids[0]] = {}
@@ -233,7 +233,7 @@ def doSendAllResults(fo, setids):
     fo.write("],")
     fo.write("stats: {")
     for x in setids:
-        cur = db.cursor()
+        cur = read_db.cursor()
         cur.execute("SELECT avg(value), max(value), min(value) from dataset_values where dataset_id = ?  GROUP BY dataset_id", (x,))
         for row in cur:
             fo.write("'%s': [%s, %s, %s,]," % (x, row[0], row[1], row[2]))
@@ -252,7 +252,7 @@ def doSendResults(fo, setid, starttime, endtime, raw, graphby, extradata=None):
 
     fo.write("{ resultcode: 0,")
 
-    cur = db.cursor()
+    cur = read_db.cursor()
     if not graphby or graphby == "time":
         cur.execute("SELECT time, value FROM dataset_values WHERE dataset_id = ? " + s1 + s2 + " ORDER BY time", (setid,))
     else:
@@ -265,7 +265,7 @@ def doSendResults(fo, setid, starttime, endtime, raw, graphby, extradata=None):
     cur.close()
     fo.write("],")
 
-    cur = db.cursor()
+    cur = read_db.cursor()
     cur.execute("SELECT time, value FROM annotations WHERE dataset_id = ? " + s1 + s2 + " ORDER BY time", (setid,))
     fo.write("annotations: [")
     for row in cur:
@@ -273,7 +273,7 @@ def doSendResults(fo, setid, starttime, endtime, raw, graphby, extradata=None):
     cur.close()
     fo.write("],")
 
-    cur = db.cursor()
+    cur = read_db.cursor()
     cur.execute("SELECT test FROM dataset_info WHERE id = ?", (setid,))
     row = cur.fetchone()
     test_name = row[0]
@@ -290,7 +290,7 @@ def doSendResults(fo, setid, starttime, endtime, raw, graphby, extradata=None):
     cur.close()
 
     if raw:
-        cur = db.cursor()
+        cur = read_db.cursor()
         cur.execute("SELECT time, data FROM dataset_extra_data WHERE dataset_id = ? " + s1 + s2 + " ORDER BY time", (setid,))
         fo.write("rawdata: [")
         for row in cur:
@@ -303,7 +303,7 @@ def doSendResults(fo, setid, starttime, endtime, raw, graphby, extradata=None):
         cur.close()
         fo.write("],")
 
-    cur = db.cursor()
+    cur = read_db.cursor()
     cur.execute("SELECT avg(value), max(value), min(value) from dataset_values where dataset_id = ? " + s1 + s2 + " GROUP BY dataset_id", (setid,))
     fo.write("stats: [")
     for row in cur:
@@ -330,7 +330,9 @@ def checkString(var):
     return bool(reString.match(var))
 
 
+@instrumented
 @wsgify
+@read_db.pooled
 def application(req):
     #make sure that we are getting clean data from the user
     values = {}
@@ -371,7 +373,7 @@ def application(req):
 
     resp.headers['Access-Control-Allow-Origin'] = '*'
     resp.content_type = 'text/plain'
-    if 'gzip' in resp.accept_encoding:
+    if 'gzip' in req.accept_encoding:
         resp.encode_content('gzip')
 
     return resp
@@ -2,11 +2,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 import os
+import re
 import sys
+import time
+import random
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from functools import wraps
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-from databases import mysql as MySQLdb
-
 kw = {}
 for environ_name, kw_name in [('CONFIG_MYSQL_HOST', 'host'),
                               ('CONFIG_MYSQL_USER', 'user'),
@@ -16,6 +22,203 @@ for environ_name, kw_name in [('CONFIG_MYSQL_HOST', 'host'),
     if os.environ.get(environ_name):
         kw[kw_name] = os.environ[environ_name]
 
+# SQLite can stand in for MySQL for load tests and local use; handlers get
+# the driver module as graphsdb.MySQLdb either way
+if os.environ.get('CONFIG_DB_BACKEND') == 'sqlite':
+    from databases import sqlite as MySQLdb
+    kw = {'db': os.environ.get('CONFIG_SQLITE_DB', 'graphs.sqlite')}
+else:
+    from databases import mysql as MySQLdb
+
+# Read replicas, as a comma separated list of host[:port]; reads go to the
+# primary when this is empty
+read_hosts = [h.strip() for h in os.environ.get('CONFIG_MYSQL_READ_HOSTS', '').split(',')
+              if h.strip()]
+read_kw = dict(kw)
+for environ_name, kw_name in [('CONFIG_MYSQL_READ_USER', 'user'),
+                              ('CONFIG_MYSQL_READ_PASSWORD', 'passwd'),
+                              ]:
+    if os.environ.get(environ_name):
+        read_kw[kw_name] = os.environ[environ_name]
+# For how many seconds after a write reads should go to the primary, and
+# optionally a file whose mtime records writes from other processes
+read_your_writes = float(os.environ.get('CONFIG_MYSQL_READ_YOUR_WRITES') or 0)
+write_marker = os.environ.get('CONFIG_MYSQL_WRITE_MARKER')
+
+pool_kw = {}
+for environ_name, kw_name in [('CONFIG_MYSQL_POOL_SIZE', 'size'),
+                              ('CONFIG_MYSQL_POOL_TIMEOUT', 'timeout'),
+                              ('CONFIG_MYSQL_POOL_PING', 'ping_after'),
+                              ('CONFIG_MYSQL_POOL_MAX_LIFETIME', 'max_lifetime'),
+                              ]:
+    if os.environ.get(environ_name):
+        pool_kw[kw_name] = float(os.environ[environ_name])
+
+# Per-request query statistics: CONFIG_MYSQL_DEBUG adds them to the
+# response headers, and statements taking CONFIG_MYSQL_SLOW_TIME seconds
+# (default 1) or longer are written to CONFIG_MYSQL_SLOW_LOG, or a
+# CONFIG_MYSQL_SLOW_SAMPLE fraction of them (default all)
+debug_queries = bool(os.environ.get('CONFIG_MYSQL_DEBUG'))
+slow_log = os.environ.get('CONFIG_MYSQL_SLOW_LOG')
+slow_time = float(os.environ.get('CONFIG_MYSQL_SLOW_TIME') or 1)
+slow_sample = float(os.environ.get('CONFIG_MYSQL_SLOW_SAMPLE') or 1)
+
+_literals = re.compile(r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.)*"|\b\d+(?:\.\d+)?\b|%s|\?""")
+_lists = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_spaces = re.compile(r"\s+")
+
+
+def normalize(query):
+    """Returns query with its literals and parameters replaced by ?, so
+    statements that differ only in their values read the same"""
+    query = _literals.sub("?", query)
+    query = _lists.sub("(...)", query)
+    return _spaces.sub(" ", query).strip()
+
+
+class QueryStats(object):
+    """The queries run while handling one request"""
+
+    keep = 5
+
+    def __init__(self, name=None):
+        self.name = name
+        self.queries = 0
+        self.time = 0.0
+        self.rows = 0
+        # The slowest (elapsed, query) pairs, slowest first
+        self._slowest = []
+
+    def executed(self, query, elapsed):
+        self.queries += 1
+        self.time += elapsed
+        slowest = self._slowest
+        if len(slowest) < self.keep or elapsed > slowest[-1][0]:
+            slowest.append((elapsed, query))
+            slowest.sort(key=lambda item: -item[0])
+            del slowest[self.keep:]
+
+    def fetched(self, rows, elapsed):
+        self.rows += rows
+        self.time += elapsed
+
+    def slowest(self):
+        """Returns the slowest (elapsed, normalized statement) pairs, each
+        statement once"""
+        result = []
+        seen = set()
+        for elapsed, query in self._slowest:
+            statement = normalize(query)
+            if statement not in seen:
+                seen.add(statement)
+                result.append((elapsed, statement))
+        return result
+
+    def headers(self):
+        headers = [('Server-Timing', 'db;dur=%.1f;desc="%i queries, %i rows"'
+                    % (self.time * 1000, self.queries, self.rows))]
+        for elapsed, statement in self.slowest():
+            headers.append(('X-DB-Slow-Query', "%.1fms %s" % (elapsed * 1000, statement[:300])))
+        return headers
+
+
+class QueryLog(object):
+    """Keeps the QueryStats of the request each thread is handling, and
+    writes the slow query log.
+
+    Listeners are called with each request's QueryStats once it's done."""
+
+    def __init__(self, debug=False, slow_log=None, slow_time=1.0, slow_sample=1.0):
+        self.debug = debug
+        self.slow_time = slow_time
+        self.slow_sample = slow_sample
+        self.listeners = []
+        self._local = threading.local()
+        self._log = None
+        if slow_log:
+            self._log = logging.getLogger('graphsdb.slow.%s' % slow_log)
+            self._log.propagate = False
+            handler = logging.FileHandler(slow_log)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self._log.addHandler(handler)
+
+    def current(self):
+        """Returns the QueryStats of this thread's request, or None"""
+        return getattr(self._local, 'stats', None)
+
+    def start(self, name=None):
+        self._local.stats = QueryStats(name)
+        return self._local.stats
+
+    def finish(self):
+        stats = self.current()
+        self._local.stats = None
+        if stats is not None:
+            for listener in self.listeners:
+                listener(stats)
+        return stats
+
+    def executed(self, query, elapsed):
+        stats = self.current()
+        if stats is not None:
+            stats.executed(query, elapsed)
+        if (self._log is not None and elapsed >= self.slow_time
+            and random.random() < self.slow_sample):
+            self._log.warning("%.3fs %s %s", elapsed, stats and stats.name or '-',
+                              normalize(query))
+
+    def fetched(self, rows, elapsed):
+        stats = self.current()
+        if stats is not None:
+            stats.fetched(rows, elapsed)
+
+queries = QueryLog(debug_queries, slow_log, slow_time, slow_sample)
+
+
+def instrumented(app):
+    """WSGI middleware recording the queries each request runs in
+    graphsdb.queries; in debug mode they're added to the response headers.
+
+    Queries run while a streamed body is read still count, though they
+    come too late for the headers."""
+    def wrapper(environ, start_response):
+        name = environ.get('REQUEST_METHOD', 'GET') + ' ' + \
+            environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        if environ.get('QUERY_STRING'):
+            name += '?' + environ['QUERY_STRING'][:200]
+        stats = queries.start(name)
+
+        def start(status, headers, exc_info=None):
+            if queries.debug:
+                headers = list(headers) + stats.headers()
+            return start_response(status, headers, exc_info)
+        try:
+            body = app(environ, start)
+        except:
+            queries.finish()
+            raise
+        return _Finished(body, queries.finish)
+    return wrapper
+
+
+class _Finished(object):
+    """Wraps a WSGI body to call finish once it's been closed"""
+
+    def __init__(self, body, finish):
+        self.body = body
+        self.finish = finish
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish()
+
+
 ## This gets around problems with MySQL dropping a connection -- we
 ## catch the error and try to reopen the connection:
 
@@ -26,9 +229,21 @@ class RetryConnection(object):
     def __init__(self, **kw):
         self._kw = kw
         self._db = None
+        # When the current MySQL connection was opened
+        self.created = None
 
     def _reconnect(self):
         self._db = MySQLdb.connect(**self._kw)
+        self.created = time.time()
+
+    def _close(self):
+        if self._db is not None:
+            try:
+                self._db.close()
+            except MySQLdb.Error:
+                pass
+        self._db = None
+        self.created = None
 
     def cursor(self, *args, **kw):
         if self._db is None:
@@ -53,19 +268,299 @@ class RetryConnection(object):
                         self._reconnect()
                     else:
                         raise
-        return repl
+        if attr != 'execute':
+            return repl
+
+        def execute(query, *args, **kw):
+            start = time.time()
+            try:
+                return repl(query, *args, **kw)
+            finally:
+                queries.executed(query, time.time() - start)
+        return execute
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """A bounded pool of RetryConnections.
+
+    Each thread checks out at most one connection at a time; nested
+    checkouts from the same thread share it.  Connections that have been
+    idle for ping_after seconds are pinged before being handed out, and
+    connections older than max_lifetime seconds are reopened."""
+
+    def __init__(self, size=5, timeout=30, ping_after=60, max_lifetime=3600, **kw):
+        self._kw = kw
+        self.size = int(size)
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.max_lifetime = max_lifetime
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self.stats = {'checkouts': 0,
+                      'waits': 0,
+                      'wait_time': 0.0,
+                      'max_wait': 0.0,
+                      'timeouts': 0,
+                      'recycled': 0,
+                      'ping_failures': 0,
+                      }
+
+    def current(self):
+        """Returns the connection this thread has checked out, or None"""
+        return getattr(self._local, 'conn', None)
+
+    def checkout(self):
+        local = self._local
+        if getattr(local, 'depth', 0):
+            local.depth += 1
+            return local.conn
+        local.conn = self._acquire()
+        local.depth = 1
+        return local.conn
+
+    def checkin(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0:
+            conn, local.conn = local.conn, None
+            self._release(conn)
 
-db = RetryConnection(**kw)
+    def _acquire(self):
+        start = time.time()
+        waited = False
+        conn = None
+        self._cond.acquire()
+        try:
+            while not self._idle and self._created >= self.size:
+                remaining = self.timeout - (time.time() - start)
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout("No database connection free after %ss" % self.timeout)
+                waited = True
+                self._cond.wait(remaining)
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                self._created += 1
+            wait = time.time() - start
+            self.stats['checkouts'] += 1
+            if waited:
+                self.stats['waits'] += 1
+                self.stats['wait_time'] += wait
+                self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+        finally:
+            self._cond.release()
+
+        if conn is None:
+            # The MySQL connection itself is opened on first use
+            conn = RetryConnection(**self._kw)
+        else:
+            self._validate(conn)
+        return conn
+
+    def _validate(self, conn):
+        if conn._db is None:
+            return
+        now = time.time()
+        if self.max_lifetime and now - conn.created > self.max_lifetime:
+            self.stats['recycled'] += 1
+            conn._close()
+        elif self.ping_after and now - conn.last_used > self.ping_after:
+            try:
+                conn._db.ping()
+            except MySQLdb.Error:
+                self.stats['ping_failures'] += 1
+                conn._close()
+
+    def _release(self, conn):
+        if conn._db is not None:
+            try:
+                # Don't carry a transaction (or its read snapshot) over to
+                # the next user
+                conn._db.rollback()
+            except MySQLdb.Error:
+                conn._close()
+        conn.last_used = time.time()
+        self._cond.acquire()
+        try:
+            self._idle.append(conn)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def metrics(self):
+        """Returns the pool statistics along with its current usage"""
+        self._cond.acquire()
+        try:
+            result = dict(self.stats)
+            result['size'] = self.size
+            result['open'] = self._created
+            result['idle'] = len(self._idle)
+            result['in_use'] = self._created - len(self._idle)
+        finally:
+            self._cond.release()
+        if result['waits']:
+            result['avg_wait'] = result['wait_time'] / result['waits']
+        else:
+            result['avg_wait'] = 0.0
+        return result
+
+
+class PooledConnection(object):
+    """Stands in for a connection, forwarding to the connection the current
+    thread has checked out of the pool.
+
+    Handlers should hold a connection for the whole request with
+    connection() or the pooled decorator.  Code that uses the object without
+    checking out first (scripts, mostly) gets a connection that stays with
+    its thread."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._local = threading.local()
+
+    def _choosePool(self):
+        return self.pool
+
+    def _pool(self):
+        """Returns the pool this thread is using, choosing one if it has
+        nothing checked out"""
+        pool = getattr(self._local, 'pool', None)
+        if pool is None or pool.current() is None:
+            pool = self._local.pool = self._choosePool()
+        return pool
+
+    def _conn(self):
+        pool = self._pool()
+        conn = pool.current()
+        if conn is None:
+            conn = pool.checkout()
+        return conn
+
+    @contextmanager
+    def connection(self):
+        pool = self._pool()
+        conn = pool.checkout()
+        try:
+            yield conn
+        finally:
+            pool.checkin()
+
+    def pooled(self, func):
+        """Decorator that holds a connection while func runs"""
+        @wraps(func)
+        def wrapper(*args, **kw):
+            with self.connection():
+                return func(*args, **kw)
+        return wrapper
+
+    def cursor(self, *args, **kw):
+        return self._conn().cursor(*args, **kw)
+
+    def __getattr__(self, attr):
+        return getattr(self._conn(), attr)
+
+
+class PrimaryConnection(PooledConnection):
+    """The read/write connection; it remembers when it last committed so
+    reads can be kept on the primary for a while afterwards.  Writes
+    committed some other way (on a cursor's connection, say) should be
+    recorded with wrote()."""
+
+    def __init__(self, pool, marker=None):
+        PooledConnection.__init__(self, pool)
+        self.marker = marker
+        self.last_write = 0
+
+    def commit(self):
+        self._conn().commit()
+        self.wrote()
+
+    def wrote(self):
+        self.last_write = time.time()
+        if self.marker:
+            try:
+                os.utime(self.marker, None)
+            except OSError:
+                open(self.marker, 'a').close()
+
+    def lastWrite(self):
+        """Returns when this or (with a marker file) any process last wrote"""
+        if self.marker:
+            try:
+                return max(self.last_write, os.stat(self.marker).st_mtime)
+            except OSError:
+                pass
+        return self.last_write
+
+
+class ReplicaConnection(PooledConnection):
+    """The read-only connection; each checkout goes to the next replica
+    pool in turn, or to the primary shortly after a write"""
+
+    def __init__(self, pools, primary, window=0):
+        PooledConnection.__init__(self, None)
+        self.pools = pools
+        self.primary = primary
+        self.window = window
+        self._turn = itertools.count()
+
+    def _choosePool(self):
+        if self.window and time.time() - self.primary.lastWrite() < self.window:
+            return self.primary.pool
+        return self.pools[next(self._turn) % len(self.pools)]
+
+
+def replicaKw(host, kw):
+    """Returns connection arguments for a host[:port] replica"""
+    kw = dict(kw)
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        kw['port'] = int(port)
+    kw['host'] = host
+    return kw
+
+# The marker only matters to processes reading from replicas
+db = PrimaryConnection(ConnectionPool(**dict(kw, **pool_kw)),
+                       read_hosts and write_marker or None)
+if read_hosts:
+    read_db = ReplicaConnection(
+        [ConnectionPool(**dict(replicaKw(host, read_kw), **pool_kw))
+         for host in read_hosts],
+        db, read_your_writes)
+else:
+    read_db = db
 # For access to the AMO database (for collect_cgi) use:
 #amo_db = RetryConnection(...)
 
 
 class RetryCursor(object):
+    """Wraps a cursor, reconnecting and retrying when the server has gone
+    away.
+
+    Unbuffered cursors (SSCursor, SSDictCursor) should be read with
+    iterrows(); a lost connection is only retried until the first row has
+    been handed out, since after that the rows can't be replayed.  Other
+    queries can't be run on the connection until such a cursor has been
+    read to the end or closed.
+
+    Each statement, and the rows fetched, are recorded in graphsdb.queries."""
+
+    # Server has gone away, lost connection during query
+    _retry_errors = (2006, 2013)
 
     def __init__(self, conn, *args, **kw):
         self._args = args
         self._kw = kw
         self._connection = conn
+        self._query = None
+        self._consumed = False
         self._connect_cursor()
 
     def _connect_cursor(self, reconnect=False):
@@ -74,18 +569,71 @@ class RetryCursor(object):
         self._cursor = self._connection._db.cursor(*self._args, **self._kw)
 
     def execute(self, *args, **kw):
+        self._query = (args, kw)
+        self._consumed = False
         tries = 0
+        start = time.time()
+        try:
+            while 1:
+                try:
+                    return self._cursor.execute(*args, **kw)
+                except MySQLdb.OperationalError, e:
+                    if e.args[0] == 2006:
+                        tries += 1
+                        if tries >= self._connection._retries:
+                            raise
+                        self._connect_cursor(True)
+                    else:
+                        raise
+        finally:
+            queries.executed(args and args[0] or kw.get('query', ''), time.time() - start)
+
+    def _fetch(self, method, *args):
+        tries = 0
+        start = time.time()
         while 1:
             try:
-                return self._cursor.execute(*args, **kw)
+                result = getattr(self._cursor, method)(*args)
+                break
             except MySQLdb.OperationalError, e:
-                if e.args[0] == 2006:
-                    tries += 1
-                    if tries >= self._connection._retries:
-                        raise
-                    self._connect_cursor(True)
-                else:
+                if (e.args[0] not in self._retry_errors or self._consumed
+                    or self._query is None):
+                    raise
+                tries += 1
+                if tries >= self._connection._retries:
                     raise
+                self._connect_cursor(True)
+                args_, kw_ = self._query
+                self.execute(*args_, **kw_)
+        if result:
+            self._consumed = True
+        if method == 'fetchone':
+            rows = result is not None and 1 or 0
+        else:
+            rows = len(result)
+        queries.fetched(rows, time.time() - start)
+        return result
+
+    def fetchone(self):
+        return self._fetch('fetchone')
+
+    def fetchmany(self, *args):
+        return self._fetch('fetchmany', *args)
+
+    def fetchall(self):
+        return self._fetch('fetchall')
+
+    def iterrows(self, size=1000):
+        """Yields the result rows, fetching size rows at a time"""
+        while 1:
+            rows = self.fetchmany(size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    def __iter__(self):
+        return self.iterrows()
 
     def __getattr__(self, attr):
         return getattr(self._cursor, attr)
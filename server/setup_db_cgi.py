@@ -8,7 +8,7 @@ import os
 import warnings
 from webob.dec import wsgify
 from webob import Response
-from graphsdb import db
+from graphsdb import db, instrumented
 
 # These table-exists warnings are boring:
 warnings.filterwarnings('ignore', message=r'Table.*already exists')
@@ -17,6 +17,7 @@ here = os.path.dirname(os.path.abspath(__file__))
 sql_file = os.path.join(here, '../sql/schema.sql')
 
 
+@instrumented
 @wsgify
 def application(req):
     cursor = db.cursor()
@@ -81,7 +81,8 @@ CREATE TABLE IF NOT EXISTS test_runs (
 
    PRIMARY KEY (id),
    KEY (test_id, build_id),
-   KEY (test_id, build_id, date_run)
+   KEY (test_id, build_id, date_run),
+   KEY (test_id, date_run)
 ) ENGINE=InnoDB;
 
 CREATE TABLE IF NOT EXISTS test_run_values (
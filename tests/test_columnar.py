@@ -0,0 +1,49 @@
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+server_path = os.path.join(os.path.dirname(here), 'server')
+sys.path.append(server_path)
+
+import columnar
+
+
+def write_series(filename):
+    writer = columnar.SeriesWriter({'test_id': 1, 'branch_id': 2, 'os_id': 3})
+    writer.add(10, 1229477017, 2.5, 234, 2220, 20090115164131, 0, 'a2018012b3ee')
+    writer.add(11, 1229477018, None, 235, 2221, None, 1, None)
+    fp = open(filename, 'wb')
+    writer.write(fp)
+    fp.close()
+
+
+def test_roundtrip(tmpdir):
+    filename = str(tmpdir.join('series.grcol'))
+    write_series(filename)
+    f = columnar.ColumnarFile(filename)
+    assert len(f) == 2
+    assert f.meta == {'test_id': 1, 'branch_id': 2, 'os_id': 3}
+    assert f.names == [name for name, dtype in columnar.SERIES_COLUMNS]
+    assert list(f['id']) == [10, 11]
+    assert list(f['ref_build_id']) == [20090115164131, 0]
+    assert list(f['revision']) == ['a2018012b3ee', '']
+    assert f['value'][0] == 2.5
+    assert f['value'][1] != f['value'][1]
+    f.close()
+
+
+def test_columns_are_aligned(tmpdir):
+    filename = str(tmpdir.join('series.grcol'))
+    write_series(filename)
+    header = columnar.readHeader(open(filename, 'rb').read())
+    for column in header['columns']:
+        assert column['offset'] % columnar.ALIGN == 0
+
+
+def test_read_columns(tmpdir):
+    filename = str(tmpdir.join('series.grcol'))
+    write_series(filename)
+    columns, meta = columnar.readColumns(open(filename, 'rb').read())
+    assert meta == {'test_id': 1, 'branch_id': 2, 'os_id': 3}
+    assert list(columns['machine_id']) == [234, 235]
+    assert columns['revision'] == ['a2018012b3ee', '']
@@ -0,0 +1,43 @@
+import os
+import sys
+import zlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.append(os.path.join(root, 'server'))
+sys.path.append(os.path.join(root, 'scripts'))
+
+os.environ['CONFIG_DB_BACKEND'] = 'sqlite'
+os.environ['CONFIG_SQLITE_DB'] = ':memory:'
+
+from webob import Request
+
+import graphsdb
+import loadtest
+import dumpdata_cgi
+
+
+def test_stream():
+    # Nested checkouts share the connection, so the in-memory database
+    # lasts as long as this one
+    with graphsdb.read_db.connection() as retry_conn:
+        # The schema is made on the driver's own connection
+        retry_conn.cursor()
+        conn = retry_conn._db
+        loadtest.createSchema(graphsdb.MySQLdb, conn)
+        loadtest.seed(conn, days=2)
+        plain = Request.blank('/dump?id=1').get_response(dumpdata_cgi.application)
+        assert plain.status_int == 200 and plain.body
+        assert 'Vary' not in plain.headers
+
+        req = Request.blank('/dump?id=1&stream=1', headers={'Accept-Encoding': 'identity'})
+        resp = req.get_response(dumpdata_cgi.application)
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert resp.content_encoding is None
+        assert resp.body == plain.body
+
+        req = Request.blank('/dump?id=1&stream=1', headers={'Accept-Encoding': 'gzip'})
+        resp = req.get_response(dumpdata_cgi.application)
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert resp.content_encoding == 'gzip'
+        assert zlib.decompress(resp.body, 16 + zlib.MAX_WBITS) == plain.body
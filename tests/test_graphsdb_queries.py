@@ -0,0 +1,115 @@
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(here), 'server'))
+
+os.environ['CONFIG_DB_BACKEND'] = 'sqlite'
+os.environ['CONFIG_SQLITE_DB'] = ':memory:'
+
+from webob import Request, Response
+from webob.dec import wsgify
+
+import graphsdb
+from graphsdb import db, instrumented, normalize
+
+
+def test_normalize():
+    assert normalize("SELECT *  FROM t\n  WHERE a = 'it''s' AND b = 12.5 AND c = %s") == \
+        "SELECT * FROM t WHERE a = ? AND b = ? AND c = ?"
+    assert normalize("SELECT id FROM t1 WHERE id IN (1, 2, 3) AND x = ?") == \
+        "SELECT id FROM t1 WHERE id IN (...) AND x = ?"
+
+
+STATEMENTS = ["CREATE TABLE t (id INT, name TEXT)",
+              "INSERT INTO t (id, name) VALUES (...)",
+              "SELECT id, name FROM t WHERE id >= ?",
+              "SELECT name FROM t WHERE id = ?",
+              "DROP TABLE t"]
+
+
+@instrumented
+@wsgify
+@db.pooled
+def application(req):
+    db.execute("CREATE TABLE t (id INT, name TEXT)")
+    for i in range(3):
+        db.execute("INSERT INTO t (id, name) VALUES (%s, %s)", (i, "row%i" % i))
+    cur = db.cursor()
+    cur.execute("SELECT id, name FROM t WHERE id >= %s", (0,))
+    rows = cur.fetchall()
+    cur.execute("SELECT name FROM t WHERE id = %s", (1,))
+    cur.fetchone()
+    db.execute("DROP TABLE t")
+    return Response("%i rows" % len(rows))
+
+
+def test_request_stats(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(graphsdb.queries, 'listeners', [recorded.append])
+    monkeypatch.setattr(graphsdb.queries, 'debug', False)
+    resp = Request.blank('/t?x=1').get_response(application)
+    assert resp.body == "3 rows"
+    assert 'Server-Timing' not in resp.headers
+    stats, = recorded
+    assert stats.name == "GET /t?x=1"
+    assert stats.queries == 7
+    assert stats.rows == 4
+    # Five of the seven are kept; the inserts read the same once normalized
+    statements = [statement for elapsed, statement in stats.slowest()]
+    assert 3 <= len(statements) <= 5
+    assert set(statements) <= set(STATEMENTS)
+    assert graphsdb.queries.current() is None
+
+    monkeypatch.setattr(graphsdb.queries, 'debug', True)
+    resp = Request.blank('/t').get_response(application)
+    assert resp.headers['Server-Timing'].startswith('db;dur=')
+    assert resp.headers['Server-Timing'].endswith(';desc="7 queries, 4 rows"')
+    for header in resp.headers.getall('X-DB-Slow-Query'):
+        elapsed, statement = header.split("ms ", 1)
+        assert float(elapsed) >= 0
+        assert statement in STATEMENTS
+
+
+def test_slow_log(tmpdir):
+    filename = str(tmpdir.join('slow.log'))
+    log = graphsdb.QueryLog(slow_log=filename, slow_time=0.5)
+    log.start("GET /api")
+    log.executed("SELECT * FROM t WHERE id = 5", 0.75)
+    log.executed("SELECT * FROM t WHERE id = 6", 0.1)
+    stats = log.finish()
+    assert stats.queries == 2
+    log.executed("UPDATE t SET x = 'y'", 2.0)
+    lines = open(filename).read().splitlines()
+    assert [line.split(' ', 2)[2] for line in lines] == [
+        "0.750s GET /api SELECT * FROM t WHERE id = ?",
+        "2.000s - UPDATE t SET x = ?"]
+
+    sampled = graphsdb.QueryLog(slow_log=str(tmpdir.join('sampled.log')), slow_time=0,
+                                slow_sample=0)
+    sampled.executed("SELECT 1", 1.0)
+    assert open(str(tmpdir.join('sampled.log'))).read() == ""
+
+
+def test_writes_recorded_on_commit(tmpdir):
+    marker = str(tmpdir.join('written'))
+    primary = graphsdb.PrimaryConnection(graphsdb.ConnectionPool(db=':memory:'), marker)
+    with primary.connection():
+        cur = primary.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchall()
+    try:
+        with primary.connection():
+            primary.execute("CREATE TABLE t (id INT)")
+            raise ValueError
+    except ValueError:
+        pass
+    # Neither reads nor requests that fail count as writes
+    assert primary.lastWrite() == 0
+    assert not os.path.exists(marker)
+
+    with primary.connection():
+        primary.execute("INSERT INTO t (id) VALUES (1)")
+        primary.commit()
+    assert primary.lastWrite() > 0
+    assert os.path.exists(marker)
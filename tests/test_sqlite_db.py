@@ -0,0 +1,65 @@
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+sys.path.append(root)
+sys.path.append(os.path.join(root, 'scripts'))
+
+from databases import sqlite
+import loadtest
+
+
+def test_translate():
+    assert sqlite.translate("SELECT id FROM t WHERE a <=> ?", (1,)) == \
+        "SELECT id FROM t WHERE a  IS  ?"
+    assert sqlite.translate("SELECT * FROM t WHERE a = %s AND b LIKE 'x%%'", (1,)) == \
+        "SELECT * FROM t WHERE a = ? AND b LIKE 'x%'"
+    # Without arguments nothing is formatted, as with MySQLdb
+    assert sqlite.translate("SELECT '%%'") == "SELECT '%%'"
+
+
+def test_schema_and_cursors():
+    conn = sqlite.connect(":memory:")
+    sqlite.createSchema(conn, open(os.path.join(root, 'sql', 'schema.sql')).read())
+    conn.execute("INSERT INTO branches (name) VALUES (%s)", ("Firefox",))
+    assert conn.insert_id() == 1
+    conn.execute("INSERT INTO branches (name) VALUES (?)", ("Try",))
+    try:
+        conn.execute("INSERT INTO branches (name) VALUES (%s)", "Try")
+    except sqlite.IntegrityError:
+        pass
+    else:
+        assert False, "branch names should be unique"
+
+    cur = conn.cursor(cursorclass=sqlite.cursors.DictCursor)
+    assert cur.execute("SELECT id, name FROM branches ORDER BY id") == 2
+    assert cur.rowcount == 2
+    assert cur.fetchone() == {'id': 1, 'name': 'Firefox'}
+    assert cur.fetchall() == [{'id': 2, 'name': 'Try'}]
+
+    cur = conn.cursor(cursorclass=sqlite.cursors.SSCursor)
+    cur.execute("SELECT name FROM branches ORDER BY id")
+    assert [row[0] for row in cur] == ['Firefox', 'Try']
+    assert isinstance(row[0], str)
+
+
+def test_seed():
+    conn = sqlite.connect(":memory:")
+    loadtest.createSchema(sqlite, conn)
+    counts = loadtest.seed(conn, now=1000000000)
+    data = loadtest.Dataset(conn)
+    assert data.last_run - data.first_run + 1 == counts['runs']
+    assert len(data.combos) == len(loadtest.TESTS) * len(loadtest.BRANCHES) * len(loadtest.OSES)
+    assert len(data.sets) == counts['datasets']
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM test_run_values")
+    assert cur.fetchone()[0] == counts['values']
+
+
+def test_percentile():
+    values = range(1, 101)
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([5], 95) == 5
+    assert loadtest.percentile([], 50) is None